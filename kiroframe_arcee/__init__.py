@@ -1,5 +1,12 @@
 # flake8: noqa: F401
+from . import aio
 from .arcee import (init, send, tag, milestone, info, finish, error, stage,
-                    hyperparam, model, model_version, model_version_alias,
+                    hyperparam, hyperparams, model, model_version, model_version_alias,
                     model_version_tag, artifact, artifact_tag, Dataset,
-                    log_dataset, use_dataset)
+                    log_dataset, use_dataset, Run, current_run, counters)
+from .modules.object_store import ObjectStore
+from .sender.sender import set_request_timeouts
+from .sender.encoding import set_request_compression, set_serializer
+from .modules.governor import Governor, set_transfer_limits
+from .modules.extractors import register_extractor
+from .modules.providers import register_provider
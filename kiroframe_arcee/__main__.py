@@ -0,0 +1,5 @@
+import sys
+
+from kiroframe_arcee.cli import main
+
+sys.exit(main())
@@ -0,0 +1,517 @@
+import asyncio
+import atexit
+import aiohttp
+import contextvars
+import time
+import threading
+import warnings
+from contextlib import contextmanager
+from functools import partial
+
+from kiroframe_arcee.sender.sender import Sender
+from kiroframe_arcee.sender.coalescer import WriteCoalescer
+from kiroframe_arcee.sender.outbox import (
+    EVENTS, METRICS, PROC_STATS, Outbox)
+from kiroframe_arcee.sender.spool import get_spool
+from kiroframe_arcee.collectors.console import (
+    acquire_console, release_console)
+from kiroframe_arcee.name_generator import NameGenerator
+from kiroframe_arcee.utils import default_loop, flatten_config, run_sync
+from kiroframe_arcee.modules.dataset import Dataset
+from kiroframe_arcee.modules.snapshots import SnapshotStore
+
+
+class Job(threading.Thread):
+    def __init__(self, shutdown_flag, *args, **kwargs):
+        # TODO: typing
+        threading.Thread.__init__(self)
+        self.__shutdown_flag = shutdown_flag
+        self.__kw = kwargs
+
+    def s_noblock(self, sender, run, token, outbox):
+        # stats are sampled now and sent by the outbox, heartbeats queued
+        # while the api is slow are replaced by newer ones
+        data = run_sync(sender.collect_proc_data())
+        return run_sync(outbox.put(
+            PROC_STATS, partial(sender.send_proc_data, run, token, data)))
+
+    def job(self):
+        args = self.__kw.get("meth_args", list())
+        try:
+            self.s_noblock(*args)
+        except Exception:
+            # heartbeat is skipped while the api is unreachable
+            pass
+
+    def run(self):
+        sleep = self.__kw.get("sleep")
+        if not sleep or not isinstance(sleep, int):
+            # 1 second by default
+            sleep = 1
+        while not self.__shutdown_flag.is_set():
+            self.job()
+            time.sleep(sleep)
+
+
+class Run:
+    """
+    Task run with its own state. Runs of the process share the transport,
+    the platform meta and hardware stats. Module functions log to the run
+    active in the current context (thread or asyncio task)
+    """
+
+    def __init__(
+        self, token=None, task_key=None, run_name=None, endpoint_url=None,
+        ssl=True, period=1, spool_dir=None, offline=False
+    ):
+        self.shutdown_flag = threading.Event()
+        self.token = token
+        self.task_key = task_key
+        spool = get_spool(spool_dir) if spool_dir or offline else None
+        self.sender = Sender(endpoint_url, ssl, self.shutdown_flag, spool,
+                             offline)
+        if spool is not None and not offline:
+            spool.start_shipper(default_loop)
+        self.period = period
+        self.hb = None
+        self._run = None
+        self._tags = dict()
+        self._name = run_name
+        self._hyperparams = dict()
+        self._model = None
+        self._model_version = None
+        self._model_version_tags = dict()
+        self._model_version_aliases = list()
+        self._artifacts = dict()
+        self._used_datasets = set()
+        self._context_tokens = list()
+        self.writes = WriteCoalescer()
+        self.outbox = Outbox()
+
+    async def start(self):
+        """
+        Creates the run and starts its heartbeat
+        """
+        acquire_console()
+        if self.name is None:
+            self.name = NameGenerator.get_random_name()
+        self.run = (await self.sender.get_run_id(
+            self.task_key, self.token, self.name))["id"]
+        self.hb = Job(
+            meth_args=(self.sender, self.run, self.token, self.outbox),
+            sleep=self.period,
+            shutdown_flag=self.shutdown_flag,
+        )
+        self.hb.start()
+        atexit.register(self._unhandled_finish)
+        await self.sender.send_stats(
+            self.token,
+            {"project": self.task_key, "run": self.run, "data": {}},
+        )
+        return self
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes the run current in the context, e.g. in worker threads which
+        don't inherit the context of the thread started them
+        """
+        token = _current_run.set(self)
+        try:
+            yield self
+        finally:
+            _current_run.reset(token)
+
+    def _unhandled_finish(self):
+        if not self.shutdown_flag.is_set():
+            warnings.warn(
+                "Run terminated unexpectedly! Please ensure that you use "
+                "`arcee.init()` as a context manager (`with arcee.init():`) "
+                "or explicitly call `arcee.finish()` / `arcee.error()`",
+                UserWarning
+            )
+            run_sync(_finish(self, 2))
+
+    @property
+    def run(self):
+        return self._run
+
+    @run.setter
+    def run(self, value):
+        self._run = value
+
+    @property
+    def tags(self):
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        k, v = value
+        self._tags.update({k: v})
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+
+    @property
+    def hyperparams(self):
+        return self._hyperparams
+
+    @hyperparams.setter
+    def hyperparams(self, value):
+        k, v = value
+        self._hyperparams.update({k: v})
+
+    def __enter__(self):
+        if self.run is None:
+            run_sync(self.start())
+        self._context_tokens.append(_current_run.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            run_sync(_finish(self, 2 if exc_type is None else 3))
+        finally:
+            _current_run.reset(self._context_tokens.pop())
+        return exc_type is None
+
+    async def __aenter__(self):
+        if self.run is None:
+            await self.start()
+        self._context_tokens.append(_current_run.set(self))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await _finish(self, 2 if exc_type is None else 3)
+        finally:
+            _current_run.reset(self._context_tokens.pop())
+        return exc_type is None
+
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, value):
+        self._model = value
+
+    @property
+    def model_version(self):
+        return self._model_version
+
+    @model_version.setter
+    def model_version(self, value):
+        self._model_version = value
+
+    @property
+    def model_version_tags(self):
+        return self._model_version_tags
+
+    @model_version_tags.setter
+    def model_version_tags(self, value):
+        k, v = value
+        self._model_version_tags.update({k: v})
+
+    @property
+    def model_version_aliases(self):
+        return self._model_version_aliases
+
+    @model_version_aliases.setter
+    def model_version_aliases(self, value):
+        aliases = set(self._model_version_aliases)
+        aliases.add(value)
+        self._model_version_aliases = list(aliases)
+
+    @property
+    def artifacts(self):
+        return self._artifacts
+
+    @artifacts.setter
+    def artifacts(self, value):
+        id_, path, tags = value
+        self._artifacts[path] = {
+            'id': id_,
+            'tags': tags
+        }
+
+
+_current_run = contextvars.ContextVar('kiroframe_run', default=None)
+# run of init, current where no run is active in the context
+_default_run = None
+
+
+def current_run() -> Run:
+    """
+    Returns the run active in the current context or the run of init
+    """
+    run = _current_run.get() or _default_run
+    if run is None:
+        raise RuntimeError('No active run. Use init() to start one')
+    return run
+
+
+async def init(
+    token, task_key, run_name=None, endpoint_url=None, ssl=True, period=1,
+    spool_dir=None, offline=False
+):
+    global _default_run
+    run = Run(token, task_key, run_name, endpoint_url, ssl, period,
+              spool_dir, offline)
+    await run.start()
+    _default_run = run
+    return run
+
+
+def _update_hyperparams(arcee, values):
+    arcee._hyperparams.update(values)
+    arcee.writes.update('hyperparameters', partial(
+        arcee.sender.add_hyperparams, arcee.run, arcee.token), values)
+
+
+async def hyperparam(key, value):
+    """
+    Add hyperparameter
+    Args:
+        key: string
+        value: float
+    Returns:
+    """
+    _update_hyperparams(current_run(), {key: value})
+
+
+async def hyperparams(config):
+    """
+    Add hyperparameters
+    Args:
+        config: dict, dataclass or namespace, nested configs are flattened
+            to dot separated keys
+    Returns:
+    """
+    _update_hyperparams(current_run(), flatten_config(config))
+
+
+async def tag(key, value):
+    arcee = current_run()
+    arcee.tags = (key, value)
+    arcee.writes.update('tags', partial(
+        arcee.sender.add_tags, arcee.run, arcee.token), {key: value})
+
+
+async def milestone(value):
+    arcee = current_run()
+    await arcee.outbox.put(EVENTS, partial(
+        arcee.sender.add_milestone, arcee.run, arcee.token, value))
+
+
+async def stage(name):
+    arcee = current_run()
+    await arcee.outbox.put(EVENTS, partial(
+        arcee.sender.create_stage, arcee.run, arcee.token, name))
+
+
+async def log_dataset(dataset: Dataset, comment: str = None,
+                      delta: bool = False):
+    """
+    Log dataset
+    Args:
+        dataset: the dataset to register a new version for
+        comment: the usage comment
+        delta: register the version as changes against the parent version
+            the dataset was loaded from instead of the full file list
+    Returns:
+    """
+    arcee = current_run()
+    if dataset:
+        if dataset._shard:
+            raise TypeError('Dataset shard cannot be logged')
+        await asyncio.to_thread(dataset.wait_ready)
+        body = dataset.delta() if delta else None
+        if body:
+            files = None
+        else:
+            # full file list is streamed without building it in memory,
+            # the stream is rebuilt for retries
+            body, files = dataset._attrs(), dataset._files.iter_json
+        dataset_dict = await arcee.sender.register_dataset(
+            arcee.token, arcee.run, arcee.name, arcee.task_key,
+            body=body, comment=comment, files=files
+        )
+        version = dataset_dict["version"]
+        if files is None:
+            dataset._apply_delta(version["version"], version.get('files'))
+        else:
+            dataset._set_registered(version["version"], version.get('files'))
+        dataset._arcee = arcee
+
+
+async def use_dataset(dataset: str, comment: str = None) -> Dataset:
+    """
+    Use dataset
+    Args:
+        dataset: the dataset indentifier in key:version format
+        comment: the usage comment
+    Returns: Dataset
+    """
+    arcee = current_run()
+    snapshots = SnapshotStore()
+    resolved = snapshots.resolve(dataset)
+    used = (arcee.run, dataset)
+    if resolved and snapshots.is_fresh(resolved):
+        # pinned version or recently checked alias, the usage is recorded
+        # in background once per run and sent before the run finishes
+        if used not in arcee._used_datasets:
+            arcee._used_datasets.add(used)
+            await arcee.outbox.put(EVENTS, partial(
+                arcee.sender.use_dataset, arcee.token, arcee.run, dataset,
+                comment=comment, etag=resolved['etag']))
+        result = await asyncio.to_thread(snapshots.load, resolved)
+        result._arcee = arcee
+        return result
+    try:
+        used_version = await arcee.sender.use_dataset(
+            arcee.token, arcee.run, dataset, comment=comment,
+            etag=resolved and resolved['etag'])
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        if not resolved:
+            raise
+        # offline, use the last resolved version
+        dataset_dict = None
+    else:
+        if used_version is None:
+            # requests are not sent once the run is finished
+            raise RuntimeError(
+                'Run is finished, dataset %s cannot be used' % dataset)
+        dataset_dict, etag = used_version
+        arcee._used_datasets.add(used)
+        if dataset_dict is None:
+            try:
+                snapshots.touch(resolved)
+            except OSError:
+                pass
+    if dataset_dict is None:
+        result = await asyncio.to_thread(snapshots.load, resolved)
+    else:
+        result = Dataset.from_response(dataset_dict)
+        try:
+            await asyncio.to_thread(snapshots.save, dataset, result, etag)
+        except OSError:
+            pass
+    result._arcee = arcee
+    return result
+
+
+async def _send_console(arcee):
+    try:
+        await arcee.sender.send_console(arcee.run, arcee.token)
+    except Exception:
+        pass
+
+
+async def _finish(arcee, state):
+    if arcee.shutdown_flag.is_set():
+        return
+    release_console()
+    await _send_console(arcee)
+    try:
+        try:
+            await arcee.writes.close()
+        except Exception:
+            pass
+        await arcee.outbox.drain()
+        await arcee.sender.change_state(arcee.run, arcee.token, state, True)
+    finally:
+        arcee.shutdown_flag.set()
+        # finished runs of sweeps are not kept alive until the exit
+        atexit.unregister(arcee._unhandled_finish)
+        await asyncio.to_thread(arcee.hb.join)
+        arcee.outbox.close()
+        spool = arcee.sender.spool
+        if spool is not None:
+            await asyncio.to_thread(spool.sync)
+            if not arcee.sender.offline:
+                # records left are shipped on the next start or by replay
+                await spool.drain()
+
+
+async def finish():
+    await _finish(current_run(), 2)
+
+
+async def error():
+    await _finish(current_run(), 3)
+
+
+async def info():
+    arcee = current_run()
+    return arcee.__dict__
+
+
+async def counters():
+    """
+    Returns counters of queued, dropped and sent requests of the run and
+    of writes coalesced into pending requests
+    """
+    arcee = current_run()
+    return dict(arcee.outbox.counters(), coalesced=arcee.writes.coalesced)
+
+
+async def send(data):
+    arcee = current_run()
+    await arcee.outbox.put(METRICS, partial(
+        arcee.sender.send_stats,
+        arcee.token,
+        {"project": arcee.task_key, "run": arcee.run, "data": data},
+    ))
+
+
+async def model(key, path=None):
+    arcee = current_run()
+    arcee.model = await arcee.sender.add_model(arcee.token, key)
+    await arcee.sender.create_model_version(
+        arcee.run, arcee.model, arcee.token, path=path)
+
+
+async def model_version(version):
+    arcee = current_run()
+    await arcee.sender.add_version(
+        arcee.run, arcee.model, arcee.token, version)
+
+
+async def model_version_alias(alias):
+    arcee = current_run()
+    arcee.model_version_aliases = alias
+    await arcee.sender.add_version_aliases(
+        arcee.run, arcee.model, arcee.token, arcee.model_version_aliases)
+
+
+async def model_version_tag(key, value):
+    arcee = current_run()
+    arcee.model_version_tags = (key, value)
+    arcee.writes.update(('model_version_tags', arcee.model), partial(
+        arcee.sender.add_version_tags, arcee.run, arcee.model, arcee.token),
+        {key: value})
+
+
+async def artifact(path, name=None, description=None, tags=None):
+    arcee = current_run()
+    arcee.artifacts = await arcee.sender.add_artifact(
+        arcee.token, arcee.run, arcee.name, arcee.task_key, path, name,
+        description, tags
+    )
+
+
+async def artifact_tag(path, key, value):
+    arcee = current_run()
+    artifact = arcee.artifacts.get(path)
+    if not artifact:
+        raise ValueError("Artifact doesn't exists."
+                         "Use arcee.artifact() to create one")
+    artifact['tags'][key] = value
+    arcee.writes.update(('artifact_tags', path), partial(
+        arcee.sender.update_artifact_tags, arcee.token, artifact['id']),
+        artifact['tags'])
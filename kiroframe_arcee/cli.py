@@ -0,0 +1,40 @@
+import sys
+import asyncio
+import argparse
+
+import aiohttp
+
+from kiroframe_arcee.sender.spool import Spool
+
+
+async def _replay(path, endpoint_url=None):
+    spool = Spool(path)
+    try:
+        async with aiohttp.ClientSession() as session:
+            shipped = await spool.ship(session, endpoint_url)
+        return shipped, spool.pending
+    finally:
+        spool.close()
+
+
+def replay(args):
+    try:
+        shipped, pending = asyncio.run(_replay(args.dir, args.endpoint_url))
+    except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        print('Replay failed: %s' % exc, file=sys.stderr)
+        return 1
+    print('Shipped %s records, %s left' % (shipped, pending))
+    return 0 if not pending else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='kiro')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser(
+        'replay', help='upload runs recorded in the spool directory')
+    replay_parser.add_argument('dir', help='spool directory')
+    replay_parser.add_argument(
+        '--endpoint-url', help='Kiroframe url instead of the recorded one')
+    replay_parser.set_defaults(func=replay)
+    args = parser.parse_args(argv)
+    return args.func(args)
@@ -1,6 +1,7 @@
 import concurrent.futures
 from io import StringIO
 import sys
+import threading
 from typing import Dict
 
 from kiroframe_arcee.utils import run_async
@@ -50,14 +51,27 @@ stdout_writes = WritesCollector(sys.stdout)
 stderr_writes = WritesCollector(sys.stderr)
 
 
+# the console is captured while any run of the process is active
+_console_lock = threading.Lock()
+_console_users = 0
+
+
 def acquire_console():
-    sys.stdout = stdout_writes.proxy
-    sys.stderr = stderr_writes.proxy
+    global _console_users
+    with _console_lock:
+        _console_users += 1
+        sys.stdout = stdout_writes.proxy
+        sys.stderr = stderr_writes.proxy
 
 
 def release_console():
-    sys.stdout = sys.__stdout__
-    sys.stderr = sys.__stderr__
+    global _console_users
+    with _console_lock:
+        _console_users = max(0, _console_users - 1)
+        if _console_users:
+            return
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
 
 
 class Collector:
@@ -1,6 +1,8 @@
 import asyncio
 import math
 import os
+import time
+import threading
 import concurrent.futures
 from functools import reduce
 
@@ -19,6 +21,12 @@ BYTES_IN_KiB = 1024
 
 class Collector:
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+    # the latest heartbeat io stats and their monotonic time
+    io_stats = None
+    io_stats_time = 0.0
+    # stats being collected, shared by heartbeats of all runs
+    _sampling = None
+    _sampling_lock = threading.Lock()
 
     @staticmethod
     def _gpu_stats():
@@ -152,6 +160,33 @@ class Collector:
                 "net_recv": net_recv,
             }
         }
+        cls.io_stats = result["io_stats"]
+        cls.io_stats_time = time.monotonic()
         ps_stats = await run_async(cls._collect_stats, executor=cls.executor)
         result.update(ps_stats)
         return result
+
+    @classmethod
+    async def shared_stats(cls):
+        """
+        Collects stats once for concurrent callers: callers arriving while
+        stats are collected get the same result
+        """
+        with cls._sampling_lock:
+            future = cls._sampling
+            owner = future is None
+            if owner:
+                future = cls._sampling = concurrent.futures.Future()
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await cls.collect_stats()
+            future.set_result(result)
+            return result
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with cls._sampling_lock:
+                cls._sampling = None
+            future.cancel()
@@ -1,40 +1,194 @@
+import io
 import os
+import json
+import mmap
+import time
+import heapq
+import random
 import asyncio
 import threading
-from typing import List, Dict
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List
+from kiroframe_arcee.modules import object_store, profiling
+from kiroframe_arcee.modules import governor as governor_module
+from kiroframe_arcee.modules.governor import Governor
+from kiroframe_arcee.modules.manifest import Manifest, consume
+from kiroframe_arcee.modules.object_store import ObjectStore
+from kiroframe_arcee.modules import providers
 from kiroframe_arcee.modules.providers import local_file, amazon
+from kiroframe_arcee.utils import run_sync
 
 LOCAL_PREFIX = 'file://'
 S3_PREFIX = 's3://'
 BASE_PATH = 'kiroframe/datasets/%s/'
+DIGEST_CACHE_PATH = 'kiroframe/datasets/%s.digests.json'
+SIZE_BALANCED = 'size_balanced'
+ROUND_ROBIN = 'round_robin'
+META_BATCH_SIZE = 1000
+VERIFY_STAT = 'stat'
+VERIFY_FULL = 'full'
 
 
-class DatasetThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.exception = None
+class MetaBackfill(object):
+    """
+    Collects meta of downloaded files registered without it. Meta is
+    extracted in the shared worker pool and sent in batches of batch_size
+    files
+    """
+    executor = ThreadPoolExecutor(max_workers=10)
 
-    def run(self):
+    def __init__(self, dataset, batch_size=None):
+        self._dataset = dataset
+        self._batch_size = batch_size or META_BATCH_SIZE
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, file, download_path):
+        if not self._dataset._arcee or not file.get('_id') or file.get(
+                'meta'):
+            return
+        future = self.executor.submit(
+            local_file.read_file_meta, download_path, file['digest'])
+        with self._lock:
+            self._pending.append((file, future))
+            if len(self._pending) < self._batch_size:
+                return
+            batch, self._pending = self._pending, []
+        self._send(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        paths = dict()
+        files = []
+        for file, future in batch:
+            try:
+                meta = future.result()
+            except Exception:
+                continue
+            if meta:
+                paths[file['_id']] = file['path']
+                files.append({'_id': file['_id'], 'meta': meta})
+        if not files:
+            return
+        arcee = self._dataset._arcee
         try:
-            if self._target:
-                self._target(*self._args, **self._kwargs)
-        except Exception as e:
-            self.exception = e
+            updated = run_sync(
+                arcee.sender.update_files_meta(arcee.token, files))
+            # nothing is returned once the run is finished
+            for file_dict in updated or ():
+                path = paths.get(file_dict.get('_id'))
+                if path in self._dataset._files:
+                    self._dataset._files.set_meta(path, file_dict['meta'])
+        except Exception:
+            # meta is backfilled on a best effort basis, the download
+            # doesn't fail with it
+            return
+
+
+class PrefetchIterator(object):
+    """
+    Yields local paths of dataset files in the given order while the next
+    prefetch files are downloaded in background. wait_time is the total
+    time spent waiting for files that were not downloaded yet
+    """
+
+    def __init__(self, dataset, paths, prefetch, store, transfer):
+        self._dataset = dataset
+        self._paths = iter(paths)
+        self._prefetch = max(1, prefetch)
+        self._store = store
+        self._transfer = transfer
+        self._backfill = MetaBackfill(dataset)
+        self._executor = ThreadPoolExecutor(max_workers=self._prefetch)
+        self._pending = deque()
+        self._in_flight = dict()
+        self._closed = False
+        self.wait_time: float = 0.0
+        self.files: int = 0
+
+    def __iter__(self):
+        return self
+
+    def _submit(self):
+        while len(self._pending) < self._prefetch:
+            path = next(self._paths, None)
+            if path is None:
+                return
+            file = self._dataset._files[path]
+            download_path = self._dataset._download_path(path)
+            digest = file['digest']
+            previous = self._in_flight.get(digest)
+            if previous is not None:
+                # same content is already being downloaded
+                future = self._executor.submit(
+                    self._link, previous, digest, download_path)
+            else:
+                future = self._executor.submit(
+                    self._dataset._download, self._store,
+                    [(file, download_path)], self._backfill,
+                    **self._transfer)
+            self._in_flight[digest] = future
+            self._pending.append((download_path, future))
+
+    def _link(self, previous, digest, download_path):
+        previous.result()
+        self._store.link(digest, download_path)
+
+    def __next__(self):
+        self._submit()
+        if not self._pending:
+            if not self._closed:
+                self.close()
+                print('Iteration completed: %s files, waiting on data '
+                      '%.2fs' % (self.files, self.wait_time))
+            raise StopIteration
+        download_path, future = self._pending.popleft()
+        start = time.monotonic()
+        try:
+            future.result()
+        except BaseException:
+            self.close()
+            raise
+        self.wait_time += time.monotonic() - start
+        self.files += 1
+        self._submit()
+        return download_path
+
+    def close(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+        self._backfill.flush()
+        self._closed = True
 
 
 class Dataset(object):
     __slots__ = ('key', 'name', 'description', 'labels', 'meta',
                  'timespan_from', 'timespan_to', 'aliases',
-                 '_tasks', '_files', '_version', '_arcee')
+                 '_tasks', '_files', '_version', '_arcee', '_parent',
+                 '_changes', '_shard')
 
     def __init__(self, key: str, name: str = None, description: str = None,
                  labels: List[str] = None, meta: Dict = None,
                  timespan_from: int = None, timespan_to: int = None,
                  aliases: List[str] = None):
         self._tasks: List = []
-        self._files: Dict = {}
+        self._files: Manifest = Manifest()
         self._version: int = None
         self._arcee = None
+        # registered version the files were loaded from and the base
+        # digests of the paths changed since then (None for new paths)
+        self._parent: int = None
+        self._changes: Dict = {}
+        # (rank, world_size) of a dataset shard
+        self._shard = None
         self.key: str = key
         self.name: str = name
         self.description: str = description
@@ -52,22 +206,43 @@ class Dataset(object):
         obj = cls(**{
             k: response.get(k) for k in cls.__slots__ if k in response
         })
-        obj._version = version['version']
-        if files:
-            obj.replace_files(files)
+        obj._set_registered(version['version'], files)
+        return obj
+
+    @classmethod
+    def from_snapshot(cls, path):
+        manifest, attrs = Manifest.load(path)
+        version = attrs.pop('version')
+        obj = cls(**attrs)
+        obj._version = obj._parent = version
+        obj._files = manifest
         return obj
 
+    def save_snapshot(self, path):
+        if self._version is None:
+            raise TypeError('Dataset is not logged')
+        self._files.save(path, dict(self._attrs(), version=self._version))
+
+    def _set_registered(self, version, files):
+        self._version = version
+        self._parent = version
+        self._changes = {}
+        # files of the api response aren't used after they are loaded
+        self._files = Manifest.from_files(consume(files or []))
+
     def replace_files(self, files):
-        self._files = {f['path']: {
-            '_id': f['_id'],
+        self._files = Manifest.from_files(files)
+
+    @staticmethod
+    def _file_body(f):
+        return {
             'path': f['path'],
             'size': f['size'],
             'digest': f['digest'],
             'meta': f.get('meta', {}),
-        } for f in files}
+        }
 
-    @property
-    def __dict__(self):
+    def _attrs(self):
         res = dict()
         for k in self.__slots__:
             if k.startswith('_'):
@@ -75,96 +250,417 @@ class Dataset(object):
             value = getattr(self, k)
             if value:
                 res[k] = getattr(self, k)
-        files = []
-        for f in self._files.values():
-            files.append({
-                'path': f['path'],
-                'size': f['size'],
-                'digest': f['digest'],
-                'meta': f.get('meta', {}),
-            })
-        res['files'] = files
         return res
 
+    @property
+    def __dict__(self):
+        res = self._attrs()
+        res['files'] = [self._file_body(f) for f in self._files.values()]
+        return res
+
+    def delta(self):
+        """
+        Returns the dataset changes since the parent version: added and
+        changed files and removed paths. Only the paths touched by
+        add_file/remove_file are compared, so the cost depends on the size
+        of the change. Returns None if the dataset has no parent version
+        """
+        if self._parent is None:
+            return None
+        res = self._attrs()
+        added, changed, removed = [], [], []
+        for path, base_digest in self._changes.items():
+            f = self._files.get(path)
+            if f is None:
+                if base_digest is not None:
+                    removed.append(path)
+            elif base_digest is None:
+                added.append(self._file_body(f))
+            elif f['digest'] != base_digest:
+                changed.append(self._file_body(f))
+        res.update({
+            'parent_version': self._parent,
+            'added': added,
+            'changed': changed,
+            'removed': removed,
+        })
+        return res
+
+    def _apply_delta(self, version, files):
+        # registered delta response contains the added and changed files
+        for f in files or []:
+            if f['path'] in self._files:
+                self._files.set_id(f['path'], f['_id'])
+        self._version = version
+        self._parent = version
+        self._changes = {}
+
+    def _track_change(self, path):
+        if self._parent is None or path in self._changes:
+            return
+        self._changes[path] = self._files.digest(path)
+
     def _get_provider(self, path):
-        if path.startswith(LOCAL_PREFIX):
-            return local_file, path.strip(LOCAL_PREFIX)
-        elif path.startswith(S3_PREFIX):
-            return amazon, path
-        else:
-            raise TypeError('Unhandled path type')
+        return providers.get_provider(path)
 
-    def _add_file(self, path):
-        provider, local_path = self._get_provider(path)
-        digest, size, meta = asyncio.run(provider.get_file_info(local_path))
-        self._files[path] = {
-            'path': path,
-            'size': size,
-            'digest': digest,
-            'meta': meta
-        }
+    def _add_file(self, path, sample_rows=None, previous=None,
+                  full_profile=False):
+        try:
+            provider, local_path = self._get_provider(path)
+            # providers may revalidate the previous digest and return None
+            # if the file is unchanged
+            info = asyncio.run(provider.get_file_info(
+                local_path, sample_rows=sample_rows,
+                full_profile=full_profile,
+                digest=previous['digest'] if previous else None))
+        except BaseException:
+            # the reserved row must not be registered with an empty digest
+            if previous is None:
+                self._files.remove(path)
+            else:
+                self._files.set(path, previous['digest'], previous['size'],
+                                previous['meta'], previous['_id'])
+            raise
+        if info is None:
+            self._files.set(path, previous['digest'], previous['size'],
+                            previous['meta'], previous['_id'])
+            return
+        digest, size, meta = info
+        self._files.set(path, digest, size, meta)
 
-    def add_file(self, path):
+    def add_file(self, path, sample_rows: int = None,
+                 full_profile: bool = False):
         if path in self._files and self._version is None:
             return
+        self._track_change(path)
         self._version = None
-        self._files[path] = None
-        thr = DatasetThread(target=self._add_file, args=(path, ))
-        thr.start()
-        self._tasks.append(thr)
+        previous = self._files.get(path)
+        # reserve the row to keep files in the order they were added
+        self._files.set(path, '', 0)
+        self._tasks.append(governor_module.default_governor.submit(
+            self._add_file, path, sample_rows, previous, full_profile))
 
     def remove_file(self, path):
         if path in self._files:
-            del self._files[path]
+            self._track_change(path)
+            self._files.remove(path)
 
     def wait_ready(self):
         for task in self._tasks:
-            task.join()
-            if task.exception:
-                raise task.exception
+            if task.exception():
+                raise task.exception()
 
-    def download(self, overwrite=True) -> dict:
+    def download(self, overwrite=True, part_size=None, concurrency=None,
+                 store: ObjectStore = None,
+                 governor: Governor = None) -> dict:
         download_map = dict()
+        transfer = self._transfer(part_size, concurrency, governor)
+        store = store or object_store.default_store
         if self._version is None:
             raise TypeError('Dataset is not logged')
         name = f'{self.key}:V{self._version}'
         print('Downloading %s' % name)
+        backfill = MetaBackfill(self)
+        targets = dict()
         for path, file in self._files.items():
-            destination = BASE_PATH % name
-            file_name = path.split('/')[-1]
-            download_path = destination + file_name
+            download_path = self._download_path(path)
             download_map[path] = download_path
             if not overwrite and os.path.isfile(download_path):
                 continue
-            thr = DatasetThread(
-                target=self._download, args=(file, destination, file_name))
-            thr.start()
-            self._tasks.append(thr)
+            targets.setdefault(file['digest'], []).append(
+                (file, download_path))
+        for files in targets.values():
+            self._tasks.append(transfer['governor'].submit(
+                self._download, store, files, backfill, **transfer))
         self.wait_ready()
+        backfill.flush()
+        self._update_digest_cache(
+            file for files in targets.values() for file, _ in files)
+        store.evict(keep=set(self._files.digests()))
         print('Download completed: %s' % name)
         return download_map
 
-    def _download(self, file, destination, file_name):
-        digest = file['digest']
-        path = file['path']
-        provider, local_path = self._get_provider(path)
-        asyncio.run(
-            provider.download(
-                local_path, digest, destination, file_name
-            )
-        )
-        meta = file.get('meta')
-        file_id = file.get('_id')
-        if self._arcee and file_id and not meta:
+    def publish(self, prefix: str, part_size=None, concurrency=None,
+                governor: Governor = None) -> dict:
+        """
+        Uploads local files of the dataset to the s3 prefix keeping their
+        layout relative to the common directory and replaces the file
+        paths with the uploaded ones. Objects with the same content are
+        not uploaded again. Returns the map of replaced paths
+        """
+        if not prefix.startswith(S3_PREFIX):
+            raise ValueError('Publish prefix must be an s3:// path')
+        if not prefix.endswith('/'):
+            prefix += '/'
+        self.wait_ready()
+        local = [(path, file) for path, file in self._files.items()
+                 if path.startswith(LOCAL_PREFIX)]
+        if not local:
+            return {}
+        local_paths = {path: os.path.abspath(path[len(LOCAL_PREFIX):])
+                       for path, _ in local}
+        root = os.path.commonpath(
+            [os.path.dirname(p) for p in local_paths.values()])
+        transfer = self._transfer(part_size, concurrency, governor)
+        etags = dict()
+        tasks = []
+        for path, file in local:
+            dest_path = prefix + os.path.relpath(
+                local_paths[path], root).replace(os.sep, '/')
+
+            def upload(path=path, file=file, dest_path=dest_path):
+                with transfer['governor'].slot():
+                    etags[path] = dest_path, asyncio.run(amazon.upload(
+                        local_paths[path], file['digest'], dest_path,
+                        **transfer))
+            tasks.append(transfer['governor'].submit(upload))
+        wait(tasks)
+        # paths of the uploaded files are replaced even if some failed
+        published = dict()
+        for path, (dest_path, etag) in etags.items():
+            self._track_change(path)
+            self._track_change(dest_path)
+            self._files.rename(path, dest_path, etag)
+            published[path] = dest_path
+        if published:
+            self._version = None
+        for task in tasks:
+            if task.exception():
+                raise task.exception()
+        return published
+
+    def shard(self, rank: int, world_size: int,
+              strategy: str = SIZE_BALANCED) -> 'Dataset':
+        """
+        Returns the part of the dataset assigned to the rank. Assignment is
+        deterministic for the same manifest: size_balanced assigns files by
+        descending size to the least loaded rank (LPT), round_robin assigns
+        files sorted by path in turn
+        """
+        if not 0 <= rank < world_size:
+            raise ValueError(
+                'Rank %s is out of world size %s' % (rank, world_size))
+        files = sorted(self._files.sizes())
+        if strategy == SIZE_BALANCED:
+            files.sort(key=lambda f: f[1], reverse=True)
+            loads = [(0, r) for r in range(world_size)]
+            paths = []
+            for path, size in files:
+                load, r = heapq.heappop(loads)
+                if r == rank:
+                    paths.append(path)
+                heapq.heappush(loads, (load + size, r))
+        elif strategy == ROUND_ROBIN:
+            paths = [path for path, _ in files[rank::world_size]]
+        else:
+            raise ValueError('Unknown shard strategy %s' % strategy)
+        obj = Dataset(**self._attrs())
+        obj._version = self._version
+        obj._parent = self._parent
+        obj._arcee = self._arcee
+        obj._files = self._files.select(paths)
+        obj._shard = (rank, world_size)
+        return obj
+
+    @staticmethod
+    def _transfer(part_size, concurrency, governor):
+        # store objects must stay immutable, so never hardlink the sources
+        return {'part_size': part_size, 'concurrency': concurrency,
+                'hardlink': False,
+                'governor': governor or governor_module.default_governor}
+
+    def _download_path(self, path):
+        name = f'{self.key}:V{self._version}'
+        return BASE_PATH % name + path.split('/')[-1]
+
+    def _digest_cache_path(self):
+        return DIGEST_CACHE_PATH % f'{self.key}:V{self._version}'
+
+    def _load_digest_cache(self) -> Dict[str, list]:
+        try:
+            with open(self._digest_cache_path(), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _update_digest_cache(self, files, cache=None):
+        """
+        Records size, mtime and digest of the verified downloaded files.
+        The cache is shared by shards, so entries are merged
+        """
+        entries = dict()
+        for file in files:
+            download_path = self._download_path(file['path'])
             try:
-                path = destination + file_name
-                meta = asyncio.run(local_file.get_file_meta(path))
-                if meta:
-                    file_dict = asyncio.run(
-                        self._arcee.sender.update_file_meta(
-                            file_id, self._arcee.token, meta=meta
-                        )
+                st = os.stat(download_path)
+            except OSError:
+                continue
+            entries[os.path.basename(download_path)] = [
+                st.st_size, st.st_mtime_ns, file['digest']]
+        if not entries:
+            return
+        cache = self._load_digest_cache() if cache is None else cache
+        cache.update(entries)
+        path = self._digest_cache_path()
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def _check_stat(self, path, file, cache):
+        download_path = self._download_path(path)
+        try:
+            st = os.stat(download_path)
+        except FileNotFoundError:
+            return 'missing', None
+        if st.st_size != file['size']:
+            return 'size', st
+        entry = cache.get(os.path.basename(download_path))
+        if entry and entry != [st.st_size, st.st_mtime_ns, file['digest']]:
+            return 'modified', st
+        return None, st
+
+    def verify(self, mode: str = VERIFY_STAT,
+               workers: int = None) -> Iterator[dict]:
+        """
+        Verifies the downloaded dataset files and yields the mismatches as
+        soon as they are found. stat mode compares sizes and mtimes with
+        the manifest and the digest cache recorded on download, full mode
+        re-hashes the files in parallel and refreshes the digest cache
+        """
+        if self._version is None:
+            raise TypeError('Dataset is not logged')
+        if mode not in (VERIFY_STAT, VERIFY_FULL):
+            raise ValueError('Unknown verify mode %s' % mode)
+        cache = self._load_digest_cache()
+        if mode == VERIFY_STAT:
+            return self._verify_stat(cache)
+        return self._verify_full(cache, workers or os.cpu_count() or 1)
+
+    def _mismatch(self, path, reason):
+        return {'path': path, 'local_path': self._download_path(path),
+                'reason': reason}
+
+    def _verify_stat(self, cache):
+        for path, file in self._files.items():
+            reason, _ = self._check_stat(path, file, cache)
+            if reason:
+                yield self._mismatch(path, reason)
+
+    def _verify_full(self, cache, workers):
+        files = iter(self._files.items())
+        verified = []
+        pending = dict()
+        # hashlib releases the GIL, so threads hash on all cores
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(pending) < workers * 2:
+                    path, file = next(files, (None, None))
+                    if path is None:
+                        break
+                    reason, _ = self._check_stat(path, file, {})
+                    if reason:
+                        yield self._mismatch(path, reason)
+                        continue
+                    provider, _ = self._get_provider(path)
+                    local_digest = getattr(provider, 'local_digest',
+                                           local_file.local_digest)
+                    future = executor.submit(
+                        local_digest, self._download_path(path),
+                        file['digest'])
+                    pending[future] = file
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file = pending.pop(future)
+                    actual = future.result()
+                    if actual is None:
+                        # opaque etag or etag of non-uniform multipart
+                        # upload, the file is verified by stat only
+                        continue
+                    if actual != file['digest']:
+                        yield self._mismatch(file['path'], 'digest')
+                    else:
+                        verified.append(file)
+        self._update_digest_cache(verified, cache)
+
+    def profile(self) -> dict:
+        """
+        Aggregates meta of the files into the dataset profile: row and file
+        counts, hive partition values and column stats. Footers of local
+        parquet files logged without column stats are read concurrently
+        """
+        missing = dict()
+        for path, file in self._files.items():
+            if 'columns' in file['meta'] or not path.startswith(LOCAL_PREFIX):
+                continue
+            if path.lower().endswith('.parquet'):
+                missing[path[len(LOCAL_PREFIX):]] = path
+        read = {missing[local_path]: meta for local_path, meta in
+                profiling.profile_parquet_files(missing).items()}
+
+        def metas():
+            for path, file in self._files.items():
+                meta = read.get(path, file['meta'])
+                partitions = profiling.hive_partitions(path)
+                yield dict(meta, partitions=partitions) if partitions else meta
+        return profiling.merge_profiles(metas())
+
+    def iter_files(self, prefetch=4, shuffle=False, seed=None,
+                   part_size=None, concurrency=None,
+                   store: ObjectStore = None,
+                   governor: Governor = None) -> PrefetchIterator:
+        """
+        Iterates over local paths of the dataset files, downloading the next
+        prefetch files in background. Files are yielded in the manifest
+        order or shuffled with the seed
+        """
+        if self._version is None:
+            raise TypeError('Dataset is not logged')
+        paths = list(self._files)
+        if shuffle:
+            random.Random(seed).shuffle(paths)
+        transfer = self._transfer(part_size, concurrency, governor)
+        return PrefetchIterator(
+            self, paths, prefetch, store or object_store.default_store,
+            transfer)
+
+    def open(self, path, store: ObjectStore = None, readahead=None):
+        """
+        Opens the dataset file for reading without downloading the dataset.
+        Files present in the object store are returned as read-only mmap,
+        other files are read lazily from the source (with ranged requests
+        for s3) and verified against the digest once read to the end
+        """
+        file = self._files[path]
+        store = store or object_store.default_store
+        cached = store.get(file['digest'], file['size'])
+        if cached:
+            if not file['size']:
+                return io.BytesIO()
+            with open(cached, 'rb') as f:
+                return mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ)
+        provider, local_path = self._get_provider(path)
+        return provider.open_file(
+            local_path, file['digest'], file['size'], readahead=readahead)
+
+    def _download(self, store, files, backfill, **transfer):
+        file = files[0][0]
+        digest = file['digest']
+        if not store.get(digest, file.get('size')):
+            provider, local_path = self._get_provider(file['path'])
+            with transfer['governor'].slot():
+                asyncio.run(
+                    provider.download(
+                        local_path, digest, store.object_dir(digest),
+                        store.object_name(digest), **transfer
                     )
-                    file['meta'] = file_dict['meta']
-            except Exception:
-                pass
+                )
+        for file, path in files:
+            store.link(digest, path)
+            # rows with the same content have own ids
+            backfill.add(file, path)
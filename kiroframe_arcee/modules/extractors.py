@@ -0,0 +1,227 @@
+import os
+import ast
+import json
+import mmap
+import struct
+import zipfile
+from collections import namedtuple
+from typing import Callable, Dict
+
+import pyarrow as pa
+
+from kiroframe_arcee.modules import profiling
+from kiroframe_arcee.modules.profiling import MetaCache
+
+# rows read to infer jsonl schema
+JSONL_SAMPLE_ROWS: int = 1_000
+# tensors listed in safetensors meta, larger files get totals only
+MAX_TENSORS: int = 1_000
+_NPY_MAGIC = b'\x93NUMPY'
+
+Extractor = namedtuple('Extractor', ('func', 'cached', 'sample_rows'))
+_extractors: Dict[str, Extractor] = dict()
+
+
+def register_extractor(*suffixes: str, cached: bool = False,
+                       sample_rows: int = None):
+    """
+    Registers the decorated function as the meta extractor of files with
+    the suffixes. The function gets the path and sample_rows and returns
+    the meta dict. Results of cached extractors are cached by digest.
+    sample_rows is the default sample of the extractor, files are read in
+    full only if requested
+    """
+    def decorator(func: Callable):
+        for suffix in suffixes:
+            _extractors[suffix.lower()] = Extractor(
+                func, cached, sample_rows)
+        return func
+    return decorator
+
+
+def extract_meta(path, digest: str = None, sample_rows: int = None,
+                 cache: MetaCache = None, full_profile: bool = False) -> dict:
+    """
+    Extracts the file meta with the extractor registered for its suffix
+    and adds values of hive-style partitions of the path
+    """
+    suffix = os.path.splitext(os.fspath(path))[1].lower()
+    extractor = _extractors.get(suffix)
+    if extractor is None:
+        raise ValueError(f"Unsupported file format: {suffix}")
+    if sample_rows is None and not full_profile:
+        sample_rows = extractor.sample_rows
+    meta = None
+    if extractor.cached and digest:
+        cache = cache or profiling.default_cache
+        variant = None if sample_rows is None else 'sample%s' % sample_rows
+        meta = cache.get(digest, variant)
+    if meta is None:
+        meta = extractor.func(path, sample_rows=sample_rows)
+        if extractor.cached and digest:
+            cache.set(digest, meta, variant)
+    partitions = profiling.hive_partitions(path)
+    if partitions:
+        meta['partitions'] = partitions
+    return meta
+
+
+@register_extractor('.csv', cached=True,
+                    sample_rows=profiling.CSV_SAMPLE_ROWS)
+def _csv(path, sample_rows=None):
+    return profiling.profile_csv(path, sample_rows)
+
+
+@register_extractor('.parquet')
+def _parquet(path, **kwargs):
+    return profiling.profile_parquet(path)
+
+
+@register_extractor('.arrow', '.feather', '.ipc')
+def _arrow(path, **kwargs):
+    # the footer lists record batches, their headers are read from the
+    # memory map without touching the buffers
+    with pa.memory_map(os.fspath(path), 'r') as source:
+        reader = pa.ipc.open_file(source)
+        rows = sum(reader.get_batch(i).num_rows
+                   for i in range(reader.num_record_batches))
+        schema = reader.schema
+    return {
+        'format': 'arrow',
+        'headers': schema.names,
+        'rows': rows,
+        'record_batches': reader.num_record_batches,
+        'schema': {f.name: str(f.type) for f in schema},
+    }
+
+
+@register_extractor('.orc')
+def _orc(path, **kwargs):
+    from pyarrow import orc
+
+    # the file tail (postscript, footer and metadata) only is read
+    orc_file = orc.ORCFile(os.fspath(path))
+    return {
+        'format': 'orc',
+        'headers': orc_file.schema.names,
+        'rows': orc_file.nrows,
+        'stripes': orc_file.nstripes,
+        'compression': orc_file.compression,
+        'schema': {f.name: str(f.type) for f in orc_file.schema},
+    }
+
+
+def _npy_header(read) -> dict:
+    """
+    Parses npy header, read is a function returning next n bytes
+    """
+    magic = read(len(_NPY_MAGIC) + 2)
+    if magic[:len(_NPY_MAGIC)] != _NPY_MAGIC:
+        raise ValueError('Invalid npy file')
+    major = magic[-2]
+    length_format = '<H' if major == 1 else '<I'
+    (length, ) = struct.unpack(
+        length_format, read(struct.calcsize(length_format)))
+    encoding = 'latin1' if major < 3 else 'utf8'
+    header = ast.literal_eval(read(length).decode(encoding))
+    return {
+        'dtype': str(header['descr']),
+        'shape': list(header['shape']),
+        'fortran_order': header['fortran_order'],
+    }
+
+
+@register_extractor('.npy')
+def _npy(path, **kwargs):
+    with open(path, 'rb') as f, mmap.mmap(
+            f.fileno(), length=0, access=mmap.ACCESS_READ) as view:
+        position = [0]
+
+        def read(n):
+            data = view[position[0]:position[0] + n]
+            position[0] += n
+            return data
+        meta = _npy_header(read)
+    meta['format'] = 'npy'
+    return meta
+
+
+@register_extractor('.npz')
+def _npz(path, **kwargs):
+    arrays = dict()
+    # zipfile reads the central directory, members are opened for headers
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            if not name.endswith('.npy'):
+                continue
+            with archive.open(info) as member:
+                arrays[name[:-len('.npy')]] = _npy_header(member.read)
+    return {'format': 'npz', 'headers': list(arrays), 'arrays': arrays}
+
+
+@register_extractor('.safetensors')
+def _safetensors(path, **kwargs):
+    with open(path, 'rb') as f:
+        (length, ) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length))
+    metadata = header.pop('__metadata__', None) or {}
+    parameters = 0
+    dtypes = set()
+    for tensor in header.values():
+        count = 1
+        for dim in tensor['shape']:
+            count *= dim
+        parameters += count
+        dtypes.add(tensor['dtype'])
+    meta = {
+        'format': 'safetensors',
+        'tensor_count': len(header),
+        'parameters': parameters,
+        'dtypes': sorted(dtypes),
+        'metadata': metadata,
+    }
+    if len(header) <= MAX_TENSORS:
+        meta['tensors'] = {
+            name: {'dtype': t['dtype'], 'shape': t['shape']}
+            for name, t in header.items()}
+    return meta
+
+
+def _json_type(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    return 'object'
+
+
+@register_extractor('.jsonl', '.ndjson')
+def _jsonl(path, sample_rows=None, **kwargs):
+    sample_rows = sample_rows or JSONL_SAMPLE_ROWS
+    schema = dict()
+    rows = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if rows >= sample_rows:
+                break
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            rows += 1
+            for key, value in record.items():
+                schema.setdefault(key, set()).add(_json_type(value))
+    return {
+        'format': 'jsonl',
+        'headers': list(schema),
+        'schema': {key: sorted(types) for key, types in schema.items()},
+        'sample_rows': rows,
+    }
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from kiroframe_arcee.collectors.hardware import (
+    BYTES_IN_KiB, Collector as HardwareCollector)
+
+_MB: int = 1_024 * 1_024
+# adaptive mode halves the rate while other io exceeds the threshold and
+# grows it back by the step on every calm heartbeat
+MIN_RATE: int = 1 * _MB
+RATE_STEP: float = 0.1
+# dataset files are processed by the pool of max_files or MAX_WORKERS
+# threads of the governor
+MAX_WORKERS: int = 32
+
+
+class Governor(object):
+    """
+    Limits dataset transfers of all providers: the number of files
+    transferred at once and the transfer rate in bytes per second (token
+    bucket). In adaptive mode the rate backs off while heartbeat io stats
+    show more than io_threshold bytes per second of io besides transfers
+    """
+
+    def __init__(self, rate: int = None, max_files: int = None,
+                 adaptive: bool = False, io_threshold: int = None):
+        self._lock = threading.Lock()
+        self._executor = None
+        self.configure(rate, max_files, adaptive, io_threshold)
+
+    def configure(self, rate: int = None, max_files: int = None,
+                  adaptive: bool = False, io_threshold: int = None):
+        if adaptive and not (rate and io_threshold):
+            raise ValueError(
+                'Adaptive mode requires rate and io_threshold')
+        with self._lock:
+            self.rate = rate
+            self.max_files = max_files
+            self.adaptive = adaptive
+            self.io_threshold = io_threshold
+            self._current_rate = rate
+            self._tokens = float(rate or 0)
+            self._updated = time.monotonic()
+            self._observed = HardwareCollector.io_stats_time
+            self._transferred = 0
+            self._files = (threading.BoundedSemaphore(max_files)
+                           if max_files else None)
+            # work already submitted is completed by the previous pool
+            executor, self._executor = self._executor, ThreadPoolExecutor(
+                max_workers=max_files or MAX_WORKERS,
+                thread_name_prefix='kiro-dataset')
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    @property
+    def current_rate(self):
+        return self._current_rate
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        Runs fn in the bounded pool of the governor
+        """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds one of max_files transfer slots
+        """
+        files = self._files
+        if files is None:
+            yield
+            return
+        with files:
+            yield
+
+    def _adapt(self):
+        if not self.adaptive:
+            return
+        stats_time = HardwareCollector.io_stats_time
+        if stats_time <= self._observed:
+            return
+        elapsed = stats_time - self._observed
+        own = self._transferred / elapsed if self._observed else 0
+        self._observed = stats_time
+        self._transferred = 0
+        stats = HardwareCollector.io_stats or {}
+        total = sum(stats.values()) * BYTES_IN_KiB
+        # transferred bytes are received and then written to disk
+        other = max(0, total - 2 * own)
+        if other > self.io_threshold:
+            self._current_rate = max(MIN_RATE, self._current_rate // 2)
+        else:
+            self._current_rate = min(
+                self.rate, int(self._current_rate + self.rate * RATE_STEP))
+
+    def _reserve(self, nbytes) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._transferred += nbytes
+            self._adapt()
+            rate = self._current_rate
+            if not rate:
+                return 0
+            self._tokens = min(
+                float(rate), self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= nbytes
+            return max(0.0, -self._tokens / rate)
+
+    def consume(self, nbytes: int):
+        delay = self._reserve(nbytes)
+        if delay:
+            time.sleep(delay)
+
+    async def aconsume(self, nbytes: int):
+        delay = self._reserve(nbytes)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+default_governor = Governor()
+
+
+def set_transfer_limits(rate: int = None, max_files: int = None,
+                        adaptive: bool = False, io_threshold: int = None):
+    """
+    Configures the limits shared by dataset transfers without own governor
+    Args:
+        rate: max transfer rate in bytes per second
+        max_files: max number of files transferred at once
+        adaptive: back off while other io exceeds io_threshold
+        io_threshold: io rate besides transfers in bytes per second
+    Returns:
+    """
+    default_governor.configure(rate, max_files, adaptive, io_threshold)
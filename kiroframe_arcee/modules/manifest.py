@@ -0,0 +1,327 @@
+import os
+import re
+import json
+import threading
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+
+from kiroframe_arcee.sender.encoding import dumps
+
+_MD5_DIGEST = re.compile(r'^[0-9a-f]{32}(-[0-9]+)?$')
+_DIGEST_SIZE = 16
+_EMPTY_DIGEST = bytes(_DIGEST_SIZE)
+CHUNK_ROWS = 10_000
+
+
+def consume(files: List) -> Iterator:
+    """
+    Yields items of the list releasing them from it to keep the memory
+    peak of loading large api responses low. The list is left empty
+    """
+    for i in range(len(files)):
+        item, files[i] = files[i], None
+        yield item
+    files.clear()
+
+
+class Manifest(object):
+    """
+    Compact columnar storage of dataset files. Paths are kept once in the
+    path table, md5 digests (and s3 multipart etags) as fixed-width bytes,
+    sizes in an int64 column. File ids and non-empty meta are kept aside.
+    Removed rows are compacted lazily
+    """
+    __slots__ = ('_path_list', '_path_index', '_digests', '_parts', '_sizes',
+                 '_id_list', '_meta', '_other_digests', '_removed', '_lock',
+                 '_arrow')
+
+    def __init__(self):
+        self._path_list: Optional[List[Optional[str]]] = []
+        self._path_index: Optional[Dict[str, int]] = {}
+        self._digests = bytearray()
+        self._parts = array('I')
+        self._sizes = array('q')
+        self._id_list: Optional[List[Optional[str]]] = []
+        self._meta: Dict[int, dict] = {}
+        self._other_digests: Dict[int, str] = {}
+        self._removed: int = 0
+        self._lock = threading.Lock()
+        # string columns of the snapshot the manifest was loaded from
+        self._arrow: Optional[pa.Table] = None
+
+    @classmethod
+    def from_files(cls, files: Iterable[dict]) -> 'Manifest':
+        """
+        Loads files of api response. Pass consume(files) to release items
+        of a list no longer needed while it's loaded
+        """
+        manifest = cls()
+        for f in files:
+            manifest.set(f['path'], f['digest'], f['size'], f.get('meta'),
+                         f.get('_id'))
+        return manifest
+
+    # python objects of manifests loaded from snapshots are built on the
+    # first access
+    @property
+    def _paths(self) -> List[Optional[str]]:
+        if self._path_list is None:
+            self._path_list = self._arrow.column('path').to_pylist()
+        return self._path_list
+
+    @property
+    def _ids(self) -> List[Optional[str]]:
+        if self._id_list is None:
+            column = self._arrow.column('id')
+            if column.null_count == len(column):
+                self._id_list = [None] * len(column)
+            else:
+                self._id_list = column.to_pylist()
+        return self._id_list
+
+    @property
+    def _index(self) -> Dict[str, int]:
+        if self._path_index is None:
+            self._path_index = {
+                p: row for row, p in enumerate(self._paths) if p is not None}
+        return self._path_index
+
+    def __len__(self):
+        return len(self._sizes) - self._removed
+
+    def __contains__(self, path):
+        return path in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return (p for p in self._paths if p is not None)
+
+    def __getitem__(self, path) -> dict:
+        return self._row(self._index[path])
+
+    def get(self, path, default=None) -> Optional[dict]:
+        row = self._index.get(path)
+        return default if row is None else self._row(row)
+
+    def _rows(self) -> Iterator[int]:
+        if not self._removed:
+            return iter(range(len(self._sizes)))
+        return (row for row, p in enumerate(self._paths) if p is not None)
+
+    def items(self):
+        for row in self._rows():
+            yield self._paths[row], self._row(row)
+
+    def values(self):
+        for _, f in self.items():
+            yield f
+
+    def digests(self) -> Iterator[str]:
+        for row in self._rows():
+            yield self._digest(row)
+
+    def sizes(self) -> Iterator[Tuple[str, int]]:
+        for row in self._rows():
+            yield self._paths[row], self._sizes[row]
+
+    def select(self, paths) -> 'Manifest':
+        manifest = Manifest()
+        for path in paths:
+            row = self._index[path]
+            manifest.set(path, self._digest(row), self._sizes[row],
+                         self._meta.get(row), self._ids[row])
+        return manifest
+
+    def digest(self, path) -> Optional[str]:
+        row = self._index.get(path)
+        return None if row is None else self._digest(row)
+
+    def size(self, path) -> Optional[int]:
+        row = self._index.get(path)
+        return None if row is None else self._sizes[row]
+
+    def _digest(self, row) -> str:
+        other = self._other_digests.get(row)
+        if other is not None:
+            return other
+        offset = row * _DIGEST_SIZE
+        digest = self._digests[offset:offset + _DIGEST_SIZE].hex()
+        parts = self._parts[row]
+        return '%s-%s' % (digest, parts) if parts else digest
+
+    def _row(self, row) -> dict:
+        return {
+            '_id': self._ids[row],
+            'path': self._paths[row],
+            'size': self._sizes[row],
+            'digest': self._digest(row),
+            'meta': self._meta.get(row, {}),
+        }
+
+    def set(self, path: str, digest: str, size: int, meta: dict = None,
+            id_: str = None):
+        packed, parts = _EMPTY_DIGEST, 0
+        match = _MD5_DIGEST.match(digest)
+        if match:
+            packed = bytes.fromhex(digest[:32])
+            parts = int(match.group(1)[1:]) if match.group(1) else 0
+        with self._lock:
+            row = self._index.get(path)
+            if row is None:
+                row = len(self._paths)
+                self._index[path] = row
+                self._paths.append(path)
+                self._digests += packed
+                self._parts.append(parts)
+                self._sizes.append(size)
+                self._ids.append(id_)
+            else:
+                offset = row * _DIGEST_SIZE
+                self._digests[offset:offset + _DIGEST_SIZE] = packed
+                self._parts[row] = parts
+                self._sizes[row] = size
+                self._ids[row] = id_
+            if match:
+                self._other_digests.pop(row, None)
+            else:
+                self._other_digests[row] = digest
+            self._set_meta(row, meta)
+
+    def _set_meta(self, row, meta):
+        if meta:
+            self._meta[row] = meta
+        else:
+            self._meta.pop(row, None)
+
+    def set_id(self, path, id_):
+        self._ids[self._index[path]] = id_
+
+    def set_meta(self, path, meta):
+        with self._lock:
+            self._set_meta(self._index[path], meta)
+
+    def rename(self, path, new_path, digest):
+        """
+        Moves the file to the new path keeping its position and meta. The
+        file id is reset as the new path is a new file for the platform
+        """
+        with self._lock:
+            if new_path in self._index:
+                raise ValueError('File %s already exists' % new_path)
+            row = self._index.pop(path)
+            self._paths[row] = new_path
+            self._index[new_path] = row
+        self.set(new_path, digest, self._sizes[row], self._meta.get(row))
+
+    def remove(self, path):
+        with self._lock:
+            row = self._index.pop(path, None)
+            if row is None:
+                return
+            self._paths[row] = None
+            self._ids[row] = None
+            self._meta.pop(row, None)
+            self._other_digests.pop(row, None)
+            self._removed += 1
+            if self._removed > len(self):
+                self._compact()
+
+    def _compact(self):
+        manifest = Manifest()
+        for row in self._rows():
+            manifest.set(self._paths[row], self._digest(row),
+                         self._sizes[row], self._meta.get(row),
+                         self._ids[row])
+        for slot in self.__slots__:
+            if slot != '_lock':
+                setattr(self, slot, getattr(manifest, slot))
+        self._arrow = None
+
+    def iter_json(self, chunk_rows: int = CHUNK_ROWS) -> Iterator[bytes]:
+        """
+        Yields the files serialised for registration with the request
+        serializer as comma separated JSON objects, chunk_rows files per
+        chunk
+        """
+        chunk = []
+        for row in self._rows():
+            chunk.append(dumps({
+                'path': self._paths[row],
+                'size': self._sizes[row],
+                'digest': self._digest(row),
+                'meta': self._meta.get(row, {}),
+            }))
+            if len(chunk) >= chunk_rows:
+                yield b','.join(chunk)
+                chunk = []
+        if chunk:
+            yield b','.join(chunk)
+
+    def save(self, path: str, metadata: dict = None):
+        """
+        Writes the manifest as an Arrow IPC file, metadata is kept in the
+        schema metadata as JSON
+        """
+        rows = list(self._rows()) if self._removed else None
+
+        def take(column):
+            return column if rows is None else [column[r] for r in rows]
+
+        other_digests = [self._other_digests.get(r) for r in self._rows()]
+        digests = pa.py_buffer(bytes(self._digests))
+        if rows is not None:
+            digests = pa.py_buffer(b''.join(
+                self._digests[r * _DIGEST_SIZE:(r + 1) * _DIGEST_SIZE]
+                for r in rows))
+        meta = [json.dumps(self._meta[r]) if r in self._meta else None
+                for r in self._rows()]
+        table = pa.table({
+            'path': pa.array(take(self._paths), pa.string()),
+            'digest': pa.Array.from_buffers(
+                pa.binary(_DIGEST_SIZE), len(self), [None, digests]),
+            'parts': pa.array(take(self._parts), pa.uint32()),
+            'size': pa.array(take(self._sizes), pa.int64()),
+            'id': pa.array(take(self._ids), pa.string()),
+            'meta': pa.array(meta, pa.string()),
+            'other_digest': pa.array(other_digests, pa.string()),
+        }).replace_schema_metadata(
+            {'metadata': json.dumps(metadata or {})})
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Tuple['Manifest', dict]:
+        """
+        Memory maps an Arrow IPC manifest file. Fixed-width columns are
+        copied as a whole, paths, ids and the path index are built lazily
+        """
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        manifest = cls()
+        manifest._arrow = table.select(['path', 'id'])
+        manifest._path_list = manifest._path_index = manifest._id_list = None
+        for name, column in (('parts', manifest._parts),
+                             ('size', manifest._sizes)):
+            for chunk in table.column(name).chunks:
+                column.frombytes(
+                    chunk.buffers()[1][chunk.offset * column.itemsize:]
+                    [:len(chunk) * column.itemsize])
+        for chunk in table.column('digest').chunks:
+            manifest._digests += chunk.buffers()[1][
+                chunk.offset * _DIGEST_SIZE:
+                (chunk.offset + len(chunk)) * _DIGEST_SIZE]
+        for name, target, load in (
+                ('meta', manifest._meta, json.loads),
+                ('other_digest', manifest._other_digests, str)):
+            column = table.column(name)
+            if column.null_count == len(column):
+                continue
+            for row, value in enumerate(column.to_pylist()):
+                if value is not None:
+                    target[row] = load(value)
+        metadata = json.loads(table.schema.metadata[b'metadata'])
+        return manifest, metadata
@@ -0,0 +1,211 @@
+import os
+import stat
+import time
+import re
+import threading
+from typing import Iterable, Optional
+
+STORE_PATH = 'kiroframe/objects/'
+_UNSAFE_CHARS = re.compile(r'[^0-9A-Za-z_-]')
+# version entries linked or cloned from the object with their device and
+# inode, removed together with it
+_LINKS_SUFFIX = '.links'
+_READ_ONLY = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+class ObjectStore(object):
+    """
+    Local digest-keyed storage of dataset files shared between datasets
+    and their versions. Version directories are built as links to the
+    stored objects, so a file is downloaded only once per content.
+    Objects are evicted in LRU order when the store exceeds size_limit,
+    version entries linked to evicted objects are removed with them
+    """
+
+    def __init__(self, path: str = STORE_PATH, size_limit: int = None,
+                 symlink: bool = False):
+        self.path: str = path
+        self.size_limit: Optional[int] = size_limit
+        self.symlink: bool = symlink
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def object_name(digest: str) -> str:
+        return _UNSAFE_CHARS.sub('_', digest)
+
+    def object_dir(self, digest: str) -> str:
+        return os.path.join(self.path, self.object_name(digest)[:2]) + '/'
+
+    def object_path(self, digest: str) -> str:
+        return self.object_dir(digest) + self.object_name(digest)
+
+    def get(self, digest: str, size: int = None) -> Optional[str]:
+        """
+        Returns the stored object path and marks it as recently used
+        """
+        path = self.object_path(digest)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if size is not None and st.st_size != size:
+            return None
+        self._touch(path)
+        return path
+
+    @staticmethod
+    def _touch(path):
+        # objects are immutable, so the use time is kept in atime and
+        # mtime stays the time the object was stored
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except OSError:
+            pass
+
+    def link(self, digest: str, destination: str):
+        """
+        Places the stored object to the destination path. The object is
+        cloned (reflink) if the filesystem supports it, otherwise linked.
+        Linked objects are read-only, so in-place edits of version files
+        can't change the shared object
+        """
+        from kiroframe_arcee.modules.providers.local_file import _reflink
+        source = self.object_path(digest)
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+        tmp_path = destination + '.link'
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        if not self.symlink:
+            with open(source, 'rb') as src:
+                cloned = _reflink(src, tmp_path)
+            if cloned:
+                os.replace(tmp_path, destination)
+                # clones share the extents, they are evicted with the object
+                self._register(source, destination)
+                self._touch(source)
+                return
+        os.chmod(source, stat.S_IMODE(os.stat(source).st_mode) & _READ_ONLY)
+        linked = False
+        if not self.symlink:
+            try:
+                os.link(source, tmp_path)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            os.symlink(os.path.abspath(source), tmp_path)
+        os.replace(tmp_path, destination)
+        self._register(source, destination)
+        self._touch(source)
+
+    @staticmethod
+    def _read_links(path) -> dict:
+        """
+        Returns (device, inode) of the version entries of the object
+        """
+        links = dict()
+        try:
+            with open(path + _LINKS_SUFFIX) as f:
+                for line in f:
+                    dev, ino, link = line.rstrip('\n').split(' ', 2)
+                    links[link] = (int(dev), int(ino))
+        except (OSError, ValueError):
+            pass
+        return links
+
+    @staticmethod
+    def _is_linked(path, key) -> bool:
+        # the entry wasn't replaced with another file since it was linked
+        try:
+            target = os.stat(path)
+        except OSError:
+            return False
+        return (target.st_dev, target.st_ino) == key
+
+    def _register(self, source, destination):
+        """
+        Records the version entry of the object. Entries replaced since
+        they were recorded are dropped, so the list doesn't grow with
+        repeated downloads
+        """
+        st = os.stat(destination)
+        with self._lock:
+            links = self._read_links(source)
+            links[os.path.abspath(destination)] = (st.st_dev, st.st_ino)
+            tmp_path = source + _LINKS_SUFFIX + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for link, key in links.items():
+                    if self._is_linked(link, key):
+                        f.write('%s %s %s\n' % (key[0], key[1], link))
+            os.replace(tmp_path, source + _LINKS_SUFFIX)
+
+    def _unlink_versions(self, path, st) -> bool:
+        """
+        Removes version entries linked or cloned from the object. Returns
+        False if the object has other hardlinks, so removing it frees no
+        space
+        """
+        links = self._read_links(path)
+        linked = [link for link, key in links.items()
+                  if self._is_linked(link, key)]
+        # clones have own inodes and don't hold the object inode
+        hardlinks = sum(1 for link in linked if not os.path.islink(link)
+                        if links[link] == (st.st_dev, st.st_ino))
+        if st.st_nlink - hardlinks > 1:
+            return False
+        for link in linked:
+            try:
+                os.remove(link)
+            except OSError:
+                return False
+        try:
+            os.remove(path + _LINKS_SUFFIX)
+        except OSError:
+            pass
+        return True
+
+    def _objects(self):
+        try:
+            dirs = list(os.scandir(self.path))
+        except OSError:
+            return
+        for d in dirs:
+            if not d.is_dir():
+                continue
+            for entry in os.scandir(d.path):
+                # skip partial downloads and their state files
+                if '.' not in entry.name and entry.is_file():
+                    yield entry
+
+    def size(self) -> int:
+        return sum(e.stat().st_size for e in self._objects())
+
+    def evict(self, keep: Iterable[str] = ()) -> int:
+        """
+        Removes least recently used objects until the store fits
+        size_limit. Objects of the keep digests are never removed.
+        Returns the number of freed bytes
+        """
+        if self.size_limit is None:
+            return 0
+        keep = {self.object_name(d) for d in keep}
+        with self._lock:
+            entries = [(e.stat(), e) for e in self._objects()]
+            total = sum(st.st_size for st, _ in entries)
+            freed = 0
+            for st, entry in sorted(entries, key=lambda x: x[0].st_atime):
+                if total - freed <= self.size_limit:
+                    break
+                if entry.name in keep:
+                    continue
+                if not self._unlink_versions(entry.path, st):
+                    continue
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                freed += st.st_size
+        return freed
+
+
+default_store = ObjectStore()
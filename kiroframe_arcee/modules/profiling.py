@@ -0,0 +1,328 @@
+import os
+import re
+import json
+import decimal
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyarrow import csv
+
+from kiroframe_arcee.modules.object_store import ObjectStore
+
+META_CACHE_PATH = 'kiroframe/meta/'
+_KB: int = 1_024
+_MB: int = 1_024 * _KB
+# schema is inferred from the first block, the rest is converted to it
+CSV_BLOCK_SIZE: int = 4 * _MB
+# rows of csv files profiled unless the full profile is requested
+CSV_SAMPLE_ROWS: int = 100_000
+_CSV_COLUMN_ERROR = re.compile(r'In CSV column #(\d+)')
+FOOTER_WORKERS: int = 32
+
+
+class MetaCache(object):
+    """
+    On-disk cache of extracted file meta keyed by file digest
+    """
+
+    def __init__(self, path: str = META_CACHE_PATH):
+        self.path: str = path
+
+    def _path(self, digest, variant=None):
+        name = ObjectStore.object_name(digest)
+        if variant:
+            name += '.%s' % variant
+        return os.path.join(self.path, name + '.json')
+
+    def get(self, digest: str, variant: str = None) -> Optional[dict]:
+        try:
+            with open(self._path(digest, variant)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, digest: str, meta: dict, variant: str = None):
+        path = self._path(digest, variant)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is an optimisation only
+            pass
+
+
+default_cache = MetaCache()
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, bytes):
+        return None
+    return value
+
+
+_ORDERABLE = (pa.types.is_integer, pa.types.is_floating,
+              pa.types.is_decimal, pa.types.is_temporal, pa.types.is_string,
+              pa.types.is_large_string, pa.types.is_boolean)
+
+
+def _orderable(type_):
+    return any(is_type(type_) for is_type in _ORDERABLE)
+
+
+class ColumnStats(object):
+    """
+    Null count and min/max of a column aggregated over batches
+    """
+    __slots__ = ('nulls', 'min', 'max')
+
+    def __init__(self):
+        self.nulls: int = 0
+        self.min = None
+        self.max = None
+
+    def update(self, column: pa.Array):
+        self.nulls += column.null_count
+        if column.null_count == len(column) or not _orderable(column.type):
+            return
+        min_max = pc.min_max(column)
+        self.update_range(min_max['min'].as_py(), min_max['max'].as_py())
+
+    def update_range(self, low, high):
+        try:
+            if low is not None and (self.min is None or low < self.min):
+                self.min = low
+            if high is not None and (self.max is None or high > self.max):
+                self.max = high
+        except TypeError:
+            # incomparable values of different files
+            pass
+
+    def to_dict(self) -> dict:
+        return {'nulls': self.nulls, 'min': _json_value(self.min),
+                'max': _json_value(self.max)}
+
+
+class ParquetColumnStats(ColumnStats):
+    """
+    Column stats aggregated over row group footers. Null counts and min/max
+    are None if any row group was written without them
+    """
+    __slots__ = ('range_known', 'compressed_size', 'uncompressed_size',
+                 'encodings', 'compression')
+
+    def __init__(self):
+        super().__init__()
+        # False once a row group without min/max is seen, the range of the
+        # other row groups doesn't cover the column
+        self.range_known: bool = True
+        self.compressed_size: int = 0
+        self.uncompressed_size: int = 0
+        self.encodings: set = set()
+        self.compression: set = set()
+
+    def update_chunk(self, chunk: pq.ColumnChunkMetaData):
+        self.compressed_size += chunk.total_compressed_size
+        self.uncompressed_size += chunk.total_uncompressed_size
+        self.encodings.update(chunk.encodings)
+        self.compression.add(chunk.compression)
+        stats = chunk.statistics
+        if stats is None or not stats.has_null_count:
+            self.nulls = None
+        elif self.nulls is not None:
+            self.nulls += stats.null_count
+        if stats is not None and stats.has_min_max:
+            self.update_range(stats.min, stats.max)
+        elif stats is None or not stats.has_null_count or (
+                stats.null_count != chunk.num_values):
+            # row groups of nulls only have no min/max
+            self.range_known = False
+
+    def update_range(self, low, high):
+        if self.range_known:
+            super().update_range(low, high)
+
+    def update_dict(self, stats: dict):
+        """
+        Merges stats of another file
+        """
+        if self.nulls is not None and stats.get('nulls') is not None:
+            self.nulls += stats['nulls']
+        else:
+            self.nulls = None
+        self.update_range(stats.get('min'), stats.get('max'))
+        self.compressed_size += stats.get('compressed_size', 0)
+        self.uncompressed_size += stats.get('uncompressed_size', 0)
+        self.encodings.update(stats.get('encodings', ()))
+        self.compression.update(stats.get('compression', ()))
+
+    def to_dict(self) -> dict:
+        result = super().to_dict()
+        if not self.range_known:
+            result.update({'min': None, 'max': None})
+        result.update({
+            'compressed_size': self.compressed_size,
+            'uncompressed_size': self.uncompressed_size,
+            'encodings': sorted(self.encodings),
+            'compression': sorted(self.compression),
+        })
+        return result
+
+
+def _scan_csv(path, sample_rows, convert_options=None):
+    reader = csv.open_csv(
+        path, read_options=csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=convert_options)
+    schema = reader.schema
+    stats = [ColumnStats() for _ in schema.names]
+    rows = 0
+    complete = True
+    for batch in reader:
+        if sample_rows is not None and rows >= sample_rows:
+            # the sample ended at the batch boundary before the file end
+            complete = False
+            break
+        if sample_rows is not None and rows + batch.num_rows > sample_rows:
+            batch = batch.slice(0, sample_rows - rows)
+            complete = False
+        for column_stats, column in zip(stats, batch.columns):
+            column_stats.update(column)
+        rows += batch.num_rows
+        if not complete:
+            break
+    return schema, stats, rows, complete
+
+
+def _widen_column(exc, names, column_types) -> bool:
+    """
+    Converts the column failed to be converted to strings, all columns if
+    the error doesn't name it. Returns False if nothing is left to widen
+    """
+    match = _CSV_COLUMN_ERROR.search(str(exc))
+    index = int(match.group(1)) if match else len(names)
+    columns = [names[index]] if index < len(names) else names
+    columns = [name for name in columns if name not in column_types]
+    column_types.update((name, pa.string()) for name in columns)
+    return bool(columns)
+
+
+def profile_csv(path, sample_rows: int = None) -> dict:
+    """
+    Profiles csv file with the streaming reader batch by batch, so memory
+    stays bounded by the block size. With sample_rows only the first rows
+    are profiled, the row count of the file stopped early is unknown and
+    the profiled rows are stored as sampled_rows
+    """
+    column_types = dict()
+    while True:
+        try:
+            schema, stats, rows, complete = _scan_csv(
+                path, sample_rows, csv.ConvertOptions(
+                    column_types=column_types) if column_types else None)
+            break
+        except pa.ArrowInvalid as exc:
+            # a later block doesn't match the type inferred from the first
+            # one, the column is profiled as strings
+            widened = _widen_column(exc, csv.open_csv(path).schema.names,
+                                    column_types)
+            if not widened:
+                raise
+    meta = {
+        'format': 'csv',
+        'headers': schema.names,
+        'schema': {f.name: str(f.type) for f in schema},
+        'columns': {name: s.to_dict()
+                    for name, s in zip(schema.names, stats)},
+    }
+    meta['rows' if complete else 'sampled_rows'] = rows
+    if sample_rows is not None:
+        meta['sample_rows'] = sample_rows
+    return meta
+
+
+def hive_partitions(path) -> Dict[str, str]:
+    """
+    Returns key=value partitions of the hive-style directory layout
+    """
+    partitions = dict()
+    for part in os.fspath(path).split('/')[:-1]:
+        key, sep, value = part.partition('=')
+        if sep and key:
+            partitions[key] = value
+    return partitions
+
+
+def profile_parquet(path) -> dict:
+    """
+    Profiles parquet file by the footer only, data pages are never read
+    """
+    metadata = pq.read_metadata(path)
+    schema = metadata.schema.to_arrow_schema()
+    stats = dict()
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            chunk = row_group.column(j)
+            stats.setdefault(
+                chunk.path_in_schema, ParquetColumnStats()).update_chunk(chunk)
+    return {
+        'format': 'parquet',
+        'headers': metadata.schema.names,
+        'rows': metadata.num_rows,
+        'row_groups': metadata.num_row_groups,
+        'schema': {f.name: str(f.type) for f in schema},
+        'columns': {name: s.to_dict() for name, s in stats.items()},
+    }
+
+
+_footer_executor = ThreadPoolExecutor(max_workers=FOOTER_WORKERS)
+
+
+def profile_parquet_files(paths: Iterable[str]) -> Dict[str, dict]:
+    """
+    Reads footers of parquet files concurrently. Files failed to be read
+    are skipped
+    """
+    futures = {path: _footer_executor.submit(profile_parquet, path)
+               for path in paths}
+    result = dict()
+    for path, future in futures.items():
+        try:
+            result[path] = future.result()
+        except (OSError, pa.ArrowException):
+            continue
+    return result
+
+
+def merge_profiles(metas: Iterable[dict]) -> dict:
+    """
+    Aggregates profiles of files into the dataset profile: row and file
+    counts, values of hive partitions and stats of the columns. The row
+    count is None if any file was profiled by a sample
+    """
+    profile = {'files': 0, 'rows': 0, 'partitions': {}, 'columns': {}}
+    columns = dict()
+    partitions = dict()
+    for meta in metas:
+        profile['files'] += 1
+        if profile['rows'] is not None and 'rows' in meta:
+            profile['rows'] += meta['rows']
+        else:
+            profile['rows'] = None
+        for key, value in meta.get('partitions', {}).items():
+            partitions.setdefault(key, set()).add(value)
+        for name, stats in meta.get('columns', {}).items():
+            columns.setdefault(name, ParquetColumnStats()).update_dict(stats)
+    profile['partitions'] = {k: sorted(v) for k, v in partitions.items()}
+    profile['columns'] = {k: v.to_dict() for k, v in columns.items()}
+    return profile
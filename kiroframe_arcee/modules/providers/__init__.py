@@ -1,4 +1,32 @@
 from kiroframe_arcee.modules.providers import local_file
 from kiroframe_arcee.modules.providers import amazon
+from kiroframe_arcee.modules.providers import http_file
 
-__all__ = ['local_file', 'amazon']
+__all__ = ['local_file', 'amazon', 'http_file', 'register_provider',
+           'get_provider']
+
+_providers = dict()
+
+
+def register_provider(prefix: str, provider, strip_prefix: bool = False):
+    """
+    Registers the provider module (or object) of dataset paths starting
+    with the prefix. The provider implements get_file_info, download and
+    open_file coroutines and functions of the built-in providers and
+    optionally local_digest used by full verification. With strip_prefix
+    the provider gets paths without the prefix
+    """
+    _providers[prefix] = provider, strip_prefix
+
+
+def get_provider(path: str):
+    for prefix, (provider, strip_prefix) in _providers.items():
+        if path.startswith(prefix):
+            return provider, path[len(prefix):] if strip_prefix else path
+    raise TypeError('Unhandled path type')
+
+
+register_provider('file://', local_file, strip_prefix=True)
+register_provider('s3://', amazon)
+register_provider('http://', http_file)
+register_provider('https://', http_file)
@@ -1,11 +1,68 @@
 import os
+import re
+import math
+import base64
+import json
+import asyncio
+import threading
 import aioboto3
 import aiofiles
+from contextlib import asynccontextmanager
 from urllib.parse import urlparse
+from aiobotocore.config import AioConfig
 from botocore.exceptions import ClientError
 
+from kiroframe_arcee.modules.providers import local_file
+from kiroframe_arcee.utils import md5, run_sync
 
-async def get_file_info(path):
+_MB: int = 1_024 * 1_024
+_CHUNKSIZE: int = 1 * _MB
+# default ranged download settings, can be overridden per download
+PART_SIZE: int = 64 * _MB
+CONCURRENCY: int = 16
+READAHEAD: int = 8 * _MB
+# bytes of parts read into memory by all uploads of the process at once
+UPLOAD_BUFFER: int = 512 * _MB
+_BUFFER_WAIT: float = 0.01
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+_MULTIPART_ETAG = re.compile(r'^[0-9a-f]{32}-([0-9]+)$')
+
+
+class _UploadBuffers(object):
+    """
+    Bytes held in memory by uploads running in threads of the process. A
+    part larger than UPLOAD_BUFFER is let through alone
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.used: int = 0
+
+    def _acquire(self, nbytes) -> bool:
+        with self._lock:
+            if self.used and self.used + nbytes > UPLOAD_BUFFER:
+                return False
+            self.used += nbytes
+            return True
+
+    @asynccontextmanager
+    async def hold(self, nbytes: int):
+        # uploads run on loops of different threads, so the buffer is
+        # polled rather than awaited
+        while not self._acquire(nbytes):
+            await asyncio.sleep(_BUFFER_WAIT)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.used -= nbytes
+
+
+_upload_buffers = _UploadBuffers()
+
+
+async def get_file_info(path, **kwargs):
     try:
         bucket, key = await _parse_uri(path)
         session = aioboto3.Session()
@@ -28,19 +85,413 @@ async def _parse_uri(path):
     return bucket, key
 
 
-async def download(path, digest, dest_path, file_name):
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    # no awaits between seek and write, so parts can't interleave
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+def _pread(fd, length, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def _preallocate(fd, size):
+    if os.fstat(fd).st_size == size:
+        return
+    os.ftruncate(fd, size)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # not supported by the filesystem, sparse file is fine
+            pass
+
+
+def _split(size, part_size):
+    return [(offset, min(part_size, size - offset))
+            for offset in range(0, size, part_size)]
+
+
+def _part_md5(fd, offset, length):
+    part_md5 = md5()
+    pos = offset
+    end = offset + length
+    while pos < end:
+        chunk = _pread(fd, min(_CHUNKSIZE, end - pos), pos)
+        if not chunk:
+            break
+        part_md5.update(chunk)
+        pos += len(chunk)
+    return part_md5.hexdigest() if pos == end else None
+
+
+def _load_state(state_path, digest, size, part_size):
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if (state.get('digest'), state.get('size'),
+            state.get('part_size')) != (digest, size, part_size):
+        return {}
+    return {int(k): v for k, v in state.get('parts', {}).items()}
+
+
+def _save_state(state_path, digest, size, part_size, parts):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'digest': digest, 'size': size, 'part_size': part_size,
+                   'parts': parts}, f)
+    os.replace(tmp_path, state_path)
+
+
+def _composite_digest(part_digests):
+    composite = md5()
+    for part_digest in part_digests:
+        composite.update(bytes.fromhex(part_digest))
+    return '%s-%s' % (composite.hexdigest(), len(part_digests))
+
+
+def local_digest(path, digest, part_size=None, **kwargs):
+    """
+    Computes digest of the local file in the form of the etag: md5 or
+    the composite md5 of multipart uploads. Parts are assumed uniform and
+    MiB-aligned unless part_size is given. Returns None for other etags
+    """
+    match = _MULTIPART_ETAG.match(digest)
+    if match is None:
+        return local_file.local_digest(path, digest)
+    parts = int(match.group(1))
+    size = os.path.getsize(path)
+    if not size or parts < 1:
+        return None
+    if part_size is None:
+        part_size = math.ceil(size / parts / _MB) * _MB
+    if len(_split(size, part_size)) != parts:
+        return None
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _composite_digest(
+            [_part_md5(fd, *r) for r in _split(size, part_size)])
+    finally:
+        os.close(fd)
+
+
+async def _get_part_size(s3, bucket, key, digest, part_size):
+    # multipart uploads have "<md5>-<parts count>" etags, align the ranges
+    # with the uploaded parts to be able to rebuild the etag locally
+    if '-' not in digest:
+        return part_size, False
+    head = await s3.head_object(Bucket=bucket, Key=key, PartNumber=1)
+    return head['ContentLength'], True
+
+
+async def _download_part(s3, bucket, key, digest, write, offset, length,
+                         governor=None):
+    try:
+        response = await s3.get_object(
+            Bucket=bucket, Key=key, IfMatch='"%s"' % digest,
+            Range='bytes=%s-%s' % (offset, offset + length - 1))
+    except ClientError as exc:
+        if exc.response['Error'].get('Code') in ('412', 'PreconditionFailed'):
+            raise ValueError(
+                'Cannot download dataset file s3://%s/%s. Source file has '
+                'been changed' % (bucket, key))
+        raise
+    part_md5 = md5()
+    pos = offset
+    async with response['Body'] as stream:
+        chunk = await stream.read(_CHUNKSIZE)
+        while chunk:
+            part_md5.update(chunk)
+            write(chunk, pos)
+            pos += len(chunk)
+            if governor is not None:
+                await governor.aconsume(len(chunk))
+            chunk = await stream.read(_CHUNKSIZE)
+    if pos - offset != length:
+        raise ValueError(
+            'Cannot download dataset file s3://%s/%s. Got %s bytes of %s '
+            'at offset %s' % (bucket, key, pos - offset, length, offset))
+    return part_md5.hexdigest()
+
+
+async def download(path, digest, dest_path, file_name, part_size=None,
+                   concurrency=None, governor=None, **kwargs):
+    """
+    Downloads s3 object with parallel ranged requests into a preallocated
+    file. Completed parts are tracked in a sidecar state file, so an
+    interrupted download resumes from the missing parts. Received data is
+    throttled by the governor
+    """
+    part_size = part_size or PART_SIZE
+    concurrency = concurrency or CONCURRENCY
     bucket, key = await _parse_uri(path)
     session = aioboto3.Session()
-    async with session.resource("s3") as s3:
-        s3_object = await s3.Object(bucket, key)
-        etag = await s3_object.e_tag
-        if etag.strip('"') != digest:
+    config = AioConfig(max_pool_connections=concurrency)
+    async with session.client("s3", config=config) as s3:
+        head = await s3.head_object(Bucket=bucket, Key=key)
+        if head['ETag'].strip('"') != digest:
             raise ValueError(
                 'Cannot download dataset file %s. Source file has been '
                 'changed' % path)
+        size = head['ContentLength']
+        part_size, multipart = await _get_part_size(
+            s3, bucket, key, digest, part_size)
         os.makedirs(dest_path, exist_ok=True)
-        async with aiofiles.open(dest_path + file_name, 'wb') as fp:
-            await s3_object.download_fileobj(fp)
+        part_path = dest_path + file_name + PART_SUFFIX
+        state_path = dest_path + file_name + STATE_SUFFIX
+        ranges = _split(size, part_size)
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            _preallocate(fd, size)
+            parts = _load_state(state_path, digest, size, part_size)
+            # parts written before interruption may not have been flushed
+            parts = {
+                i: d for i, d in parts.items()
+                if i < len(ranges) and _part_md5(fd, *ranges[i]) == d
+            }
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def fetch(index):
+                async with semaphore:
+                    parts[index] = await _download_part(
+                        s3, bucket, key, digest,
+                        lambda chunk, pos: _pwrite(fd, chunk, pos),
+                        *ranges[index], governor=governor)
+                    _save_state(state_path, digest, size, part_size, parts)
+
+            tasks = [asyncio.ensure_future(fetch(i))
+                     for i in range(len(ranges)) if i not in parts]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            os.close(fd)
+    part_digests = [parts[i] for i in range(len(ranges))]
+    if not multipart:
+        actual = (part_digests[0] if len(part_digests) == 1
+                  else await local_file._get_md5(part_path))
+    elif '%s-%s' % (digest.split('-')[0], len(part_digests)) == digest:
+        actual = _composite_digest(part_digests)
+    else:
+        # uploaded with non-uniform parts, the etag can't be rebuilt
+        # locally. Every range request was pinned to it with If-Match
+        actual = digest
+    if actual != digest:
+        for p in (part_path, state_path):
+            if os.path.exists(p):
+                os.remove(p)
+        raise ValueError(
+            'Cannot download dataset file %s. Digest mismatch: expected %s, '
+            'got %s' % (path, digest, actual))
+    os.replace(part_path, dest_path + file_name)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+
+class RangeReader(local_file.VerifiedReader):
+    """
+    Reads s3 object lazily with ranged requests pinned to the etag.
+    Each request fetches at least readahead bytes
+    """
+
+    def __init__(self, path, digest, size, readahead=None):
+        super().__init__(path, digest, size)
+        self._readahead = readahead or READAHEAD
+        self._buffer = bytearray()
+        self._buffer_pos = 0
+        # reads are synchronous, the client runs on the shared loop
+        self._client = aioboto3.Session().client('s3')
+        self._s3 = run_sync(self._client.__aenter__())
+
+    def _read(self, pos, view):
+        offset = pos - self._buffer_pos
+        if not 0 <= offset < len(self._buffer):
+            length = min(max(len(view), self._readahead), self._size - pos)
+            self._buffer = run_sync(self._fetch(pos, length))
+            self._buffer_pos, offset = pos, 0
+        read = min(len(view), len(self._buffer) - offset)
+        with memoryview(self._buffer) as buffer:
+            view[:read] = buffer[offset:offset + read]
+        return read
+
+    async def _fetch(self, pos, length):
+        bucket, key = await _parse_uri(self.name)
+        buffer = bytearray(length)
+
+        def write(chunk, offset):
+            buffer[offset - pos:offset - pos + len(chunk)] = chunk
+
+        await _download_part(
+            self._s3, bucket, key, self._digest, write, pos, length)
+        return buffer
+
+    def close(self):
+        if not self.closed:
+            run_sync(self._client.__aexit__(None, None, None))
+        super().close()
+
+
+async def _head(s3, bucket, key, part_number=None):
+    kwargs = {'PartNumber': part_number} if part_number else {}
+    try:
+        return await s3.head_object(Bucket=bucket, Key=key, **kwargs)
+    except ClientError as exc:
+        if exc.response['Error'].get('Code') in ('404', 'NoSuchKey'):
+            return None
+        raise
+
+
+def _file_digests(path, part_size):
+    """
+    Returns md5 and the multipart etag of the file read once
+    """
+    file_md5 = md5()
+    part_digests = []
+    with open(path, 'rb') as f:
+        part = f.read(part_size)
+        while part:
+            file_md5.update(part)
+            part_md5 = md5()
+            part_md5.update(part)
+            part_digests.append(part_md5.hexdigest())
+            part = f.read(part_size)
+    return file_md5.hexdigest(), _composite_digest(part_digests)
+
+
+async def _uploaded_etag(s3, bucket, key, path, digest):
+    """
+    Returns etag of the object if it has the content of the digest and
+    the local file, multipart etags are rebuilt with the part size of
+    the object
+    """
+    head = await _head(s3, bucket, key)
+    if head is None or head['ContentLength'] != os.path.getsize(path):
+        return None
+    etag = head['ETag'].strip('"')
+    if '-' not in etag:
+        return etag if etag == digest else None
+    first_part = await _head(s3, bucket, key, 1)
+    actual, composite = await asyncio.to_thread(
+        _file_digests, path, first_part['ContentLength'])
+    return etag if (actual, composite) == (digest, etag) else None
+
+
+async def _upload_parts(s3, bucket, key, fd, ranges, concurrency, governor,
+                        digest):
+    """
+    Uploads parts of the file in parallel and returns md5 of the source
+    with the multipart etag. The source is hashed along with the upload,
+    the upload is completed only if the source is still the file of the
+    digest, otherwise it's aborted and the etag is None
+    """
+    upload_id = (await s3.create_multipart_upload(
+        Bucket=bucket, Key=key))['UploadId']
+    semaphore = asyncio.Semaphore(concurrency)
+    part_digests = [None] * len(ranges)
+
+    async def upload(index):
+        async with semaphore, _upload_buffers.hold(ranges[index][1]):
+            data = await asyncio.to_thread(_pread, fd, ranges[index][1],
+                                           ranges[index][0])
+            if governor is not None:
+                await governor.aconsume(len(data))
+            part_md5 = md5()
+            part_md5.update(data)
+            part_digests[index] = part_md5.hexdigest()
+            response = await s3.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id,
+                PartNumber=index + 1, Body=data,
+                ContentMD5=_content_md5(part_md5))
+            return {'ETag': response['ETag'], 'PartNumber': index + 1}
+
+    hashing = asyncio.ensure_future(
+        asyncio.to_thread(local_file._md5_fd, fd))
+    tasks = [asyncio.ensure_future(upload(i)) for i in range(len(ranges))]
+    try:
+        parts = await asyncio.gather(*tasks)
+        actual = await hashing
+        if actual != digest:
+            await s3.abort_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id)
+            return actual, None
+        await s3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': parts})
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # the thread hashing the source must be done before fd is closed
+        await asyncio.wait([hashing, *tasks])
+        await s3.abort_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return actual, _composite_digest(part_digests)
+
+
+def _content_md5(md5_hash):
+    return base64.b64encode(md5_hash.digest()).decode()
+
+
+async def upload(path, digest, dest_path, part_size=None, concurrency=None,
+                 governor=None, **kwargs):
+    """
+    Uploads the local file to the s3 path and returns the object etag.
+    Files larger than part_size are uploaded with parallel multipart
+    upload. The upload is skipped if the object already has the same
+    content
+    """
+    part_size = part_size or PART_SIZE
+    concurrency = concurrency or CONCURRENCY
+    bucket, key = await _parse_uri(dest_path)
+    session = aioboto3.Session()
+    config = AioConfig(max_pool_connections=concurrency)
+    async with session.client("s3", config=config) as s3:
+        etag = await _uploaded_etag(s3, bucket, key, path, digest)
+        if etag is not None:
+            return etag
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            ranges = _split(size, part_size)
+            if len(ranges) > 1:
+                actual, etag = await _upload_parts(
+                    s3, bucket, key, fd, ranges, concurrency, governor,
+                    digest)
+            else:
+                async with _upload_buffers.hold(size):
+                    data = await asyncio.to_thread(_pread, fd, size, 0)
+                    if governor is not None:
+                        await governor.aconsume(len(data))
+                    data_md5 = md5()
+                    data_md5.update(data)
+                    actual = data_md5.hexdigest()
+                    if actual == digest:
+                        response = await s3.put_object(
+                            Bucket=bucket, Key=key, Body=data,
+                            ContentMD5=_content_md5(data_md5))
+                        etag = response['ETag'].strip('"')
+        finally:
+            os.close(fd)
+    if actual != digest:
+        raise ValueError(
+            'Cannot upload dataset file %s. Source file has been changed' %
+            path)
+    return etag
+
+
+def open_file(path, digest, size, readahead=None, **kwargs):
+    return RangeReader(path, digest, size, readahead)
 
 
 async def main(bucket, key):
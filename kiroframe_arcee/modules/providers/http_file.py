@@ -0,0 +1,336 @@
+import os
+import re
+import atexit
+import asyncio
+import threading
+import aiohttp
+
+from kiroframe_arcee.modules.providers import local_file
+from kiroframe_arcee.modules.providers.amazon import (
+    _pwrite, _preallocate, _split)
+from kiroframe_arcee.utils import md5
+
+_MB: int = 1_024 * 1_024
+_CHUNKSIZE: int = 1 * _MB
+# default ranged download settings, can be overridden per download
+PART_SIZE: int = 16 * _MB
+CONCURRENCY: int = 8
+READAHEAD: int = 8 * _MB
+POOL_LIMIT: int = 64
+PART_SUFFIX = '.part'
+_ETAG = re.compile(r'^(W/)?"(.*)"$')
+_CONTENT_RANGE = re.compile(r'^bytes \d+-\d+/(\d+)$')
+
+
+class SessionPool(object):
+    """
+    aiohttp session shared by all http transfers. The session runs on its
+    own event loop thread, so connections are reused across threads and
+    asyncio.run calls of the datasets
+    """
+
+    def __init__(self, limit: int = POOL_LIMIT):
+        self.limit: int = limit
+        self._lock = threading.Lock()
+        self._loop = None
+        self._session = None
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True,
+                                 name='kiroframe-http').start()
+                self._session = asyncio.run_coroutine_threadsafe(
+                    self._create_session(), loop).result()
+                self._loop = loop
+                atexit.register(self.close)
+        return self._loop
+
+    async def _create_session(self):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit))
+
+    def submit(self, func, *args):
+        """
+        Runs func(session, *args) coroutine on the session loop and returns
+        concurrent future of the result
+        """
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(
+            func(self._session, *args), loop)
+
+    async def call(self, func, *args):
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+            if loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(
+                self._session.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+
+
+default_pool = SessionPool()
+
+
+def _parse_etag(headers):
+    """
+    Returns etag without quotes, weak etags keep W/ prefix
+    """
+    match = _ETAG.match(headers.get('ETag', ''))
+    if match is None:
+        return None
+    return (match.group(1) or '') + match.group(2)
+
+
+def _quote(digest):
+    if digest.startswith('W/'):
+        return 'W/"%s"' % digest[2:]
+    return '"%s"' % digest
+
+
+def _is_strong(digest):
+    return digest is not None and not digest.startswith('W/')
+
+
+def _changed(path):
+    return ValueError(
+        'Cannot download dataset file %s. Source file has been changed' %
+        path)
+
+
+async def _head(session, path, digest=None):
+    headers = {'If-None-Match': _quote(digest)} if digest else {}
+    async with session.head(path, headers=headers,
+                            allow_redirects=True) as response:
+        if response.status == 304:
+            return None
+        response.raise_for_status()
+        size = response.headers.get('Content-Length')
+        return {
+            'etag': _parse_etag(response.headers),
+            'size': int(size) if size is not None else None,
+            'ranges': response.headers.get('Accept-Ranges') == 'bytes',
+        }
+
+
+async def _size(session, path):
+    """
+    Returns the file size from Content-Range of the one byte request, the
+    file is read to the end if the server doesn't support ranges
+    """
+    async with session.get(path, headers={'Range': 'bytes=0-0'}) as response:
+        response.raise_for_status()
+        match = _CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+        if response.status == 206 and match:
+            return int(match.group(1))
+        size = 0
+        async for chunk in response.content.iter_chunked(_CHUNKSIZE):
+            size += len(chunk)
+        return size
+
+
+async def _get(session, path, etag, write, governor=None):
+    """
+    Streams the file to write(chunk, pos), returns md5 and size of data.
+    Files with etag are pinned to it. Chunks are hashed and written in
+    threads, so transfers sharing the session loop don't wait for them
+    """
+    headers = {'If-Match': _quote(etag)} if _is_strong(etag) else {}
+    data_md5 = md5()
+    pos = 0
+
+    def consume(chunk, pos):
+        data_md5.update(chunk)
+        write(chunk, pos)
+    async with session.get(path, headers=headers) as response:
+        if response.status == 412:
+            raise _changed(path)
+        response.raise_for_status()
+        if etag is not None and _parse_etag(response.headers) != etag:
+            raise _changed(path)
+        async for chunk in response.content.iter_chunked(_CHUNKSIZE):
+            await asyncio.to_thread(consume, chunk, pos)
+            pos += len(chunk)
+            if governor is not None:
+                await governor.aconsume(len(chunk))
+    return data_md5.hexdigest(), pos
+
+
+async def _get_range(session, path, etag, write, offset, length,
+                     governor=None):
+    headers = {'Range': 'bytes=%s-%s' % (offset, offset + length - 1)}
+    if _is_strong(etag):
+        headers['If-Match'] = _quote(etag)
+    pos = offset
+    async with session.get(path, headers=headers) as response:
+        if response.status == 412:
+            raise _changed(path)
+        response.raise_for_status()
+        if response.status != 206:
+            raise ValueError(
+                'Cannot download dataset file %s. Range requests are not '
+                'supported' % path)
+        async for chunk in response.content.iter_chunked(_CHUNKSIZE):
+            await asyncio.to_thread(write, chunk, pos)
+            pos += len(chunk)
+            if governor is not None:
+                await governor.aconsume(len(chunk))
+    if pos - offset != length:
+        raise ValueError(
+            'Cannot download dataset file %s. Got %s bytes of %s at offset '
+            '%s' % (path, pos - offset, length, offset))
+
+
+async def _md5(session, path):
+    return await _get(session, path, None, lambda chunk, pos: None)
+
+
+def local_digest(path, digest, **kwargs):
+    """
+    Returns md5 of the downloaded copy of the file. Etags are opaque, so
+    only files with md5 digests are verified by content
+    """
+    return local_file.local_digest(path, digest)
+
+
+async def get_file_info(path, digest=None, pool=None, **kwargs):
+    """
+    Returns etag and size of the file from HEAD response. Files without
+    etag are hashed with GET, the size missing in HEAD response is got
+    with GET. Returns None if the file still has the given digest
+    """
+    pool = pool or default_pool
+    head = await pool.call(_head, path, digest)
+    if head is None:
+        return None
+    if head['etag'] is not None:
+        size = head['size']
+        if size is None:
+            size = await pool.call(_size, path)
+        return head['etag'], size, {}
+    actual, size = await pool.call(_md5, path)
+    if digest == actual:
+        return None
+    return actual, size, {}
+
+
+async def _download(session, path, digest, part_path, part_size,
+                    concurrency, governor):
+    """
+    Returns digest of the downloaded file: the etag the requests were
+    pinned to or md5 of files without etag
+    """
+    head = await _head(session, path)
+    etag = head['etag']
+    if etag is not None and etag != digest:
+        raise _changed(path)
+    size = head['size']
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        ranged = _is_strong(etag) and head['ranges']
+        if not ranged or size is None or size <= part_size:
+            actual, _ = await _get(
+                session, path, etag,
+                lambda chunk, pos: _pwrite(fd, chunk, pos), governor)
+            return etag or actual
+        _preallocate(fd, size)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(offset, length):
+            async with semaphore:
+                await _get_range(
+                    session, path, digest,
+                    lambda chunk, pos: _pwrite(fd, chunk, pos),
+                    offset, length, governor)
+
+        tasks = [asyncio.ensure_future(fetch(*r))
+                 for r in _split(size, part_size)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # every range request was pinned to the etag with If-Match
+        return etag
+    finally:
+        os.close(fd)
+
+
+async def download(path, digest, dest_path, file_name, part_size=None,
+                   concurrency=None, governor=None, pool=None, **kwargs):
+    """
+    Downloads the file with parallel ranged requests pinned to the etag
+    if the server supports them, otherwise with a single request
+    """
+    pool = pool or default_pool
+    os.makedirs(dest_path, exist_ok=True)
+    part_path = dest_path + file_name + PART_SUFFIX
+    try:
+        actual = await pool.call(
+            _download, path, digest, part_path, part_size or PART_SIZE,
+            concurrency or CONCURRENCY, governor)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    if actual != digest:
+        os.remove(part_path)
+        raise ValueError(
+            'Cannot download dataset file %s. Digest mismatch: expected %s, '
+            'got %s' % (path, digest, actual))
+    os.replace(part_path, dest_path + file_name)
+
+
+class RangeReader(local_file.VerifiedReader):
+    """
+    Reads http file lazily with ranged requests pinned to the etag. Each
+    request fetches at least readahead bytes
+    """
+
+    def __init__(self, path, digest, size, readahead=None, pool=None):
+        super().__init__(path, digest, size)
+        self._readahead = readahead or READAHEAD
+        self._pool = pool or default_pool
+        self._buffer = bytearray()
+        self._buffer_pos = 0
+        head = self._pool.submit(_head, path).result()
+        self._etag = head['etag']
+        if self._etag is not None and self._etag != digest:
+            raise ValueError('Dataset file %s has been changed' % path)
+
+    def _read(self, pos, view):
+        offset = pos - self._buffer_pos
+        if not 0 <= offset < len(self._buffer):
+            length = min(max(len(view), self._readahead), self._size - pos)
+            self._buffer = self._pool.submit(
+                self._fetch, pos, length).result()
+            self._buffer_pos, offset = pos, 0
+        read = min(len(view), len(self._buffer) - offset)
+        with memoryview(self._buffer) as buffer:
+            view[:read] = buffer[offset:offset + read]
+        return read
+
+    async def _fetch(self, session, pos, length):
+        buffer = bytearray(length)
+
+        def write(chunk, offset):
+            buffer[offset - pos:offset - pos + len(chunk)] = chunk
+
+        await _get_range(session, self.name, self._etag, write, pos, length)
+        return buffer
+
+    def _verify(self):
+        # reads of files with etag are pinned to it, the digest of files
+        # without etag is md5
+        if self._etag is None:
+            super()._verify()
+
+
+def open_file(path, digest, size, readahead=None, **kwargs):
+    return RangeReader(path, digest, size, readahead)
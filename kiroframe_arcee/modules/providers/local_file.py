@@ -1,33 +1,42 @@
+import io
+import abc
 import os
-import sys
-import hashlib
-import shutil
+import re
 import mmap
 import aiofiles
 import asyncio
-import csv
-from pathlib import Path
-import pyarrow.parquet as pq
+
+from kiroframe_arcee.modules import extractors
+from kiroframe_arcee.modules.profiling import MetaCache
+from kiroframe_arcee.utils import md5
 
 _KB: int = 1_024
+_MB: int = 1_024 * _KB
 _CHUNKSIZE: int = 128 * _KB
+_COPY_BUFSIZE: int = 8 * _MB
+# linux ioctl to clone file extents (reflink) on btrfs, xfs, etc.
+_FICLONE = 0x40049409
+PART_SUFFIX = '.part'
+_MD5_DIGEST = re.compile(r'^[0-9a-f]{32}$')
+
 
+def is_md5(digest):
+    return _MD5_DIGEST.match(digest) is not None
 
-async def get_file_info(path):
+
+async def get_file_info(path, sample_rows=None, full_profile=False,
+                        **kwargs):
     digest = await _get_md5(path)
     size = await _get_size(path)
     try:
-        meta = await get_file_meta(path)
+        meta = await get_file_meta(path, digest, sample_rows, full_profile)
     except Exception:
         meta = {}
     return digest, size, meta
 
 
 async def _get_md5(path):
-    if sys.version_info >= (3, 9):
-        md_5_hash = hashlib.md5(usedforsecurity=False)
-    else:
-        md_5_hash = hashlib.md5()
+    md_5_hash = md5()
     async with aiofiles.open(path, "rb") as f:
         try:
             with mmap.mmap(f.fileno(), length=0,
@@ -43,39 +52,231 @@ async def _get_md5(path):
     return md_5_hash.hexdigest()
 
 
+def local_digest(path, digest, **kwargs):
+    """
+    Returns md5 of the downloaded copy of the file. Returns None if the
+    digest isn't md5, so the content can't be verified
+    """
+    if not is_md5(digest):
+        return None
+    with open(path, 'rb') as f:
+        return _md5_fd(f.fileno())
+
+
 async def _get_size(path):
     st = os.stat(path)
     return st.st_size
 
 
-async def download(path, digest, dest_path, file_name):
+def _md5_fd(fd):
+    md_5_hash = md5()
+    try:
+        with mmap.mmap(fd, length=0, access=mmap.ACCESS_READ) as mview:
+            md_5_hash.update(mview)
+    except ValueError:
+        # empty file
+        pass
+    return md_5_hash.hexdigest()
+
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+
+def _hardlink(src, dst):
+    try:
+        os.link(src.name, dst)
+        return True
+    except OSError:
+        return False
+
+
+def _write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def _copy_md5(src, dst, governor=None):
+    md_5_hash = md5()
+    size = os.fstat(src.fileno()).st_size
+    try:
+        mview = mmap.mmap(src.fileno(), length=0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # empty or non-mappable file
+        mview = None
+    if mview is not None:
+        with mview, memoryview(mview) as view:
+            for offset in range(0, size, _COPY_BUFSIZE):
+                with view[offset:offset + _COPY_BUFSIZE] as chunk:
+                    md_5_hash.update(chunk)
+                    _write_all(dst.fileno(), chunk)
+                    if governor is not None:
+                        governor.consume(len(chunk))
+        return md_5_hash.hexdigest()
+    buf = bytearray(_COPY_BUFSIZE)
+    with memoryview(buf) as view:
+        read = src.readinto(view)
+        while read:
+            md_5_hash.update(view[:read])
+            _write_all(dst.fileno(), view[:read])
+            if governor is not None:
+                governor.consume(read)
+            read = src.readinto(view)
+    return md_5_hash.hexdigest()
+
+
+def _copy_verified(path, destination, hardlink=True, governor=None):
+    """
+    Places a copy of the file to the destination and returns md5 of the
+    placed data. Source is read only once: on the same filesystem the file
+    is cloned (reflink) or hardlinked and the result is hashed, otherwise
+    data is hashed while it's copied (throttled by the governor)
+    """
+    with open(path, 'rb') as src:
+        same_fs = os.fstat(src.fileno()).st_dev == os.stat(
+            os.path.dirname(destination) or '.').st_dev
+        if same_fs:
+            linked = _reflink(src, destination)
+            linked = linked or hardlink and _hardlink(src, destination)
+            if linked:
+                with open(destination, 'rb') as placed:
+                    return _md5_fd(placed.fileno())
+        with open(destination, 'wb') as dst:
+            return _copy_md5(src, dst, governor)
+
+
+async def download(path, digest, dest_path, file_name, hardlink=True,
+                   governor=None, **kwargs):
     if not os.path.exists(path):
         raise ValueError('Failed to find file path %s' % path)
-    md5 = await _get_md5(path)
-    if md5 != digest:
+    os.makedirs(dest_path, exist_ok=True)
+    destination = dest_path + file_name
+    tmp_path = destination + PART_SUFFIX
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        actual = await asyncio.to_thread(
+            _copy_verified, path, tmp_path, hardlink, governor)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if actual != digest:
+        os.remove(tmp_path)
         raise ValueError(
             'Cannot download dataset file %s. Source file has been changed' %
             path)
-    os.makedirs(dest_path, exist_ok=True)
-    shutil.copy(path, dest_path + file_name)
-
-
-async def get_file_meta(path):
-    path = Path(path)
-    suffix = path.suffix.lower()
-    if suffix == ".csv":
-        async with aiofiles.open(path, "r", encoding="utf-8",
-                                 newline="") as f:
-            header_line = await f.readline()
-            headers = next(csv.reader([header_line]))
-        return {"format": "csv", "headers": headers}
-    elif suffix == ".parquet":
-        # PyArrow is synchronous and blocks the event loop. Run in a thread
-        def read_parquet():
-            metadata = pq.read_metadata(path)
-            return metadata.schema.names, metadata.num_rows
-
-        headers, row_count = await asyncio.to_thread(read_parquet)
-        return {"format": "parquet", "headers": headers, "rows": row_count}
-    else:
-        raise ValueError(f"Unsupported file format: {suffix}")
+    os.replace(tmp_path, destination)
+
+
+class VerifiedReader(io.RawIOBase):
+    """
+    Raw binary reader of a dataset file. Data read sequentially is hashed,
+    the digest is verified once the end of the file is reached
+    """
+
+    def __init__(self, path, digest, size):
+        # io base classes don't check abstract methods on instantiation
+        if self.__abstractmethods__:
+            raise TypeError('Cannot instantiate abstract reader %s' %
+                            type(self).__name__)
+        super().__init__()
+        self.name = path
+        self._digest = digest
+        self._size = size
+        self._pos = 0
+        self._md5 = md5()
+        self._hashed = 0
+
+    @abc.abstractmethod
+    def _read(self, pos, view) -> int:
+        """
+        Reads data at the position into the view, returns the read size
+        """
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError('Negative seek position %s' % offset)
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        with memoryview(b) as view:
+            length = max(0, min(len(view), self._size - self._pos))
+            read = self._read(self._pos, view[:length]) if length else 0
+            if self._pos == self._hashed and read:
+                self._md5.update(view[:read])
+                self._hashed += read
+                if self._hashed == self._size:
+                    self._verify()
+        self._pos += read
+        return read
+
+    def _verify(self):
+        # etags other than md5 (s3 multipart, http) can't be rebuilt from
+        # the stream, such reads are pinned to the etag by the provider
+        if not is_md5(self._digest):
+            return
+        if self._md5.hexdigest() != self._digest:
+            raise ValueError(
+                'Dataset file %s has been changed' % self.name)
+
+
+class LocalReader(VerifiedReader):
+    def __init__(self, path, digest, size):
+        super().__init__(path, digest, size)
+        self._file = open(path, 'rb', buffering=0)
+        if os.fstat(self._file.fileno()).st_size != size:
+            self._file.close()
+            raise ValueError(
+                'Dataset file %s has been changed' % path)
+
+    def _read(self, pos, view):
+        self._file.seek(pos)
+        return self._file.readinto(view)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_file(path, digest, size, **kwargs):
+    return LocalReader(path, digest, size)
+
+
+def read_file_meta(path, digest=None, sample_rows=None,
+                   cache: MetaCache = None, full_profile=False):
+    return extractors.extract_meta(path, digest, sample_rows, cache,
+                                   full_profile)
+
+
+async def get_file_meta(path, digest=None, sample_rows=None,
+                        full_profile=False):
+    # PyArrow is synchronous and blocks the event loop. Run in a thread
+    return await asyncio.to_thread(
+        read_file_meta, path, digest, sample_rows, None, full_profile)
@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import time
+import threading
+from typing import Dict, Optional
+
+from kiroframe_arcee.modules.dataset import Dataset
+
+SNAPSHOT_PATH = 'kiroframe/manifests/'
+_UNSAFE_CHARS = re.compile(r'[^0-9A-Za-z_.-]')
+_PINNED_VERSION = re.compile(r'^[Vv]?[0-9]+$')
+# seconds an alias resolution is used without revalidation
+ALIAS_TTL: float = 60
+
+# resolutions of the process shared by the stores, keyed by refs path
+_resolved: Dict[str, dict] = dict()
+_resolved_lock = threading.Lock()
+
+
+class SnapshotStore(object):
+    """
+    Local Arrow snapshots of resolved dataset versions keyed by dataset key
+    and version. The refs file of a dataset maps the requested versions and
+    aliases to the resolved version, its ETag and the time it was checked.
+    Refs are kept in the process as well. Pinned versions never change,
+    aliases are fresh for ALIAS_TTL seconds since the last check
+    """
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path: str = path
+
+    @staticmethod
+    def _split(dataset: str):
+        key, _, ref = dataset.rpartition(':')
+        if not key:
+            return ref, ''
+        return key, ref
+
+    def _dir(self, key):
+        return os.path.join(self.path, _UNSAFE_CHARS.sub('_', key))
+
+    def _snapshot_path(self, key, version):
+        return os.path.join(self._dir(key), 'V%s.arrow' % version)
+
+    def _refs_path(self, key):
+        return os.path.join(self._dir(key), 'refs.json')
+
+    def _load_refs(self, key, reload=False) -> dict:
+        path = self._refs_path(key)
+        with _resolved_lock:
+            refs = _resolved.get(os.path.abspath(path))
+        if refs is not None and not reload:
+            return dict(refs)
+        try:
+            with open(path, 'r') as f:
+                refs = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        with _resolved_lock:
+            _resolved[os.path.abspath(path)] = refs
+        return dict(refs)
+
+    def _save_refs(self, key, refs):
+        path = self._refs_path(key)
+        with _resolved_lock:
+            _resolved[os.path.abspath(path)] = refs
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(refs, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def is_fresh(resolved: dict) -> bool:
+        """
+        Returns True if the resolved version can be used without
+        revalidation
+        """
+        if _PINNED_VERSION.match(resolved['ref']):
+            return True
+        return time.time() - resolved.get('checked', 0) < ALIAS_TTL
+
+    def resolve(self, dataset: str) -> Optional[dict]:
+        """
+        Returns the last resolved version of the dataset identifier in
+        key:version format, if its snapshot exists
+        """
+        key, ref = self._split(dataset)
+        resolved = self._load_refs(key).get(ref)
+        if not resolved or not self.is_fresh(dict(resolved, ref=ref)):
+            # other processes of the node may have resolved it
+            resolved = self._load_refs(key, reload=True).get(ref)
+        if not resolved or not os.path.isfile(
+                self._snapshot_path(key, resolved['version'])):
+            return None
+        return dict(resolved, key=key, ref=ref)
+
+    def load(self, resolved: dict) -> Dataset:
+        return Dataset.from_snapshot(
+            self._snapshot_path(resolved['key'], resolved['version']))
+
+    def save(self, dataset: str, obj: Dataset, etag: str = None):
+        key, ref = self._split(dataset)
+        os.makedirs(self._dir(key), exist_ok=True)
+        obj.save_snapshot(self._snapshot_path(key, obj._version))
+        refs = self._load_refs(key)
+        refs[ref] = {'version': obj._version, 'etag': etag,
+                     'checked': time.time()}
+        self._save_refs(key, refs)
+
+    def touch(self, resolved: dict):
+        """
+        Marks the resolved version as revalidated
+        """
+        refs = self._load_refs(resolved['key'])
+        refs[resolved['ref']] = {'version': resolved['version'],
+                                 'etag': resolved['etag'],
+                                 'checked': time.time()}
+        self._save_refs(resolved['key'], refs)
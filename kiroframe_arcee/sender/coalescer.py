@@ -0,0 +1,116 @@
+import asyncio
+import threading
+
+from kiroframe_arcee.sender.retry import is_transient
+from kiroframe_arcee.utils import default_loop
+
+# updates made within the window are sent with one request per entity
+FLUSH_INTERVAL: float = 1.0
+
+
+class _Entity(object):
+    __slots__ = ('send', 'values', 'sent')
+
+    def __init__(self, send):
+        self.send = send
+        self.values: dict = dict()
+        self.sent: dict = dict()
+
+
+class WriteCoalescer(object):
+    """
+    Merges updates of run entities (tags, hyperparameters, model version
+    and artifact tags) and sends every changed entity once per flush
+    window. send(values) coroutine of the entity gets all its values,
+    entities without changes since the last send are skipped
+    """
+
+    def __init__(self, interval: float = FLUSH_INTERVAL, loop=None):
+        self.interval: float = interval
+        self._loop = loop or default_loop
+        self._lock = threading.Lock()
+        self._entities = dict()
+        self._scheduled = None
+        self._flushing = None
+        self._closed = False
+        # updates merged into a pending send or not changing the entity
+        self.coalesced: int = 0
+
+    def update(self, key, send, values: dict):
+        with self._lock:
+            entity = self._entities.get(key)
+            if entity is None:
+                entity = self._entities[key] = _Entity(send)
+            entity.send = send
+            changed = entity.values != entity.sent
+            entity.values.update(values)
+            if changed or entity.values == entity.sent:
+                self.coalesced += 1
+            if entity.values == entity.sent or self._closed:
+                return
+            if self._scheduled is not None:
+                return
+            self._scheduled = self._loop.submit(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        with self._lock:
+            self._scheduled = None
+            # kept for close to wait for the flush in flight
+            self._flushing = flushing = self._loop.submit(self.flush())
+        try:
+            await asyncio.wrap_future(flushing)
+        except Exception as exc:
+            # entities failed to be sent are kept, the send is repeated in
+            # the next window while the api is unreachable
+            if not is_transient(exc):
+                return
+            with self._lock:
+                if self._scheduled is None and not self._closed:
+                    self._scheduled = self._loop.submit(self._flush_later())
+
+    async def flush(self):
+        """
+        Sends changed entities. Entities failed to be sent stay changed,
+        the first error is raised
+        """
+        with self._lock:
+            pending = list()
+            for entity in self._entities.values():
+                if entity.values != entity.sent:
+                    pending.append((entity, entity.sent, dict(entity.values)))
+                    entity.sent = pending[-1][2]
+        results = await asyncio.gather(
+            *(entity.send(values) for entity, _, values in pending),
+            return_exceptions=True)
+        error = None
+        for (entity, previous, values), result in zip(pending, results):
+            if not isinstance(result, BaseException):
+                continue
+            with self._lock:
+                if entity.sent is values:
+                    entity.sent = previous
+            error = error or result
+        if error is not None:
+            raise error
+
+    async def close(self):
+        """
+        Cancels the scheduled flush, waits for the flush in flight and
+        sends changes left, the first error is raised
+        """
+        with self._lock:
+            self._closed = True
+        self.cancel()
+        with self._lock:
+            flushing = self._flushing
+        if flushing is not None:
+            # entities failed to be sent in flight are sent again below
+            await asyncio.wait([asyncio.wrap_future(flushing)])
+        await self.flush()
+
+    def cancel(self):
+        with self._lock:
+            scheduled, self._scheduled = self._scheduled, None
+        if scheduled is not None:
+            scheduled.cancel()
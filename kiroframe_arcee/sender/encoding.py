@@ -0,0 +1,106 @@
+import gzip
+import json
+import asyncio
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+# smaller bodies aren't worth compressing
+COMPRESS_THRESHOLD: int = 16 * 1024
+# larger bodies are compressed in a thread not to block the event loop
+OFFLOAD_SIZE: int = 1024 * 1024
+GZIP_LEVEL: int = 6
+ZSTD_LEVEL: int = 3
+
+_compression = None
+_threshold = COMPRESS_THRESHOLD
+
+
+def _default(obj):
+    # numpy scalars and arrays not handled natively, numpy isn't imported
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(
+        'Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
+def _orjson_dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=_default, option=(
+        orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj, default=_default, separators=(',', ':')).encode()
+
+
+_dumps = _orjson_dumps if orjson is not None else _json_dumps
+
+
+def dumps(obj) -> bytes:
+    """
+    Serializes obj to JSON with the serializer set, orjson if installed
+    """
+    result = _dumps(obj)
+    return result.encode() if isinstance(result, str) else result
+
+
+def set_serializer(func=None):
+    """
+    Sets the function serializing request bodies to compact JSON bytes or
+    str, None restores the default one
+    """
+    global _dumps
+    if func is None:
+        func = _orjson_dumps if orjson is not None else _json_dumps
+    _dumps = func
+
+
+def set_request_compression(encoding=GZIP,
+                            threshold: int = COMPRESS_THRESHOLD):
+    """
+    Compresses request bodies larger than threshold bytes with gzip or
+    zstd encoding, None disables compression
+    """
+    global _compression, _threshold
+    if encoding not in (None, GZIP, ZSTD):
+        raise ValueError('Unsupported encoding: %s' % encoding)
+    if encoding == ZSTD and zstandard is None:
+        raise ValueError('zstd encoding requires zstandard package')
+    _compression, _threshold = encoding, threshold
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+async def encode_body(data, headers=None):
+    """
+    Returns the serialized and, if enabled, compressed request body with
+    its headers
+    """
+    headers = dict(headers or {})
+    if data is None:
+        return None, headers
+    body = dumps(data)
+    headers.setdefault('Content-Type', 'application/json')
+    encoding = _compression
+    if encoding is None or len(body) < _threshold:
+        return body, headers
+    if len(body) > OFFLOAD_SIZE:
+        body = await asyncio.to_thread(compress, body, encoding)
+    else:
+        body = compress(body, encoding)
+    headers['Content-Encoding'] = encoding
+    return body, headers
@@ -0,0 +1,164 @@
+import time
+import asyncio
+import threading
+from collections import deque
+
+from kiroframe_arcee.sender.retry import backoff, is_transient
+from kiroframe_arcee.utils import default_loop
+
+# drop policies of full queues
+NEVER_DROP = 'never_drop'
+DOWNSAMPLE = 'downsample'
+DROP_OLDEST = 'drop_oldest'
+EVENTS = 'events'
+METRICS = 'metrics'
+PROC_STATS = 'proc_stats'
+# categories in priority order with their policy and capacity. Callers
+# putting events into the full queue wait for space
+CATEGORIES = {
+    EVENTS: (NEVER_DROP, 1_000),
+    METRICS: (DOWNSAMPLE, 1_000),
+    PROC_STATS: (DROP_OLDEST, 10),
+}
+BACKPRESSURE_INTERVAL: float = 0.01
+DRAIN_TIMEOUT: float = 30.0
+
+
+class Outbox(object):
+    """
+    Bounded queues of requests sent in background by the run. Full metric
+    queues are down-sampled: every other queued metric is dropped. Full
+    heartbeat queues drop the oldest heartbeat
+    """
+
+    def __init__(self, loop=None):
+        self._loop = loop or default_loop
+        self._lock = threading.Lock()
+        self._queues = {category: deque() for category in CATEGORIES}
+        self.dropped = {category: 0 for category in CATEGORIES}
+        self.sent: int = 0
+        self.failed: int = 0
+        self._in_flight = 0
+        self._worker = None
+        self._wakeup = None
+        self._closed = False
+
+    def _push(self, category, send) -> bool:
+        policy, capacity = CATEGORIES[category]
+        with self._lock:
+            if self._closed:
+                self.dropped[category] += 1
+                return True
+            queue = self._queues[category]
+            if len(queue) >= capacity:
+                if policy == NEVER_DROP:
+                    return False
+                if policy == DROP_OLDEST:
+                    queue.popleft()
+                    self.dropped[category] += 1
+                else:
+                    # every other metric is dropped, the newest are kept
+                    kept = list(queue)[::-2][::-1]
+                    self.dropped[category] += len(queue) - len(kept)
+                    queue.clear()
+                    queue.extend(kept)
+            queue.append(send)
+            if self._worker is None:
+                self._worker = self._loop.submit(self._run())
+            elif self._wakeup is not None:
+                self._loop.loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    async def put(self, category: str, send):
+        """
+        Queues send() coroutine function of the category
+        """
+        while not self._push(category, send):
+            await asyncio.sleep(BACKPRESSURE_INTERVAL)
+
+    def _pop(self):
+        with self._lock:
+            for category, queue in self._queues.items():
+                if queue:
+                    self._in_flight += 1
+                    return category, queue.popleft()
+            self._wakeup.clear()
+        return None, None
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        attempt = 0
+        while True:
+            category, send = self._pop()
+            if send is None:
+                await self._wakeup.wait()
+                continue
+            try:
+                attempt = await self._send(category, send, attempt)
+            except Exception:
+                # the worker must not die, queued requests would never be
+                # sent and callers waiting for space would hang
+                self.failed += 1
+                attempt = 0
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+    async def _send(self, category, send, attempt: int) -> int:
+        """
+        Sends the request, returns the attempt of the next one. Events
+        failed with transient errors are queued again
+        """
+        try:
+            await send()
+        except Exception as exc:
+            if CATEGORIES[category][0] != NEVER_DROP or not is_transient(
+                    exc):
+                self.failed += 1
+                return 0
+        else:
+            self.sent += 1
+            return 0
+        delay = backoff(attempt)
+        with self._lock:
+            self._queues[category].appendleft(send)
+        await asyncio.sleep(delay)
+        return attempt + 1
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._in_flight + sum(map(len, self._queues.values()))
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """
+        Waits until queued requests are sent
+        """
+        deadline = time.monotonic() + timeout
+        while self.pending:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def close(self):
+        """
+        Stops sending, requests left are counted as dropped
+        """
+        with self._lock:
+            self._closed = True
+            worker, self._worker = self._worker, None
+            for category, queue in self._queues.items():
+                self.dropped[category] += len(queue)
+                queue.clear()
+        if worker is not None:
+            worker.cancel()
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {
+                'queued': {c: len(q) for c, q in self._queues.items()},
+                'dropped': dict(self.dropped),
+                'sent': self.sent,
+                'failed': self.failed,
+            }
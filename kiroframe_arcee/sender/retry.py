@@ -0,0 +1,176 @@
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import aiohttp
+
+RETRY_ATTEMPTS: int = 4
+BACKOFF_BASE: float = 0.5
+# longer Retry-After is capped not to stall the run
+MAX_BACKOFF: float = 30.0
+# larger exponents reach MAX_BACKOFF anyway and may overflow
+MAX_BACKOFF_EXPONENT: int = 16
+# consecutive failures opening the circuit and the time it stays open
+FAILURE_THRESHOLD: int = 5
+RESET_TIMEOUT: float = 30.0
+# statuses of requests which may be retried, requests which are not
+# idempotent are retried only if the api didn't process them
+_TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+_UNPROCESSED_STATUSES = (429, 503)
+
+
+class CircuitOpenError(aiohttp.ClientConnectionError):
+    """
+    Request is not sent while the endpoint is down
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Opens after threshold consecutive failures of the endpoint. While open
+    requests fail at once, after reset_timeout a single probe request is
+    let through: the circuit closes if it succeeds and opens again if not
+    """
+
+    def __init__(self, threshold: int = FAILURE_THRESHOLD,
+                 reset_timeout: float = RESET_TIMEOUT):
+        self.threshold: int = threshold
+        self.reset_timeout: float = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened < self.reset_timeout:
+                return False
+            # the next probe is let through after another reset_timeout,
+            # so a probe lost to cancellation doesn't keep the circuit open
+            self._opened = now
+            self._probing = True
+            return True
+
+    def retry_in(self) -> float:
+        """
+        Returns seconds until the next probe request is let through
+        """
+        with self._lock:
+            if self._opened is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (
+                time.monotonic() - self._opened))
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                self._opened = time.monotonic()
+            self._probing = False
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint_url: str) -> CircuitBreaker:
+    """
+    Returns the circuit breaker of the endpoint shared by all runs
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint_url)
+        if breaker is None:
+            breaker = _breakers[endpoint_url] = CircuitBreaker()
+        return breaker
+
+
+def retry_after(exc) -> Optional[float]:
+    """
+    Returns delay in seconds requested by Retry-After header
+    """
+    headers = getattr(exc, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def is_transient(exc, idempotent: bool = True) -> bool:
+    if isinstance(exc, aiohttp.ClientResponseError):
+        statuses = _TRANSIENT_STATUSES if idempotent else (
+            _UNPROCESSED_STATUSES)
+        return exc.status in statuses
+    if idempotent:
+        return isinstance(exc, (aiohttp.ClientConnectionError,
+                                asyncio.TimeoutError))
+    # the request wasn't sent
+    return isinstance(exc, aiohttp.ClientConnectorError)
+
+
+def backoff(attempt: int, exc=None) -> float:
+    """
+    Returns exponential backoff delay with full jitter, Retry-After of the
+    response takes precedence. The delay is capped with MAX_BACKOFF
+    """
+    delay = retry_after(exc)
+    if delay is None:
+        delay = random.uniform(
+            0, BACKOFF_BASE * 2 ** min(attempt, MAX_BACKOFF_EXPONENT))
+    return min(MAX_BACKOFF, delay)
+
+
+async def with_retries(request, breaker: CircuitBreaker = None,
+                       idempotent: bool = True, attempts: int = None,
+                       wait_open: bool = False):
+    """
+    Awaits request() retrying transient errors. Failures are counted by the
+    breaker, requests fail with CircuitOpenError while it's open. With
+    wait_open attempts wait for the probe of the open circuit instead
+    """
+    attempts = attempts or RETRY_ATTEMPTS
+    for attempt in range(attempts):
+        if breaker is not None and not breaker.allow():
+            if not wait_open or attempt + 1 == attempts:
+                raise CircuitOpenError('Circuit is open, endpoint is down')
+            await asyncio.sleep(breaker.retry_in() or backoff(attempt))
+            continue
+        try:
+            result = await request()
+        except Exception as exc:
+            if breaker is not None:
+                if is_transient(exc):
+                    breaker.failure()
+                else:
+                    # the api is up and rejected the request
+                    breaker.success()
+            if attempt + 1 == attempts or not is_transient(exc, idempotent):
+                raise
+            await asyncio.sleep(backoff(attempt, exc))
+        else:
+            if breaker is not None:
+                breaker.success()
+            return result
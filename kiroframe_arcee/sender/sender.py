@@ -1,5 +1,7 @@
+import asyncio
 import aiohttp
 import threading
+import weakref
 
 from kiroframe_arcee.platform import CollectorFactory
 from kiroframe_arcee.collectors.command_line import (
@@ -8,6 +10,10 @@ from kiroframe_arcee.collectors.git import Collector as GitCollector
 from kiroframe_arcee.collectors.hardware import Collector as HardwareCollector
 from kiroframe_arcee.collectors.module import Collector as ImportsCollector
 from kiroframe_arcee.collectors.console import Collector as OutCollector
+from kiroframe_arcee.sender.encoding import dumps, encode_body
+from kiroframe_arcee.sender.retry import get_breaker, with_retries
+from kiroframe_arcee.sender.spool import placeholder
+from kiroframe_arcee.utils import default_loop
 
 
 def check_shutdown_flag_set(function):
@@ -21,22 +27,79 @@ def check_shutdown_flag_set(function):
 class Sender:
     # default Kiroframe url
     base_url = "https://my.kiroframe.com:443/arcee/v2"
-
-    def __init__(self, endpoint_url=None, ssl=True, shutdown_flag=None):
+    # pooled session of every event loop, shared by senders of all runs
+    _sessions = weakref.WeakKeyDictionary()
+    _sessions_lock = threading.Lock()
+    # platform meta doesn't change while the process is running
+    _platform_meta = None
+    # request timeouts in seconds by endpoint
+    timeouts = {
+        'default': 30,
+        'proc': 10,
+        'collect': 10,
+        'consoles': 60,
+        'dataset_use': 60,
+        'dataset_register': 600,
+        'files': 120,
+    }
+
+    def __init__(self, endpoint_url=None, ssl=True, shutdown_flag=None,
+                 spool=None, offline=False):
         if endpoint_url is None:
             endpoint_url = self.base_url
+        if offline and spool is None:
+            raise ValueError('Offline mode requires spool')
         self.endpoint_url = endpoint_url
         self.shutdown_flag = shutdown_flag or threading.Event()
         self.ssl = ssl
-
-    @staticmethod
-    async def m():
-        platform = await CollectorFactory.get()
-        return await platform().get_platform_meta()
+        # requests not returning data are appended to the spool shipped in
+        # background, offline senders never use the network
+        self.spool = spool
+        self.offline = offline
+        self.breaker = get_breaker(endpoint_url)
+
+    @classmethod
+    def _session(cls) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        with cls._sessions_lock:
+            session = cls._sessions.get(loop)
+            if session is None or session.closed:
+                session = aiohttp.ClientSession()
+                cls._sessions[loop] = session
+        return session
+
+    @classmethod
+    async def close(cls):
+        """
+        Closes pooled sessions. Sessions of other running loops are closed
+        on their loops
+        """
+        loop = asyncio.get_running_loop()
+        with cls._sessions_lock:
+            sessions = list(cls._sessions.items())
+            cls._sessions.clear()
+        for session_loop, session in sessions:
+            if session_loop is loop:
+                await session.close()
+            elif session_loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+                    session.close(), session_loop))
+
+    def _client(self) -> aiohttp.ClientSession:
+        if self.offline:
+            raise aiohttp.ClientConnectionError('Offline mode')
+        return self._session()
+
+    @classmethod
+    async def m(cls):
+        if cls._platform_meta is None:
+            platform = await CollectorFactory.get()
+            cls._platform_meta = await platform().get_platform_meta()
+        return cls._platform_meta
 
     @staticmethod
     async def _proc_data():
-        return await HardwareCollector.collect_stats()
+        return await HardwareCollector.shared_stats()
 
     @staticmethod
     async def _imports_data():
@@ -54,27 +117,111 @@ class Sender:
     async def _output():
         return await OutCollector.collect()
 
+    def _timeout(self, url) -> aiohttp.ClientTimeout:
+        """
+        Returns timeout of the endpoint: the last path segment of the url
+        having own timeout
+        """
+        path = url[len(self.endpoint_url):].split('?')[0]
+        for segment in reversed(path.split('/')):
+            if segment in self.timeouts:
+                return aiohttp.ClientTimeout(total=self.timeouts[segment])
+        return aiohttp.ClientTimeout(total=self.timeouts['default'])
+
     async def send_get_request(self, url, headers=None, params=None) -> dict:
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(
-                url, params=params, raise_for_status=True, ssl=self.ssl
+        async def request():
+            async with self._client().get(
+                url, headers=headers, params=params, raise_for_status=True,
+                ssl=self.ssl, timeout=self._timeout(url)
             ) as response:
                 return await response.json()
 
-    async def send_post_request(self, url, headers=None, data=None) -> dict:
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.post(
-                url, json=data, raise_for_status=True, ssl=self.ssl
+        return await with_retries(request, self.breaker)
+
+    async def send_request(self, method, url, headers=None,
+                           data=None, wait_open=False) -> dict:
+        """
+        Sends the request retrying transient errors. POST requests are
+        retried only if the api didn't process them. wait_open requests
+        wait for the endpoint to recover instead of failing at once
+        """
+        # the body is encoded once for all attempts
+        body, headers = await encode_body(data, headers)
+
+        async def request():
+            async with self._client().request(
+                method, url, headers=headers, data=body,
+                raise_for_status=True, ssl=self.ssl,
+                timeout=self._timeout(url)
             ) as response:
                 return await response.json()
 
-    async def send_patch_request(self, url, headers=None, data=None) -> dict:
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.patch(
-                url, json=data, raise_for_status=True, ssl=self.ssl
+        return await with_retries(request, self.breaker,
+                                  idempotent=method != 'POST',
+                                  wait_open=wait_open)
+
+    async def send_post_request(self, url, headers=None, data=None) -> dict:
+        return await self.send_request('POST', url, headers, data)
+
+    async def send_deferred_request(self, method, url, headers=None,
+                                    data=None, sync=False):
+        """
+        Sends the request, in spool mode appends it to the spool. sync
+        requests are not dropped: they fsync the spool at once or wait for
+        the endpoint to recover
+        """
+        if self.spool is None:
+            return await self.send_request(method, url, headers, data,
+                                           wait_open=sync)
+        await asyncio.to_thread(
+            self.spool.append, self.endpoint_url, url, method, headers,
+            data, self.ssl, sync=sync)
+
+    async def send_create_request(self, url, headers, data, id_key) -> dict:
+        """
+        Posts the request creating an entity. Offline the request is
+        appended to the spool and the entity gets a placeholder id
+        """
+        if not self.offline:
+            return await self.send_post_request(url, headers, data)
+        entity_id = placeholder()
+        await asyncio.to_thread(
+            self.spool.append, self.endpoint_url, url, 'POST', headers,
+            data, self.ssl, returns=(entity_id, id_key), sync=True)
+        return {id_key: entity_id}
+
+    async def send_post_stream_request(self, url, headers=None, data=None,
+                                       key=None, chunks=tuple) -> dict:
+        """
+        Posts data with the JSON array under the key streamed from chunks of
+        comma separated JSON objects, so the full body is never built.
+        chunks() returns new chunks for every attempt of the request
+        """
+        prefix = dumps(data or {})[:-1]
+        if data:
+            prefix += b','
+        prefix += dumps(key) + b':['
+
+        async def body():
+            yield prefix
+            for i, chunk in enumerate(chunks()):
+                if i:
+                    yield b','
+                yield chunk
+            yield b']}'
+
+        async def request():
+            async with self._client().post(
+                url, headers=headers, data=body(), raise_for_status=True,
+                ssl=self.ssl, timeout=self._timeout(url)
             ) as response:
                 return await response.json()
 
+        return await with_retries(request, self.breaker, idempotent=False)
+
+    async def send_patch_request(self, url, headers=None, data=None) -> dict:
+        return await self.send_request('PATCH', url, headers, data)
+
     @check_shutdown_flag_set
     async def get_run_id(self, task_key, token, run_name):
         uri = "%s/tasks/%s/run" % (self.endpoint_url, task_key)
@@ -85,53 +232,59 @@ class Sender:
             "command": await self._self_command(),
             "name": run_name
         }
-        return await self.send_post_request(uri, headers, data)
+        return await self.send_create_request(uri, headers, data, "id")
 
     @check_shutdown_flag_set
     async def add_milestone(self, run_id, token, value):
         uri = "%s/run/%s/milestones" % (self.endpoint_url, run_id)
         headers = {"x-api-key": token, "Content-Type": "application/json"}
-        return await self.send_post_request(uri, headers, {"milestone": value})
+        return await self.send_deferred_request(
+            "POST", uri, headers, {"milestone": value})
 
     @check_shutdown_flag_set
     async def add_tags(self, run_id, token, tags):
         uri = "%s/run/%s" % (self.endpoint_url, run_id)
         headers = {"x-api-key": token, "Content-Type": "application/json"}
-        return await self.send_patch_request(uri, headers, {"tags": tags})
+        return await self.send_deferred_request(
+            "PATCH", uri, headers, {"tags": tags})
 
     @check_shutdown_flag_set
     async def change_state(self, run_id, token, state, finish=False):
         uri = "%s/run/%s" % (self.endpoint_url, run_id)
         headers = {"x-api-key": token, "Content-Type": "application/json"}
-        return await self.send_patch_request(
-            uri, headers, {"state": state, "finish": finish}
+        return await self.send_deferred_request(
+            "PATCH", uri, headers, {"state": state, "finish": finish},
+            sync=True
         )
 
     @check_shutdown_flag_set
     async def create_stage(self, run_id, token, name):
         uri = "%s/run/%s/stages" % (self.endpoint_url, run_id)
         headers = {"x-api-key": token, "Content-Type": "application/json"}
-        return await self.send_post_request(uri, headers, {"stage": name})
+        return await self.send_deferred_request(
+            "POST", uri, headers, {"stage": name})
 
     @check_shutdown_flag_set
     async def send_stats(self, token, data):
         headers = {"x-api-key": token, "Content-Type": "application/json"}
         meta = await self.m()
         data.update({"platform": meta.to_dict()})
-        await self.send_post_request(
-            "%s/%s" % (self.endpoint_url, "collect"), headers, data
+        await self.send_deferred_request(
+            "POST", "%s/%s" % (self.endpoint_url, "collect"), headers, data
         )
 
     @check_shutdown_flag_set
-    async def send_proc_data(self, run_id, token):
-        uri = "%s/run/%s/proc" % (self.endpoint_url, run_id)
-        headers = {"x-api-key": token, "Content-Type": "application/json"}
-        data = dict()
+    async def collect_proc_data(self):
         meta = await self.m()
         proc = await self._proc_data()
-        data.update({"platform": meta.to_dict()})
-        data.update({"proc_stats": proc})
-        return await self.send_post_request(uri, headers, data)
+        return {"platform": meta.to_dict(), "proc_stats": proc}
+
+    async def send_proc_data(self, run_id, token, data=None):
+        uri = "%s/run/%s/proc" % (self.endpoint_url, run_id)
+        headers = {"x-api-key": token, "Content-Type": "application/json"}
+        if data is None:
+            data = await self.collect_proc_data()
+        return await self.send_deferred_request("POST", uri, headers, data)
 
     @staticmethod
     def generate_description(task_key, run_name, run_id):
@@ -139,7 +292,7 @@ class Sender:
 
     @check_shutdown_flag_set
     async def register_dataset(self, token, run_id, run_name, task_key, body,
-                               comment=None):
+                               comment=None, files=None):
         uri = f"{self.endpoint_url}/run/{run_id}/dataset_register"
         headers = {"x-api-key": token, "Content-Type": "application/json"}
         if 'description' not in body:
@@ -147,21 +300,43 @@ class Sender:
                 task_key, run_name, run_id)
         if comment:
             body['comment'] = comment
+        if files is not None:
+            return await self.send_post_stream_request(
+                uri, headers, body, 'files', files)
         return await self.send_post_request(uri, headers, body)
 
     @check_shutdown_flag_set
-    async def use_dataset(self, token, run_id, dataset: str, comment=None):
+    async def use_dataset(self, token, run_id, dataset: str, comment=None,
+                          etag=None):
+        """
+        Returns the used dataset version and its ETag. The version is None
+        if it wasn't changed since the etag
+        """
         uri = f"{self.endpoint_url}/run/{run_id}/dataset_use"
         headers = {"x-api-key": token, "Content-Type": "application/json"}
-        return await self.send_post_request(
-            uri, headers, {"dataset": dataset, "comment": comment})
+        if etag:
+            headers["If-None-Match"] = etag
+        body, headers = await encode_body(
+            {"dataset": dataset, "comment": comment}, headers)
+
+        async def request():
+            async with self._client().post(
+                uri, headers=headers, data=body, ssl=self.ssl,
+                timeout=self._timeout(uri)
+            ) as response:
+                if etag and response.status == 304:
+                    return None, etag
+                response.raise_for_status()
+                return await response.json(), response.headers.get("ETag")
+
+        return await with_retries(request, self.breaker, idempotent=False)
 
     @check_shutdown_flag_set
     async def add_hyperparams(self, run_id, token, hyperparams):
         uri = "%s/run/%s" % (self.endpoint_url, run_id)
         headers = {"x-api-key": token, "Content-Type": "application/json"}
-        return await self.send_patch_request(
-            uri, headers, {"hyperparameters": hyperparams}
+        return await self.send_deferred_request(
+            "PATCH", uri, headers, {"hyperparameters": hyperparams}
         )
 
     async def send_console(self, run_id, token):
@@ -169,13 +344,13 @@ class Sender:
         headers = {"x-api-key": token, "Content-Type": "application/json"}
 
         data = await self._output()
-        await self.send_post_request(uri, headers, data)
+        await self.send_deferred_request("POST", uri, headers, data)
 
     @check_shutdown_flag_set
     async def add_model(self, token, key):
         headers = {"x-api-key": token, "Content-Type": "application/json"}
-        model = await self.send_post_request(
-            self.endpoint_url + '/models', headers, {"key": key}
+        model = await self.send_create_request(
+            self.endpoint_url + '/models', headers, {"key": key}, '_id'
         )
         return model.get('_id')
 
@@ -184,13 +359,13 @@ class Sender:
         headers = {"x-api-key": token, "Content-Type": "application/json"}
         uri = f'{self.endpoint_url}/runs/{run_id}/models/{model_id}/version'
         body = {'path': path} if path else {}
-        await self.send_post_request(uri, headers, body)
+        await self.send_deferred_request('POST', uri, headers, body)
 
     @check_shutdown_flag_set
     async def patch_model_version(self, run_id, model_id, token, params):
         headers = {"x-api-key": token, "Content-Type": "application/json"}
         uri = f'{self.endpoint_url}/runs/{run_id}/models/{model_id}/version'
-        await self.send_patch_request(uri, headers, params)
+        await self.send_deferred_request('PATCH', uri, headers, params)
 
     async def add_version(self, run_id, model_id, token, version):
         body = {'version': str(version)}
@@ -219,23 +394,26 @@ class Sender:
         body['description'] = description
         if tags:
             body['tags'] = tags
-        artifact = await self.send_post_request(
-            self.endpoint_url + '/artifacts', headers, body
+        artifact = await self.send_create_request(
+            self.endpoint_url + '/artifacts', headers, body, '_id'
         )
         return artifact.get('_id'), path, tags or {}
 
     async def add_artifact_tags(self, token, artifacts, path, key, value):
-        headers = {"x-api-key": token, "Content-Type": "application/json"}
         artifact = artifacts.get(path)
         if not artifact:
             raise ValueError("Artifact doesn't exists."
                              "Use arcee.artifact() to create one")
         artifact['tags'][key] = value
-        body = {'tags': artifact['tags']}
-        uri = f'{self.endpoint_url}/artifacts/{artifact["id"]}'
-        await self.send_patch_request(uri, headers, body)
+        await self.update_artifact_tags(
+            token, artifact["id"], artifact['tags'])
         return artifact["id"], path, artifact['tags']
 
+    async def update_artifact_tags(self, token, artifact_id, tags):
+        headers = {"x-api-key": token, "Content-Type": "application/json"}
+        uri = f'{self.endpoint_url}/artifacts/{artifact_id}'
+        await self.send_deferred_request('PATCH', uri, headers, {'tags': tags})
+
     @check_shutdown_flag_set
     async def update_file_meta(self, file_id, token, meta):
         uri = "%s/file/%s" % (self.endpoint_url, file_id)
@@ -243,3 +421,22 @@ class Sender:
         return await self.send_patch_request(
             uri, headers, {"meta": meta}
         )
+
+    @check_shutdown_flag_set
+    async def update_files_meta(self, token, files):
+        uri = "%s/files" % self.endpoint_url
+        headers = {"x-api-key": token, "Content-Type": "application/json"}
+        return await self.send_patch_request(
+            uri, headers, {"files": files}
+        )
+
+
+# pooled sessions are closed before the background loop is stopped at exit
+default_loop.on_stop(Sender.close)
+
+
+def set_request_timeouts(**timeouts):
+    """
+    Sets request timeouts in seconds by endpoint, e.g. default=30, proc=10
+    """
+    Sender.timeouts = dict(Sender.timeouts, **timeouts)
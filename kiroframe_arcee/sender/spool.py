@@ -0,0 +1,392 @@
+import os
+import json
+import gzip
+import time
+import uuid
+import asyncio
+import itertools
+import threading
+from typing import Iterator, Optional
+
+import aiohttp
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
+from kiroframe_arcee.sender.encoding import dumps, encode_body
+from kiroframe_arcee.sender.retry import get_breaker, with_retries
+
+SPOOL_PATH = 'kiroframe/spool/'
+_MB: int = 1_024 * 1_024
+# active segment is sealed and compressed once it reaches the size
+SEGMENT_SIZE: int = 8 * _MB
+# appended records are fsynced at most once per interval, state changes
+# are fsynced at once
+FSYNC_INTERVAL: float = 0.2
+# shipped records between checkpoints, records creating entities are
+# checkpointed at once
+CHECKPOINT_BATCH: int = 100
+SHIP_INTERVAL: float = 0.5
+MAX_SHIP_DELAY: float = 30.0
+DRAIN_TIMEOUT: float = 30.0
+PLACEHOLDER_PREFIX = 'offline-'
+_SEGMENT = '.log'
+_COMPRESSED = '.log.gz'
+_CHECKPOINT = 'checkpoint.json'
+_LOCK = 'lock'
+
+
+def placeholder() -> str:
+    """
+    Returns id of the entity created in offline mode. Placeholders are
+    replaced with real ids when the spool is shipped
+    """
+    return PLACEHOLDER_PREFIX + uuid.uuid4().hex
+
+
+def _lock_exclusive(f):
+    """
+    Locks the file without blocking, raises OSError if it's locked
+    """
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        import msvcrt
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def _is_permanent(exc) -> bool:
+    # requests rejected by the api are never shipped successfully
+    if not isinstance(exc, aiohttp.ClientResponseError):
+        return False
+    return 400 <= exc.status < 500 and exc.status not in (408, 429)
+
+
+class Spool(object):
+    """
+    Durable log of outgoing requests. Records are appended to the active
+    segment, sealed segments are compressed. Shipped records are tracked
+    with the checkpoint, so shipping resumes after restarts. The spool
+    directory is used by one process at once
+    """
+
+    def __init__(self, path: str = SPOOL_PATH):
+        self.path: str = path
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, _LOCK), 'w')
+        try:
+            _lock_exclusive(self._lock_file)
+        except OSError:
+            self._lock_file.close()
+            raise ValueError('Spool %s is used by another process' % path)
+        self._lock = threading.Lock()
+        self._shipping = threading.Lock()
+        self._synced = time.monotonic()
+        self._shipper = None
+        self.checkpoint: dict = self._load_checkpoint()
+        segments = self._segments()
+        for start, name in segments[:-1]:
+            if name.endswith(_SEGMENT):
+                self._compress(name)
+        self.last_seq: int = self.checkpoint['seq']
+        self._file = None
+        if segments and segments[-1][1].endswith(_SEGMENT):
+            self._open_tail(segments[-1][1])
+        elif segments:
+            for record in self._read(segments[-1][1]):
+                self.last_seq = max(self.last_seq, record['seq'])
+
+    def _segments(self):
+        """
+        Returns sorted (first seq, file name) of segments
+        """
+        segments = dict()
+        for name in os.listdir(self.path):
+            for suffix in (_COMPRESSED, _SEGMENT):
+                if name.endswith(suffix):
+                    start = int(name[:-len(suffix)])
+                    # compressed copy wins over the segment being removed
+                    if suffix == _COMPRESSED or start not in segments:
+                        segments[start] = name
+                    break
+        return sorted(segments.items())
+
+    def _open_tail(self, name):
+        """
+        Opens the last segment for appending, the record torn by a crash
+        is truncated
+        """
+        path = os.path.join(self.path, name)
+        good = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                self.last_seq = max(self.last_seq, record['seq'])
+        self._file = open(path, 'ab')
+        self._file.truncate(good)
+
+    def _new_segment(self):
+        path = os.path.join(self.path, '%020d%s' % (
+            self.last_seq + 1, _SEGMENT))
+        self._file = open(path, 'ab')
+
+    def _compress(self, name):
+        path = os.path.join(self.path, name)
+        dest = path[:-len(_SEGMENT)] + _COMPRESSED
+        tmp_path = dest + '.tmp'
+        try:
+            with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                while True:
+                    chunk = src.read(_MB)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, dest)
+            os.remove(path)
+        except FileNotFoundError:
+            # the segment was shipped and removed meanwhile
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _read(self, name) -> Iterator[dict]:
+        path = os.path.join(self.path, name)
+        opener = gzip.open if name.endswith(_COMPRESSED) else open
+        try:
+            with opener(path, 'rb') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # the tail being appended
+                        return
+        except FileNotFoundError:
+            if name.endswith(_SEGMENT):
+                # the segment has been compressed meanwhile
+                yield from self._read(name[:-len(_SEGMENT)] + _COMPRESSED)
+
+    def append(self, endpoint_url: str, url: str, method: str,
+               headers: dict = None, data=None, ssl: bool = True,
+               returns: tuple = None, sync: bool = False) -> int:
+        """
+        Appends the request. returns is (placeholder, key) of the entity
+        id in the response of requests creating entities offline
+        """
+        record = {
+            'method': method,
+            'endpoint': endpoint_url,
+            'path': url[len(endpoint_url):] if url.startswith(
+                endpoint_url) else url,
+            'headers': headers,
+            'body': data,
+            'ssl': ssl,
+        }
+        if returns:
+            record['returns'] = list(returns)
+        with self._lock:
+            if self._file is None:
+                self._new_segment()
+            self.last_seq += 1
+            record['seq'] = self.last_seq
+            self._file.write(dumps(record) + b'\n')
+            self._file.flush()
+            now = time.monotonic()
+            if sync or now - self._synced >= FSYNC_INTERVAL:
+                os.fsync(self._file.fileno())
+                self._synced = now
+            if self._file.tell() >= SEGMENT_SIZE:
+                self._seal()
+            return self.last_seq
+
+    def _seal(self):
+        os.fsync(self._file.fileno())
+        name = os.path.basename(self._file.name)
+        self._file.close()
+        self._file = None
+        threading.Thread(target=self._compress, args=(name, ),
+                         daemon=True).start()
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._synced = time.monotonic()
+
+    def records(self, after: int = 0) -> Iterator[dict]:
+        """
+        Yields records with seq greater than after
+        """
+        segments = self._segments()
+        for i, (start, name) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= after + 1:
+                continue
+            for record in self._read(name):
+                if record['seq'] > after:
+                    yield record
+
+    def _load_checkpoint(self) -> dict:
+        try:
+            with open(os.path.join(self.path, _CHECKPOINT)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'seq': 0, 'ids': {}}
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.path, _CHECKPOINT)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._remove_shipped()
+
+    def _remove_shipped(self):
+        segments = self._segments()
+        active = self._file and os.path.basename(self._file.name)
+        for (_, name), (start, _) in zip(segments, segments[1:]):
+            if start - 1 <= self.checkpoint['seq'] and name != active:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+
+    def _resolve(self, value: str) -> str:
+        for key, real in self.checkpoint['ids'].items():
+            value = value.replace(key, real)
+        return value
+
+    async def _ship_record(self, session, record, endpoint_url=None):
+        endpoint_url = endpoint_url or record['endpoint']
+        url = self._resolve(endpoint_url + record['path'])
+        body = record['body']
+        if self.checkpoint['ids'] and body is not None:
+            body = json.loads(self._resolve(json.dumps(body)))
+        body, headers = await encode_body(body, record['headers'])
+
+        async def request():
+            async with session.request(
+                record['method'], url, headers=headers, data=body,
+                raise_for_status=True, ssl=record['ssl']
+            ) as response:
+                if record.get('returns'):
+                    key, id_key = record['returns']
+                    result = await response.json()
+                    self.checkpoint['ids'][key] = result[id_key]
+
+        # the shipper backs off itself, the breaker keeps it from sending
+        # while the endpoint is down
+        await with_retries(request, get_breaker(endpoint_url), attempts=1)
+
+    async def ship(self, session: aiohttp.ClientSession,
+                   endpoint_url: str = None) -> int:
+        """
+        Sends records after the checkpoint in order, returns the number of
+        shipped records. Records rejected by the api are skipped, other
+        errors stop shipping. Delivery is at least once: records shipped
+        after the last checkpoint are shipped again after a crash
+        """
+        shipped = 0
+        if not self._shipping.acquire(blocking=False):
+            # shipped by another caller
+            return shipped
+        try:
+            # segments are read and the checkpoint is fsynced in threads,
+            # so the loop shared with the runs isn't blocked
+            records = self.records(self.checkpoint['seq'])
+            while True:
+                batch = await asyncio.to_thread(
+                    list, itertools.islice(records, CHECKPOINT_BATCH))
+                if not batch:
+                    break
+                for record in batch:
+                    try:
+                        await self._ship_record(
+                            session, record, endpoint_url)
+                    except Exception as exc:
+                        if not _is_permanent(exc):
+                            raise
+                    self.checkpoint['seq'] = record['seq']
+                    shipped += 1
+                    # entities must not be created twice
+                    if record.get('returns') or (
+                            shipped % CHECKPOINT_BATCH == 0):
+                        await asyncio.to_thread(self._save_checkpoint)
+        finally:
+            if shipped:
+                await asyncio.to_thread(self._save_checkpoint)
+            self._shipping.release()
+        return shipped
+
+    @property
+    def pending(self) -> int:
+        return self.last_seq - self.checkpoint['seq']
+
+    def start_shipper(self, loop):
+        """
+        Starts shipping records in background on the loop thread
+        """
+        with self._lock:
+            if self._shipper is None:
+                self._shipper = loop.submit(self._ship_forever())
+
+    async def _ship_forever(self):
+        from kiroframe_arcee.sender.sender import Sender
+
+        delay = SHIP_INTERVAL
+        while True:
+            if self.pending:
+                try:
+                    await self.ship(Sender._session())
+                    delay = SHIP_INTERVAL
+                except Exception:
+                    delay = min(MAX_SHIP_DELAY, delay * 2)
+            await asyncio.sleep(delay)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """
+        Waits until records appended so far are shipped
+        """
+        seq = self.last_seq
+        deadline = time.monotonic() + timeout
+        while self.checkpoint['seq'] < seq:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def close(self):
+        with self._lock:
+            shipper, self._shipper = self._shipper, None
+            if shipper is not None:
+                shipper.cancel()
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+        self._lock_file.close()
+
+
+_spools = dict()
+_spools_lock = threading.Lock()
+
+
+def get_spool(path: Optional[str] = None) -> Spool:
+    """
+    Returns the spool of the directory shared by runs of the process
+    """
+    key = os.path.abspath(path or SPOOL_PATH)
+    with _spools_lock:
+        spool = _spools.get(key)
+        if spool is None:
+            spool = _spools[key] = Spool(path or SPOOL_PATH)
+        return spool
@@ -1,19 +1,16 @@
+import argparse
 import asyncio
+import atexit
+import dataclasses
+import hashlib
+import sys
+import threading
+import types
+from collections.abc import Mapping
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 
-def single(class_):
-    instances = {}
-
-    def get_instance(*args, **kwargs):
-        if class_ not in instances:
-            instances[class_] = class_(*args, **kwargs)
-        return instances[class_]
-
-    return get_instance
-
-
 async def run_async(func, *args, loop=None, executor=None, **kwargs):
     if loop is None:
         loop = asyncio.get_event_loop()
@@ -21,3 +18,119 @@ async def run_async(func, *args, loop=None, executor=None, **kwargs):
         executor = ThreadPoolExecutor(max_workers=10)
     pfunc = partial(func, *args, **kwargs)
     return await loop.run_in_executor(executor, pfunc)
+
+
+def md5():
+    if sys.version_info >= (3, 9):
+        return hashlib.md5(usedforsecurity=False)
+    return hashlib.md5()
+
+
+class LoopThread(object):
+    """
+    Event loop running forever on a daemon thread. Coroutines of the sync
+    api are run on it, so the sync api works inside running event loops
+    and shares connections of the loop between the calls
+    """
+
+    def __init__(self, name: str = 'kiroframe'):
+        self.name: str = name
+        self._lock = threading.Lock()
+        self._loop = None
+        self._on_stop = list()
+
+    def on_stop(self, func):
+        """
+        Registers coroutine function run on the loop before it's stopped
+        """
+        self._on_stop.append(func)
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run, args=(loop, ),
+                                 daemon=True, name=self.name).start()
+                self._loop = loop
+                atexit.register(self.stop)
+        return self._loop
+
+    @staticmethod
+    def _run(loop):
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def submit(self, coro):
+        """
+        Schedules the coroutine on the loop, returns concurrent future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """
+        Runs the coroutine on the loop and waits for the result
+        """
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError(
+                'Sync api cannot be called from the kiroframe loop')
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def stop(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        for func in self._on_stop:
+            try:
+                asyncio.run_coroutine_threadsafe(func(), loop).result()
+            except Exception:
+                pass
+        loop.call_soon_threadsafe(loop.stop)
+
+
+default_loop = LoopThread()
+
+
+def run_sync(coro):
+    """
+    Runs the coroutine of the sync api on the shared background loop
+    """
+    return default_loop.run(coro)
+
+
+def _config_items(config):
+    if dataclasses.is_dataclass(config) and not isinstance(config, type):
+        return {f.name: getattr(config, f.name)
+                for f in dataclasses.fields(config)}
+    if isinstance(config, Mapping):
+        return config
+    if isinstance(config, (argparse.Namespace, types.SimpleNamespace)):
+        return vars(config)
+    return None
+
+
+def flatten_config(config, prefix: str = '') -> dict:
+    """
+    Flattens dict, dataclass or namespace config, keys of nested configs
+    are joined with dots
+    """
+    items = _config_items(config)
+    if items is None:
+        raise TypeError('Unsupported config type: %s' % type(config))
+    result = dict()
+    for key, value in items.items():
+        name = '%s%s' % (prefix, key)
+        if _config_items(value) is None:
+            result[name] = value
+        else:
+            result.update(flatten_config(value, name + '.'))
+    return result
@@ -0,0 +1,131 @@
+import os
+import asyncio
+import tempfile
+import threading
+import unittest
+from aiohttp import web
+from aiounittest import AsyncTestCase
+
+import kiroframe_arcee as kiro
+from kiroframe_arcee.modules.dataset import Dataset
+from kiroframe_arcee.modules.snapshots import SnapshotStore
+from kiroframe_arcee.sender.sender import Sender
+
+
+class ApiServer:
+    """
+    Api stand-in running on its own loop thread, so sync calls blocking
+    the test loop are served
+    """
+
+    def __init__(self, response=None):
+        self.requests = []
+        self.response = response or {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+
+    async def _handler(self, request):
+        peer = request.transport.get_extra_info('peername')
+        self.requests.append(
+            (request.method, request.path, await request.json(), peer[1]))
+        return web.json_response(self.response)
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self._handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        return self._runner.addresses[0][1]
+
+    def __enter__(self):
+        self._thread.start()
+        port = asyncio.run_coroutine_threadsafe(
+            self._start(), self._loop).result()
+        self.url = 'http://127.0.0.1:%s' % port
+        return self
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(
+            self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def started_run(url, run_id='run'):
+    run = kiro.Run('token', 'task', endpoint_url=url)
+    run.run = run_id
+    return run
+
+
+async def sent(run):
+    # requests queued by the run are sent in background
+    await run.outbox.drain(5)
+    run.outbox.close()
+
+
+class TestAio(AsyncTestCase):
+    async def test_pooled_session(self):
+        with ApiServer() as server:
+            sender = Sender(server.url)
+            try:
+                for value in ('first', 'second'):
+                    await sender.add_milestone('run', 'token', value)
+            finally:
+                await sender.close()
+        self.assertEqual([r[2] for r in server.requests],
+                         [{'milestone': 'first'}, {'milestone': 'second'}])
+        # both requests were sent over the same connection
+        self.assertEqual(len({r[3] for r in server.requests}), 1)
+
+    async def test_sync_in_running_loop(self):
+        with ApiServer() as server:
+            with started_run(server.url).activate() as run:
+                await kiro.aio.milestone('async')
+                # asyncio.run used to fail inside running loops
+                kiro.milestone('sync')
+                kiro.stage('stage')
+            await sent(run)
+            await Sender.close()
+        self.assertEqual(
+            [r[:3] for r in server.requests],
+            [('POST', '/run/run/milestones', {'milestone': 'async'}),
+             ('POST', '/run/run/milestones', {'milestone': 'sync'}),
+             ('POST', '/run/run/stages', {'stage': 'stage'})])
+
+    async def test_use_pinned_dataset(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, ApiServer() as server:
+            os.chdir(tmp)
+            try:
+                SnapshotStore().save('test:V3', Dataset.from_response({
+                    'key': 'test', 'version': {'version': 3, 'files': []}}))
+                with started_run(server.url).activate() as run:
+                    dataset = await kiro.aio.use_dataset('test:V3')
+                    # the usage is queued with the run requests and sent
+                    # before the run finishes
+                    await sent(run)
+                await Sender.close()
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(dataset._version, 3)
+        self.assertEqual([r[:3] for r in server.requests], [
+            ('POST', '/run/run/dataset_use',
+             {'dataset': 'test:V3', 'comment': None})])
+
+    async def test_use_dataset_finished(self):
+        run = started_run('http://localhost')
+        run.shutdown_flag.set()
+        with run.activate():
+            with self.assertRaisesRegex(RuntimeError, 'Run is finished'):
+                await kiro.aio.use_dataset('unknown:V1')
+
+
+class TestRunSync(unittest.TestCase):
+    def test_result(self):
+        async def value():
+            return 42
+
+        self.assertEqual(kiro.utils.run_sync(value()), 42)
@@ -0,0 +1,287 @@
+import os
+import asyncio
+import tempfile
+from aiounittest import AsyncTestCase
+from botocore.exceptions import ClientError
+from unittest.mock import patch
+
+from kiroframe_arcee.modules.providers import amazon
+from kiroframe_arcee.utils import md5
+
+
+class FakeBody:
+    def __init__(self, data):
+        self._data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self, amt=None):
+        chunk, self._data = self._data[:amt], self._data[amt:]
+        return chunk
+
+
+class FakeS3:
+    def __init__(self, data, etag, fail_ranges=0):
+        self.data = data
+        self.etag = etag
+        self.fail_ranges = fail_ranges
+        self.ranges = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def head_object(self, Bucket, Key, PartNumber=None):
+        return {'ETag': '"%s"' % self.etag, 'ContentLength': len(self.data)}
+
+    async def get_object(self, Bucket, Key, IfMatch, Range):
+        if IfMatch != '"%s"' % self.etag:
+            raise ClientError(
+                {'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        if self.fail_ranges and len(self.ranges) >= self.fail_ranges:
+            raise ConnectionError('connection reset')
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        self.ranges.append(start)
+        return {'Body': FakeBody(self.data[start:end + 1])}
+
+
+class FakeSession:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def client(self, *args, **kwargs):
+        return self.s3
+
+
+class LocalS3:
+    """
+    In-memory S3 stand-in storing objects with their parts
+    """
+
+    def __init__(self):
+        self.objects = dict()
+        self.uploads = dict()
+        self.requests = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    @staticmethod
+    def _md5(data):
+        digest = md5()
+        digest.update(data)
+        return digest.hexdigest()
+
+    async def head_object(self, Bucket, Key, PartNumber=None):
+        self.requests.append('head_object')
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        etag, parts = self.objects[(Bucket, Key)]
+        part = parts[PartNumber - 1] if PartNumber else b''.join(parts)
+        return {'ETag': '"%s"' % etag, 'ContentLength': len(part)}
+
+    async def get_object(self, Bucket, Key, IfMatch, Range):
+        etag, parts = self.objects[(Bucket, Key)]
+        if IfMatch != '"%s"' % etag:
+            raise ClientError(
+                {'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        return {'Body': FakeBody(b''.join(parts)[start:end + 1])}
+
+    async def put_object(self, Bucket, Key, Body, ContentMD5):
+        self.requests.append('put_object')
+        etag = self._md5(Body)
+        self.objects[(Bucket, Key)] = etag, [Body]
+        return {'ETag': '"%s"' % etag}
+
+    async def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = dict()
+        return {'UploadId': upload_id}
+
+    async def upload_part(self, Bucket, Key, UploadId, PartNumber, Body,
+                          ContentMD5):
+        self.requests.append('upload_part')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"%s"' % self._md5(Body)}
+
+    async def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                        MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        data = [parts[p['PartNumber']] for p in MultipartUpload['Parts']]
+        etag = amazon._composite_digest([self._md5(d) for d in data])
+        self.objects[(Bucket, Key)] = etag, data
+        return {'ETag': '"%s"' % etag}
+
+    async def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+class S3TestCase(AsyncTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name + '/'
+        self.data = os.urandom(10 * 1024 + 7)
+        digest = md5()
+        digest.update(self.data)
+        self.digest = digest.hexdigest()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class TestRangedDownload(S3TestCase):
+    async def _download(self, s3, part_size=1024):
+        with patch.object(amazon.aioboto3, 'Session',
+                          return_value=FakeSession(s3)):
+            await amazon.download('s3://bucket/key', self.digest, self.dest,
+                                  'file', part_size=part_size, concurrency=4)
+
+    async def test_download(self):
+        s3 = FakeS3(self.data, self.digest)
+        await self._download(s3)
+        with open(self.dest + 'file', 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(len(s3.ranges), 11)
+        self.assertEqual(os.listdir(self.dest), ['file'])
+
+    async def test_resume(self):
+        s3 = FakeS3(self.data, self.digest, fail_ranges=4)
+        with self.assertRaises(ConnectionError):
+            await self._download(s3)
+        self.assertTrue(os.path.exists(
+            self.dest + 'file' + amazon.STATE_SUFFIX))
+        s3 = FakeS3(self.data, self.digest)
+        await self._download(s3)
+        self.assertEqual(len(s3.ranges), 7)
+        with open(self.dest + 'file', 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    async def test_changed_source(self):
+        s3 = FakeS3(self.data, 'other')
+        with self.assertRaises(ValueError):
+            await self._download(s3)
+
+
+class TestRangeReader(S3TestCase):
+    def test_read(self):
+        s3 = FakeS3(self.data, self.digest)
+        with patch.object(amazon.aioboto3, 'Session',
+                          return_value=FakeSession(s3)):
+            f = amazon.open_file('s3://bucket/key', self.digest,
+                                 len(self.data), readahead=4096)
+        with f:
+            f.seek(5000)
+            self.assertEqual(f.read(10), self.data[5000:5010])
+            f.seek(0)
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(s3.ranges, [5000, 0, 8192])
+
+    async def test_read_in_running_loop(self):
+        s3 = FakeS3(self.data, self.digest)
+        with patch.object(amazon.aioboto3, 'Session',
+                          return_value=FakeSession(s3)):
+            f = amazon.open_file('s3://bucket/key', self.digest,
+                                 len(self.data))
+        with f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_changed_source(self):
+        s3 = FakeS3(self.data, self.digest)
+        with patch.object(amazon.aioboto3, 'Session',
+                          return_value=FakeSession(s3)):
+            f = amazon.open_file('s3://bucket/key', 'other', len(self.data))
+        with f:
+            self.assertRaises(ValueError, f.read)
+
+
+class TestLocalDigest(S3TestCase):
+    def test_multipart(self):
+        data = os.urandom(2 * amazon._MB + 5)
+        path = self.dest + 'file'
+        with open(path, 'wb') as f:
+            f.write(data)
+        parts = []
+        for offset in range(0, len(data), amazon._MB):
+            digest = md5()
+            digest.update(data[offset:offset + amazon._MB])
+            parts.append(digest.hexdigest())
+        etag = amazon._composite_digest(parts)
+        self.assertEqual(amazon.local_digest(path, etag), etag)
+        self.assertIsNone(amazon.local_digest(path, 'etag-7'))
+        digest = md5()
+        digest.update(data)
+        self.assertEqual(amazon.local_digest(path, digest.hexdigest()),
+                         digest.hexdigest())
+        # opaque etags can't be rebuilt locally
+        self.assertIsNone(amazon.local_digest(path, 'other'))
+        self.assertIsNone(amazon.local_digest(path, '5e8a1b2c-3e8'))
+
+
+class TestUpload(S3TestCase):
+    async def _upload(self, s3, path, digest, part_size):
+        with patch.object(amazon.aioboto3, 'Session',
+                          return_value=FakeSession(s3)):
+            return await amazon.upload(path, digest, 's3://bucket/key',
+                                       part_size=part_size, concurrency=4)
+
+    async def test_upload(self):
+        path = self.dest + 'file'
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        for part_size, etag in ((1024 * 1024, self.digest),
+                                (1024, None)):
+            s3 = LocalS3()
+            uploaded = await self._upload(s3, path, self.digest, part_size)
+            if etag:
+                self.assertEqual(uploaded, etag)
+            else:
+                self.assertTrue(uploaded.endswith('-11'))
+            self.assertEqual(b''.join(s3.objects[('bucket', 'key')][1]),
+                             self.data)
+            s3.requests.clear()
+            self.assertEqual(
+                await self._upload(s3, path, self.digest, part_size),
+                uploaded)
+            self.assertNotIn('put_object', s3.requests)
+            self.assertNotIn('upload_part', s3.requests)
+
+    async def test_upload_buffer(self):
+        path = self.dest + 'file'
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        peak = []
+        pread = amazon._pread
+
+        def counted(fd, length, offset):
+            peak.append(amazon._upload_buffers.used)
+            return pread(fd, length, offset)
+
+        with patch.object(amazon, 'UPLOAD_BUFFER', 2048), \
+                patch.object(amazon, '_pread', side_effect=counted):
+            await asyncio.gather(*(
+                self._upload(LocalS3(), path, self.digest, 1024)
+                for _ in range(3)))
+        self.assertLessEqual(max(peak), 2048)
+        self.assertEqual(amazon._upload_buffers.used, 0)
+
+    async def test_changed_source(self):
+        path = self.dest + 'file'
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        for part_size in (1024 * 1024, 1024):
+            s3 = LocalS3()
+            with self.assertRaises(ValueError):
+                await self._upload(s3, path, 'other', part_size)
+            # nothing is published, the multipart upload is aborted
+            self.assertEqual(s3.objects, {})
+            self.assertEqual(s3.uploads, {})
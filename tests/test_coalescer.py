@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import unittest
+from dataclasses import dataclass, field
+from aiounittest import AsyncTestCase
+
+import kiroframe_arcee as kiro
+from kiroframe_arcee.sender.coalescer import WriteCoalescer
+from kiroframe_arcee.sender.sender import Sender
+from kiroframe_arcee.utils import flatten_config, run_sync
+from tests.test_aio import ApiServer, started_run
+
+
+class Recorder:
+    def __init__(self, fail=False, delay=0):
+        self.sent = []
+        self.fail = fail
+        self.delay = delay
+
+    async def __call__(self, values):
+        fail = self.fail
+        await asyncio.sleep(self.delay)
+        if fail:
+            raise ConnectionError('unreachable')
+        self.sent.append(values)
+
+
+class TestWriteCoalescer(AsyncTestCase):
+    async def test_merged(self):
+        writes = WriteCoalescer(interval=0.01)
+        send = Recorder()
+        for i in range(10):
+            writes.update('tags', send, {'key%s' % (i % 3): i})
+        await asyncio.sleep(0.2)
+        self.assertEqual(send.sent, [{'key0': 9, 'key1': 7, 'key2': 8}])
+        # unchanged values are not sent again
+        writes.update('tags', send, {'key0': 9})
+        await writes.flush()
+        self.assertEqual(len(send.sent), 1)
+
+    async def test_failed(self):
+        writes = WriteCoalescer(interval=60)
+        send = Recorder(fail=True)
+        writes.update('tags', send, {'key': 1})
+        with self.assertRaises(ConnectionError):
+            await writes.flush()
+        send.fail = False
+        await writes.flush()
+        writes.cancel()
+        self.assertEqual(send.sent, [{'key': 1}])
+
+    async def test_close(self):
+        writes = WriteCoalescer(interval=0.01)
+        send = Recorder(fail=True, delay=0.1)
+        writes.update('tags', send, {'key': 1})
+        await asyncio.sleep(0.05)
+        # the flush in flight fails, close waits for it and sends again
+        send.fail = False
+        await writes.close()
+        self.assertEqual(send.sent, [{'key': 1}])
+        writes.update('tags', send, {'key': 2})
+        await asyncio.sleep(0.05)
+        self.assertEqual(send.sent, [{'key': 1}])
+
+
+@dataclass
+class Optimizer:
+    name: str = 'adam'
+    betas: tuple = (0.9, 0.999)
+
+
+@dataclass
+class Config:
+    epochs: int = 10
+    optimizer: Optimizer = field(default_factory=Optimizer)
+
+
+class TestFlattenConfig(unittest.TestCase):
+    def test_nested(self):
+        config = argparse.Namespace(
+            model=Config(), data={'path': 's3://bucket', 'workers': 4})
+        self.assertEqual(flatten_config(config), {
+            'model.epochs': 10,
+            'model.optimizer.name': 'adam',
+            'model.optimizer.betas': (0.9, 0.999),
+            'data.path': 's3://bucket',
+            'data.workers': 4,
+        })
+
+    def test_unsupported(self):
+        self.assertRaises(TypeError, flatten_config, [1, 2])
+
+
+class TestHyperparams(unittest.TestCase):
+    def test_single_patch(self):
+        with ApiServer() as server:
+            run = started_run(server.url)
+            run.writes.interval = 60
+            with run.activate():
+                kiro.hyperparam('lr', 0.1)
+                kiro.hyperparams({'lr': 0.01, 'model': {'depth': 3}})
+                kiro.tag('env', 'test')
+            run_sync(run.writes.flush())
+            run.writes.cancel()
+            run_sync(Sender.close())
+        self.assertCountEqual([r[2] for r in server.requests], [
+            {'hyperparameters': {'lr': 0.01, 'model.depth': 3}},
+            {'tags': {'env': 'test'}}])
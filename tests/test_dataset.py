@@ -0,0 +1,428 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from kiroframe_arcee.modules import dataset as dataset_module
+from kiroframe_arcee.modules import snapshots
+from kiroframe_arcee.modules.dataset import Dataset
+from kiroframe_arcee.modules.object_store import ObjectStore
+from kiroframe_arcee.modules.providers import local_file
+from kiroframe_arcee.modules.providers import amazon
+from kiroframe_arcee.modules.snapshots import SnapshotStore
+from tests.test_amazon import FakeSession, LocalS3
+from tests.test_http_file import HttpServer
+
+
+class DatasetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs('data')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def _write(path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _dataset(version, *paths):
+        dataset = Dataset('test')
+        for path in paths:
+            dataset.add_file('file://' + path)
+        dataset.wait_ready()
+        dataset._version = version
+        return dataset
+
+
+class TestObjectStore(DatasetTestCase):
+    def test_new_version_fetches_changed_files(self):
+        self._write('data/a.csv', b'a' * 10)
+        self._write('data/b.csv', b'b' * 10)
+        store = ObjectStore()
+        with patch.object(local_file, 'download',
+                          wraps=local_file.download) as download:
+            self._dataset(41, 'data/a.csv', 'data/b.csv').download(
+                store=store)
+            self.assertEqual(download.call_count, 2)
+            self._write('data/b.csv', b'c' * 10)
+            paths = self._dataset(42, 'data/a.csv', 'data/b.csv').download(
+                store=store)
+            self.assertEqual(download.call_count, 3)
+        self.assertEqual(self._read(paths['file://data/b.csv']), b'c' * 10)
+        self.assertEqual(self._read(paths['file://data/a.csv']), b'a' * 10)
+        self.assertEqual(store.size(), 30)
+
+    def test_lru_eviction(self):
+        store = ObjectStore(size_limit=25)
+        for name, data in (('a', b'a' * 10), ('b', b'b' * 10),
+                           ('c', b'c' * 10)):
+            self._write('data/%s.csv' % name, data)
+        first = self._dataset(1, 'data/a.csv')
+        first.download(store=store)
+        self._dataset(2, 'data/b.csv').download(store=store)
+        self._dataset(3, 'data/c.csv').download(store=store)
+        self.assertEqual(store.size(), 20)
+        digest = list(first._files.values())[0]['digest']
+        self.assertIsNone(store.get(digest))
+        # the version entry of the evicted object is removed with it
+        self.assertFalse(os.path.lexists(
+            first._download_path('file://data/a.csv')))
+
+    def test_eviction_symlinks(self):
+        store = ObjectStore(size_limit=15, symlink=True)
+        self._write('data/a.csv', b'a' * 10)
+        self._write('data/b.csv', b'b' * 10)
+        first = self._dataset(1, 'data/a.csv')
+        first.download(store=store)
+        second = self._dataset(2, 'data/b.csv')
+        path = second.download(store=store)['file://data/b.csv']
+        self.assertEqual(self._read(path), b'b' * 10)
+        self.assertFalse(os.path.lexists(
+            first._download_path('file://data/a.csv')))
+        self.assertEqual(store.size(), 10)
+
+    def test_eviction_clones(self):
+        def reflink(src, dst):
+            # a copy stands for the clone sharing the object extents
+            with open(dst, 'wb') as f:
+                f.write(src.read())
+            return True
+
+        store = ObjectStore(size_limit=15)
+        self._write('data/a.csv', b'a' * 10)
+        self._write('data/b.csv', b'b' * 10)
+        first = self._dataset(1, 'data/a.csv')
+        with patch.object(local_file, '_reflink', side_effect=reflink):
+            first.download(store=store)
+            # the entry is recorded once for repeated downloads
+            first.download(store=store)
+            digest = list(first._files.values())[0]['digest']
+            with open(store.object_path(digest) + '.links') as f:
+                self.assertEqual(len(f.readlines()), 1)
+            self._dataset(2, 'data/b.csv').download(store=store)
+        self.assertIsNone(store.get(digest))
+        self.assertFalse(os.path.lexists(
+            first._download_path('file://data/a.csv')))
+
+    @patch.object(local_file, '_reflink', return_value=False)
+    def test_linked_read_only(self, _):
+        store = ObjectStore()
+        self._write('data/a.csv', b'a' * 10)
+        path = self._dataset(1, 'data/a.csv').download(
+            store=store)['file://data/a.csv']
+        self.assertFalse(os.stat(path).st_mode & 0o222)
+
+
+class TestDelta(DatasetTestCase):
+    @staticmethod
+    def _response(*files):
+        return {'key': 'test', 'version': {'version': 1, 'files': [
+            {'_id': path, 'path': path, 'size': 1, 'digest': digest}
+            for path, digest in files
+        ]}}
+
+    def test_no_parent(self):
+        self.assertIsNone(Dataset('test').delta())
+
+    def test_failed_file(self):
+        self._write('data/a.csv', b'a')
+        dataset = Dataset('test')
+        dataset.add_file('file://data/a.csv')
+        dataset.add_file('file://data/missing.csv')
+        self.assertRaises(FileNotFoundError, dataset.wait_ready)
+        self.assertEqual(list(dataset._files), ['file://data/a.csv'])
+
+    def test_delta(self):
+        for name in ('a', 'b', 'c', 'd'):
+            self._write('data/%s.csv' % name, name.encode())
+        dataset = Dataset.from_response(self._response(
+            ('file://data/a.csv', 'old'), ('file://data/b.csv', 'old'),
+            ('file://data/c.csv', 'old')))
+        dataset.add_file('file://data/a.csv')
+        dataset.remove_file('file://data/b.csv')
+        dataset.add_file('file://data/d.csv')
+        dataset.wait_ready()
+        dataset.remove_file('file://data/d.csv')
+        self._write('data/e.csv', b'e')
+        dataset.add_file('file://data/e.csv')
+        dataset.wait_ready()
+        delta = dataset.delta()
+        self.assertEqual(delta['parent_version'], 1)
+        self.assertEqual([f['path'] for f in delta['changed']],
+                         ['file://data/a.csv'])
+        self.assertEqual([f['path'] for f in delta['added']],
+                         ['file://data/e.csv'])
+        self.assertEqual(delta['removed'], ['file://data/b.csv'])
+        self.assertNotIn('files', delta)
+
+        dataset._apply_delta(2, [{'_id': 'e', 'path': 'file://data/e.csv'}])
+        self.assertEqual(dataset._files['file://data/e.csv']['_id'], 'e')
+        self.assertEqual(dataset.delta()['added'], [])
+
+
+class TestSnapshots(DatasetTestCase):
+    def test_save_load(self):
+        store = SnapshotStore()
+        self.assertIsNone(store.resolve('test:latest'))
+        dataset = Dataset.from_response({
+            'key': 'test', 'labels': ['train'], 'version': {
+                'version': 3, 'files': [{
+                    '_id': 'id', 'path': 's3://bucket/a.csv', 'size': 1,
+                    'digest': 'etag', 'meta': {'format': 'csv'}}]}})
+        store.save('test:latest', dataset, '"v3"')
+        resolved = store.resolve('test:latest')
+        self.assertEqual(resolved['etag'], '"v3"')
+        loaded = store.load(resolved)
+        self.assertEqual(loaded._version, 3)
+        self.assertEqual(loaded.labels, ['train'])
+        self.assertEqual(loaded.__dict__, dataset.__dict__)
+        self.assertEqual(loaded._files['s3://bucket/a.csv']['_id'], 'id')
+
+    def test_freshness(self):
+        store = SnapshotStore()
+        dataset = Dataset.from_response({'key': 'test', 'version': {
+            'version': 3, 'files': []}})
+        store.save('test:latest', dataset, '"v3"')
+        store.save('test:V3', dataset, '"v3"')
+        latest = store.resolve('test:latest')
+        self.assertTrue(store.is_fresh(latest))
+        with patch.object(snapshots, 'ALIAS_TTL', 0):
+            self.assertFalse(store.is_fresh(latest))
+            self.assertTrue(store.is_fresh(store.resolve('test:V3')))
+            # revalidated by another process of the node
+            with open('kiroframe/manifests/test/refs.json') as f:
+                refs = json.load(f)
+            refs['latest']['version'] = 4
+            with open('kiroframe/manifests/test/refs.json', 'w') as f:
+                json.dump(refs, f)
+            self.assertIsNone(store.resolve('test:latest'))
+        store.touch(latest)
+        self.assertEqual(store.resolve('test:latest')['version'], 3)
+
+
+class TestOpen(DatasetTestCase):
+    def test_open_source(self):
+        self._write('data/a.csv', b'a' * 100)
+        dataset = self._dataset(1, 'data/a.csv')
+        with dataset.open('file://data/a.csv', store=ObjectStore()) as f:
+            self.assertEqual(f.read(10), b'a' * 10)
+            self.assertEqual(f.read(), b'a' * 90)
+        self._write('data/a.csv', b'b' * 100)
+        with dataset.open('file://data/a.csv', store=ObjectStore()) as f:
+            self.assertRaises(ValueError, f.read)
+
+    def test_open_cached(self):
+        self._write('data/a.csv', b'a' * 100)
+        dataset = self._dataset(1, 'data/a.csv')
+        store = ObjectStore()
+        dataset.download(store=store)
+        os.remove('data/a.csv')
+        with dataset.open('file://data/a.csv', store=store) as f:
+            self.assertEqual(memoryview(f)[:3], b'aaa')
+
+
+class TestIterFiles(DatasetTestCase):
+    def test_iter_files(self):
+        paths = []
+        for name, data in (('a', b'a'), ('b', b'b'), ('c', b'a'),
+                           ('d', b'd')):
+            self._write('data/%s.csv' % name, data)
+            paths.append('data/%s.csv' % name)
+        dataset = self._dataset(1, *paths)
+        files = dataset.iter_files(prefetch=2, store=ObjectStore())
+        result = [self._read(p) for p in files]
+        self.assertEqual(result, [b'a', b'b', b'a', b'd'])
+        self.assertEqual(files.files, 4)
+        self.assertGreaterEqual(files.wait_time, 0)
+
+        def order(seed):
+            return [os.path.basename(p) for p in dataset.iter_files(
+                shuffle=True, seed=seed, store=ObjectStore())]
+        self.assertEqual(order(1), order(1))
+        self.assertEqual(sorted(order(2)),
+                         ['a.csv', 'b.csv', 'c.csv', 'd.csv'])
+
+
+class TestPublish(DatasetTestCase):
+    def test_publish(self):
+        os.makedirs('data/train')
+        self._write('data/train/a.csv', b'a' * 10)
+        self._write('data/b.csv', b'b' * 3000)
+        dataset = Dataset.from_response({'key': 'test', 'version': {
+            'version': 1, 'files': []}})
+        s3 = LocalS3()
+        etag = LocalS3._md5(b'c')
+        s3.objects[('other', 'c.csv')] = etag, [b'c']
+        with patch.object(amazon, 'get_file_info', return_value=(
+                etag, 1, {})), \
+                patch.object(amazon.aioboto3, 'Session',
+                             return_value=FakeSession(s3)):
+            dataset.add_file('file://data/train/a.csv')
+            dataset.add_file('file://data/b.csv')
+            dataset.add_file('s3://other/c.csv')
+            self.assertRaises(
+                ValueError, dataset.publish, 'file://data/')
+            published = dataset.publish(
+                's3://bucket/datasets/test', part_size=1024)
+        self.assertEqual(published, {
+            'file://data/train/a.csv': 's3://bucket/datasets/test/train/a.csv',
+            'file://data/b.csv': 's3://bucket/datasets/test/b.csv'})
+        self.assertEqual(list(dataset._files), [
+            's3://bucket/datasets/test/train/a.csv',
+            's3://bucket/datasets/test/b.csv', 's3://other/c.csv'])
+        self.assertIsNone(dataset._version)
+        digest = dataset._files.digest('s3://bucket/datasets/test/b.csv')
+        self.assertEqual(digest, s3.objects[
+            ('bucket', 'datasets/test/b.csv')][0])
+        self.assertTrue(digest.endswith('-3'))
+        delta = dataset.delta()
+        self.assertEqual(len(delta['added']), 3)
+
+        dataset._version = 2
+        with patch.object(amazon.aioboto3, 'Session',
+                          return_value=FakeSession(s3)):
+            paths = dataset.download(store=ObjectStore())
+        self.assertEqual(
+            self._read(paths['s3://bucket/datasets/test/b.csv']), b'b' * 3000)
+
+
+class TestVerify(DatasetTestCase):
+    def test_verify(self):
+        for name in ('a', 'b', 'c'):
+            self._write('data/%s.csv' % name, name.encode() * 10)
+        dataset = self._dataset(
+            1, 'data/a.csv', 'data/b.csv', 'data/c.csv')
+        self.assertRaises(ValueError, dataset.verify, 'other')
+        paths = dataset.download(store=ObjectStore())
+        self.assertEqual(list(dataset.verify()), [])
+        self.assertEqual(list(dataset.verify('full')), [])
+
+        self._write(paths['file://data/a.csv'], b'x' * 10)
+        os.utime(paths['file://data/a.csv'], ns=(0, 0))
+        os.remove(paths['file://data/b.csv'])
+        self.assertEqual(
+            [(m['path'], m['reason']) for m in dataset.verify()],
+            [('file://data/a.csv', 'modified'),
+             ('file://data/b.csv', 'missing')])
+        self.assertEqual(
+            sorted((m['path'], m['reason'])
+                   for m in dataset.verify('full', workers=2)),
+            [('file://data/a.csv', 'digest'),
+             ('file://data/b.csv', 'missing')])
+
+    def test_verify_http(self):
+        for etag in ('"v1"', '"5e8a1b2c-3e8"'):
+            with HttpServer(b'x' * 10, etag=etag) as server:
+                dataset = Dataset('test')
+                dataset.add_file(server.url + '/a.csv')
+                dataset.wait_ready()
+                dataset._version = 1
+                dataset.download(store=ObjectStore())
+                # opaque etags are verified by stat only
+                self.assertEqual(list(dataset.verify('full')), [])
+
+
+class FakeSender:
+    def __init__(self, response=True):
+        self.batches = []
+        self.response = response
+
+    async def update_files_meta(self, token, files):
+        self.batches.append(files)
+        return files if self.response is True else self.response
+
+
+class FakeArcee:
+    token = 'token'
+
+    def __init__(self):
+        self.sender = FakeSender()
+
+
+class TestMetaBackfill(DatasetTestCase):
+    def test_batches(self):
+        files = []
+        for i in range(5):
+            path = 'data/%s.csv' % i
+            self._write(path, b'a,b\n%d,2\n' % i)
+            files.append(path)
+        local = self._dataset(1, *files)
+        dataset = Dataset.from_response({'key': 'test', 'version': {
+            'version': 1, 'files': [
+                dict(f, _id=str(i), meta={})
+                for i, f in enumerate(local._files.values())]}})
+        dataset._arcee = FakeArcee()
+        with patch.object(dataset_module, 'META_BATCH_SIZE', 2):
+            dataset.download(store=ObjectStore())
+        batches = dataset._arcee.sender.batches
+        self.assertEqual(sorted(len(b) for b in batches), [1, 2, 2])
+        meta = dataset._files['file://data/3.csv']['meta']
+        self.assertEqual(meta['headers'], ['a', 'b'])
+        self.assertEqual(meta['rows'], 1)
+
+    def test_same_content(self):
+        for name in ('a', 'b'):
+            self._write('data/%s.csv' % name, b'a,b\n1,2\n')
+        local = self._dataset(1, 'data/a.csv', 'data/b.csv')
+        dataset = Dataset.from_response({'key': 'test', 'version': {
+            'version': 1, 'files': [
+                dict(f, _id=str(i), meta={})
+                for i, f in enumerate(local._files.values())]}})
+        dataset._arcee = FakeArcee()
+        dataset.download(store=ObjectStore())
+        self.assertEqual(
+            sorted(f['_id'] for b in dataset._arcee.sender.batches
+                   for f in b), ['0', '1'])
+
+    def test_unexpected_response(self):
+        self._write('data/a.csv', b'a,b\n1,2\n')
+        local = self._dataset(1, 'data/a.csv')
+        for response in (None, {'error': 'failed'}, [{'_id': 'unknown'}]):
+            dataset = Dataset.from_response({'key': 'test', 'version': {
+                'version': 1, 'files': [
+                    dict(f, _id='0', meta={})
+                    for f in local._files.values()]}})
+            dataset._arcee = FakeArcee()
+            dataset._arcee.sender.response = response
+            dataset.download(store=ObjectStore())
+            self.assertEqual(len(dataset._arcee.sender.batches), 1)
+
+
+class TestShard(unittest.TestCase):
+    def setUp(self):
+        sizes = [10, 9, 8, 7, 6, 5, 4, 3, 2, 1] * 10
+        self.dataset = Dataset.from_response({'key': 'test', 'version': {
+            'version': 1, 'files': [
+                {'_id': str(i), 'path': 's3://bucket/%03d' % i, 'size': s,
+                 'digest': 'etag%s' % i} for i, s in enumerate(sizes)]}})
+
+    def test_size_balanced(self):
+        shards = [self.dataset.shard(r, 4) for r in range(4)]
+        paths = [p for shard in shards for p in shard._files]
+        self.assertEqual(sorted(paths), sorted(self.dataset._files))
+        loads = [sum(s for _, s in shard._files.sizes()) for shard in shards]
+        self.assertLessEqual(max(loads) - min(loads), 10)
+        self.assertEqual(list(self.dataset.shard(1, 4)._files),
+                         list(shards[1]._files))
+        self.assertEqual(shards[0]._version, 1)
+
+    def test_round_robin(self):
+        shard = self.dataset.shard(1, 3, strategy='round_robin')
+        self.assertEqual(len(shard._files), 33)
+        self.assertIn('s3://bucket/001', shard._files)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.dataset.shard, 4, 4)
+        self.assertRaises(ValueError, self.dataset.shard, 0, 4, 'other')
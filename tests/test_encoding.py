@@ -0,0 +1,57 @@
+import gzip
+import json
+from unittest.mock import patch
+from aiounittest import AsyncTestCase
+
+import numpy as np
+
+from kiroframe_arcee.sender import encoding
+from kiroframe_arcee.sender.sender import Sender
+from tests.test_aio import ApiServer
+
+
+class TestEncoding(AsyncTestCase):
+    def test_numpy(self):
+        data = {'loss': np.float32(0.5), 'step': np.int64(3),
+                'cpu': np.arange(4), 'grid': np.eye(2)[:, ::-1]}
+        expected = {'loss': 0.5, 'step': 3, 'cpu': [0, 1, 2, 3],
+                    'grid': [[0.0, 1.0], [1.0, 0.0]]}
+        self.assertEqual(json.loads(encoding.dumps(data)), expected)
+        with patch.object(encoding, '_dumps', encoding._json_dumps):
+            self.assertEqual(json.loads(encoding.dumps(data)), expected)
+            self.assertEqual(encoding.dumps({'a': [1, 2]}), b'{"a":[1,2]}')
+
+    def test_serializer(self):
+        try:
+            encoding.set_serializer(lambda obj: json.dumps(obj, indent=None))
+            self.assertEqual(encoding.dumps({'a': 1}), b'{"a": 1}')
+        finally:
+            encoding.set_serializer()
+
+    async def test_compression(self):
+        try:
+            encoding.set_request_compression('gzip', threshold=100)
+            body, headers = await encoding.encode_body({'a': 1})
+            self.assertNotIn('Content-Encoding', headers)
+            data = {'lines': ['line %s' % i for i in range(100)]}
+            body, headers = await encoding.encode_body(data)
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(body)), data)
+        finally:
+            encoding.set_request_compression(None)
+        self.assertRaises(ValueError, encoding.set_request_compression,
+                          'br')
+
+    async def test_sent_compressed(self):
+        data = {'stats': np.arange(1000)}
+        try:
+            encoding.set_request_compression('gzip', threshold=100)
+            with ApiServer() as server:
+                sender = Sender(server.url)
+                await sender.send_post_request(server.url + '/stats',
+                                               data=data)
+                await Sender.close()
+        finally:
+            encoding.set_request_compression(None)
+        # the api decompresses the body
+        self.assertEqual(server.requests[0][2], {'stats': list(range(1000))})
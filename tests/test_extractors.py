@@ -0,0 +1,99 @@
+import os
+import json
+import struct
+import tempfile
+import unittest
+import zipfile
+
+import pyarrow as pa
+from pyarrow import orc
+
+from kiroframe_arcee.modules import extractors
+
+
+def _npy(shape, dtype='<f4'):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (
+        dtype, tuple(shape))
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+    prefix = b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header))
+    return prefix + header.encode('latin1') + bytes(16)
+
+
+class TestExtractors(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.table = pa.table({'id': [1, 2, 3], 'name': ['a', 'b', 'c']})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _path(self, name, data=None):
+        path = os.path.join(self.tmp.name, name)
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def test_arrow(self):
+        path = self._path('data.feather')
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, self.table.schema) as writer:
+                writer.write_table(self.table, max_chunksize=2)
+        meta = extractors.extract_meta(path)
+        self.assertEqual(meta['rows'], 3)
+        self.assertEqual(meta['record_batches'], 2)
+        self.assertEqual(meta['schema'], {'id': 'int64', 'name': 'string'})
+
+    def test_orc(self):
+        path = self._path('data.orc')
+        orc.write_table(self.table, path)
+        meta = extractors.extract_meta(path)
+        self.assertEqual((meta['rows'], meta['headers']), (3, ['id', 'name']))
+
+    def test_npy(self):
+        meta = extractors.extract_meta(self._path('a.npy', _npy((2, 2))))
+        self.assertEqual(meta, {'format': 'npy', 'dtype': '<f4',
+                                'shape': [2, 2], 'fortran_order': False})
+
+    def test_npz(self):
+        path = self._path('arrays.npz')
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('x.npy', _npy((4,)))
+            archive.writestr('y.npy', _npy((1, 2), '<i8'))
+        meta = extractors.extract_meta(path)
+        self.assertEqual(meta['headers'], ['x', 'y'])
+        self.assertEqual(meta['arrays']['y']['shape'], [1, 2])
+
+    def test_safetensors(self):
+        header = json.dumps({
+            '__metadata__': {'format': 'pt'},
+            'w': {'dtype': 'F32', 'shape': [2, 3], 'data_offsets': [0, 24]},
+            'b': {'dtype': 'F16', 'shape': [3], 'data_offsets': [24, 30]},
+        }).encode()
+        path = self._path('model.safetensors',
+                          struct.pack('<Q', len(header)) + header + bytes(30))
+        meta = extractors.extract_meta(path)
+        self.assertEqual(meta['parameters'], 9)
+        self.assertEqual(meta['dtypes'], ['F16', 'F32'])
+        self.assertEqual(meta['tensors']['w']['shape'], [2, 3])
+        self.assertEqual(meta['metadata'], {'format': 'pt'})
+
+    def test_jsonl(self):
+        lines = [{'id': i, 'label': None if i % 2 else 'x'} for i in range(5)]
+        path = self._path('data.jsonl', '\n'.join(
+            json.dumps(line) for line in lines).encode())
+        meta = extractors.extract_meta(path, sample_rows=3)
+        self.assertEqual(meta['sample_rows'], 3)
+        self.assertEqual(meta['schema'], {'id': ['integer'],
+                                          'label': ['null', 'string']})
+
+    def test_registry(self):
+        path = self._path('data.custom', b'')
+        self.assertRaises(ValueError, extractors.extract_meta, path)
+        extractors.register_extractor('.custom')(
+            lambda path, **kwargs: {'format': 'custom'})
+        try:
+            self.assertEqual(extractors.extract_meta(path),
+                             {'format': 'custom'})
+        finally:
+            extractors._extractors.pop('.custom')
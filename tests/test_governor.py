@@ -0,0 +1,74 @@
+import time
+import threading
+import unittest
+from unittest.mock import patch
+
+from kiroframe_arcee.collectors.hardware import Collector
+from kiroframe_arcee.modules import governor
+from kiroframe_arcee.modules.governor import Governor
+
+
+class TestGovernor(unittest.TestCase):
+    def test_unlimited(self):
+        limits = Governor()
+        self.assertEqual(limits._reserve(10 ** 12), 0)
+
+    def test_rate(self):
+        limits = Governor(rate=1000)
+        # the bucket starts full with one second of tokens
+        self.assertEqual(limits._reserve(1000), 0)
+        self.assertAlmostEqual(limits._reserve(500), 0.5, places=2)
+        start = time.monotonic()
+        limits.consume(100)
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+
+    def test_max_files(self):
+        limits = Governor(max_files=2)
+        active, peak = [], []
+        lock = threading.Lock()
+
+        def transfer():
+            with limits.slot():
+                with lock:
+                    active.append(1)
+                    peak.append(len(active))
+                time.sleep(0.05)
+                with lock:
+                    active.pop()
+
+        threads = [threading.Thread(target=transfer) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(peak), 2)
+
+    def test_bounded_pool(self):
+        limits = Governor(max_files=2)
+        tasks = [limits.submit(lambda: threading.get_ident())
+                 for _ in range(20)]
+        self.assertLessEqual(len({task.result() for task in tasks}), 2)
+
+    def test_adaptive(self):
+        self.assertRaises(ValueError, Governor, adaptive=True)
+        mb = 1024 * 1024
+        limits = Governor(rate=16 * mb, adaptive=True, io_threshold=mb)
+        busy = {'disk_read': 4096, 'disk_write': 0, 'net_sent': 0,
+                'net_recv': 0}
+        with patch.object(Collector, 'io_stats', busy), \
+                patch.object(Collector, 'io_stats_time', time.monotonic()):
+            limits._reserve(0)
+        self.assertEqual(limits.current_rate, 8 * mb)
+        calm = dict(busy, disk_read=0)
+        with patch.object(Collector, 'io_stats', calm), \
+                patch.object(Collector, 'io_stats_time', time.monotonic()):
+            limits._reserve(0)
+        self.assertEqual(limits.current_rate, 8 * mb + 16 * mb // 10)
+
+    def test_set_transfer_limits(self):
+        try:
+            governor.set_transfer_limits(rate=100, max_files=1)
+            self.assertEqual(governor.default_governor.rate, 100)
+        finally:
+            governor.set_transfer_limits()
+        self.assertIsNone(governor.default_governor.rate)
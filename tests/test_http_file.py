@@ -0,0 +1,173 @@
+import os
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from aiohttp import web
+
+from kiroframe_arcee.modules import providers
+from kiroframe_arcee.modules.dataset import Dataset
+from kiroframe_arcee.modules.providers import http_file
+from kiroframe_arcee.utils import md5
+
+
+class HttpServer:
+    """
+    File server running on its own loop thread with optional etag and
+    range support
+    """
+
+    def __init__(self, data, etag='"v1"', ranges=True, length=True):
+        self.data = data
+        self.etag = etag
+        self.ranges = ranges
+        self.length = length
+        self.requests = []
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+
+    async def _handler(self, request):
+        self.requests.append((request.method, request.headers.get('Range')))
+        headers = {'Accept-Ranges': 'bytes'} if self.ranges else {}
+        if self.etag:
+            headers['ETag'] = self.etag
+            if request.headers.get('If-None-Match') == self.etag:
+                return web.Response(status=304, headers=headers)
+            if_match = request.headers.get('If-Match')
+            if if_match and if_match != self.etag:
+                return web.Response(status=412)
+        if request.method == 'HEAD':
+            if self.length:
+                headers['Content-Length'] = str(len(self.data))
+            return web.Response(headers=headers)
+        range_header = request.headers.get('Range')
+        if range_header and self.ranges:
+            start, end = map(int, range_header[len('bytes='):].split('-'))
+            headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                start, end, len(self.data))
+            return web.Response(body=self.data[start:end + 1], status=206,
+                                headers=headers)
+        return web.Response(body=self.data, headers=headers)
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self._handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        return self._runner.addresses[0][1]
+
+    def __enter__(self):
+        self._thread.start()
+        port = asyncio.run_coroutine_threadsafe(
+            self._start(), self._loop).result()
+        self.url = 'http://127.0.0.1:%s/data.bin' % port
+        return self
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(
+            self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+class TestHttpFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name + '/'
+        self.data = os.urandom(10 * 1024 + 7)
+        digest = md5()
+        digest.update(self.data)
+        self.md5 = digest.hexdigest()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _read(self):
+        with open(self.dest + 'file', 'rb') as f:
+            return f.read()
+
+    def test_registry(self):
+        self.assertEqual(providers.get_provider('https://host/a'),
+                         (http_file, 'https://host/a'))
+        self.assertEqual(providers.get_provider('file://data/file.csv')[1],
+                         'data/file.csv')
+        self.assertRaises(TypeError, providers.get_provider, 'ftp://a')
+
+    def test_file_info(self):
+        with HttpServer(self.data) as server:
+            self.assertEqual(
+                asyncio.run(http_file.get_file_info(server.url)),
+                ('v1', len(self.data), {}))
+            self.assertIsNone(asyncio.run(
+                http_file.get_file_info(server.url, digest='v1')))
+        with HttpServer(self.data, etag=None) as server:
+            self.assertEqual(
+                asyncio.run(http_file.get_file_info(server.url)),
+                (self.md5, len(self.data), {}))
+        # the size missing in HEAD response is got with GET
+        for ranges in (True, False):
+            with HttpServer(self.data, ranges=ranges, length=False) as server:
+                self.assertEqual(
+                    asyncio.run(http_file.get_file_info(server.url)),
+                    ('v1', len(self.data), {}))
+
+    def test_ranged_download(self):
+        threads = set()
+        pwrite = http_file._pwrite
+
+        def write(fd, data, offset):
+            threads.add(threading.current_thread().name)
+            return pwrite(fd, data, offset)
+
+        with HttpServer(self.data) as server:
+            with patch.object(http_file, '_pwrite', side_effect=write):
+                asyncio.run(http_file.download(
+                    server.url, 'v1', self.dest, 'file', part_size=1024))
+            self.assertEqual(self._read(), self.data)
+            # the shared session loop doesn't write the files
+            self.assertNotIn('kiroframe-http', threads)
+            ranges = [r for m, r in server.requests if m == 'GET']
+            self.assertEqual(len(ranges), 11)
+            server.etag = '"v2"'
+            with self.assertRaises(ValueError):
+                asyncio.run(http_file.download(
+                    server.url, 'v1', self.dest, 'file', part_size=1024))
+        self.assertEqual(os.listdir(self.dest), ['file'])
+
+    def test_download_without_ranges(self):
+        with HttpServer(self.data, etag=None, ranges=False) as server:
+            asyncio.run(http_file.download(
+                server.url, self.md5, self.dest, 'file', part_size=1024))
+            self.assertEqual(self._read(), self.data)
+            with self.assertRaises(ValueError):
+                asyncio.run(http_file.download(
+                    server.url, 'other', self.dest, 'file'))
+
+    def test_open_file(self):
+        with HttpServer(self.data) as server:
+            with http_file.open_file(server.url, 'v1', len(self.data),
+                                     readahead=4096) as f:
+                f.seek(5000)
+                self.assertEqual(f.read(10), self.data[5000:5010])
+                f.seek(0)
+                self.assertEqual(f.read(), self.data)
+
+    def test_dataset_revalidation(self):
+        with HttpServer(self.data) as server:
+            dataset = Dataset.from_response({'key': 'test', 'version': {
+                'version': 1, 'files': [{
+                    '_id': 'id', 'path': server.url, 'size': len(self.data),
+                    'digest': 'v1', 'meta': {'format': 'bin'}}]}})
+            dataset.add_file(server.url)
+            dataset.wait_ready()
+            self.assertEqual(dataset._files[server.url]['_id'], 'id')
+            self.assertEqual(dataset.delta()['changed'], [])
+            server.etag = '"v2"'
+            dataset._version = 2
+            dataset.add_file(server.url)
+            dataset.wait_ready()
+            self.assertEqual(dataset._files[server.url]['digest'], 'v2')
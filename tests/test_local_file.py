@@ -0,0 +1,55 @@
+import os
+import tempfile
+from aiounittest import AsyncTestCase
+
+from kiroframe_arcee.modules.providers import local_file
+from kiroframe_arcee.utils import md5
+
+
+class TestLocalDownload(AsyncTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'source.bin')
+        self.dest = os.path.join(self.tmp.name, 'dest') + '/'
+        self.data = os.urandom(3 * 1024 * 1024 + 11)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        digest = md5()
+        digest.update(self.data)
+        self.digest = digest.hexdigest()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    async def test_copy(self):
+        await local_file.download(
+            self.src, self.digest, self.dest, 'file', hardlink=False)
+        self.assertEqual(self._read(self.dest + 'file'), self.data)
+        self.assertNotEqual(os.stat(self.src).st_ino,
+                            os.stat(self.dest + 'file').st_ino)
+
+    async def test_link(self):
+        await local_file.download(self.src, self.digest, self.dest, 'file')
+        self.assertEqual(self._read(self.dest + 'file'), self.data)
+        self.assertEqual(os.listdir(self.dest), ['file'])
+
+    async def test_empty_file(self):
+        open(self.src, 'wb').close()
+        await local_file.download(
+            self.src, md5().hexdigest(), self.dest, 'file', hardlink=False)
+        self.assertEqual(self._read(self.dest + 'file'), b'')
+
+    async def test_changed_source(self):
+        for hardlink in (True, False):
+            with self.assertRaises(ValueError):
+                await local_file.download(
+                    self.src, 'other', self.dest, 'file', hardlink=hardlink)
+            self.assertEqual(os.listdir(self.dest), [])
+
+    def test_abstract_reader(self):
+        self.assertRaises(TypeError, local_file.VerifiedReader,
+                          self.src, self.digest, len(self.data))
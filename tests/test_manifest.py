@@ -0,0 +1,56 @@
+import json
+import unittest
+from unittest.mock import patch
+
+from kiroframe_arcee.modules.manifest import Manifest, consume
+from kiroframe_arcee.sender import encoding
+
+MD5 = '0cc175b9c0f1b6a831c399e269772661'
+
+
+class TestManifest(unittest.TestCase):
+    def test_digests(self):
+        manifest = Manifest()
+        for path, digest in (('a', MD5), ('b', MD5 + '-12'), ('c', 'etag')):
+            manifest.set(path, digest, 1)
+        self.assertEqual([manifest.digest(p) for p in 'abc'],
+                         [MD5, MD5 + '-12', 'etag'])
+        manifest.set('c', MD5, 2)
+        self.assertEqual(manifest.digest('c'), MD5)
+        self.assertEqual(manifest.size('c'), 2)
+
+    def test_from_files(self):
+        files = [{'_id': 'id', 'path': 'a', 'size': 1, 'digest': MD5,
+                  'meta': {'format': 'csv'}}]
+        manifest = Manifest.from_files(files)
+        self.assertEqual(len(files), 1)
+        self.assertEqual(manifest['a'], Manifest.from_files(
+            consume(files))['a'])
+        self.assertEqual(files, [])
+        self.assertEqual(manifest['a'], {
+            '_id': 'id', 'path': 'a', 'size': 1, 'digest': MD5,
+            'meta': {'format': 'csv'}})
+
+    def test_remove(self):
+        manifest = Manifest()
+        for i in range(10):
+            manifest.set(str(i), MD5, i, {'i': i})
+        for i in range(8):
+            manifest.remove(str(i))
+        self.assertEqual(list(manifest), ['8', '9'])
+        self.assertEqual(len(manifest._paths), 4)
+        self.assertEqual(manifest['9']['meta'], {'i': 9})
+        self.assertNotIn('1', manifest)
+
+    def test_iter_json(self):
+        manifest = Manifest()
+        for i in range(5):
+            manifest.set(str(i), MD5, i)
+        chunks = list(manifest.iter_json(chunk_rows=2))
+        self.assertEqual(len(chunks), 3)
+        files = json.loads(b'[' + b','.join(chunks) + b']')
+        self.assertEqual([f['size'] for f in files], list(range(5)))
+        # the request serializer is used
+        with patch.object(encoding, '_dumps', lambda obj: b'{}'):
+            self.assertEqual(next(manifest.iter_json(chunk_rows=2)),
+                             b'{},{}')
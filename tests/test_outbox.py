@@ -0,0 +1,148 @@
+import asyncio
+from unittest.mock import patch
+from aiounittest import AsyncTestCase
+
+import aiohttp
+
+import kiroframe_arcee as kiro
+from kiroframe_arcee.sender import outbox as outbox_module
+from kiroframe_arcee.sender import retry
+from kiroframe_arcee.sender.outbox import (
+    EVENTS, METRICS, PROC_STATS, Outbox)
+from kiroframe_arcee.sender.sender import Sender
+from tests.test_aio import ApiServer, sent, started_run
+
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+        self.errors = []
+
+    def __call__(self, value):
+        async def send():
+            if self.errors:
+                raise self.errors.pop(0)
+            self.sent.append(value)
+        return send
+
+
+class TestOutbox(AsyncTestCase):
+    def _blocked(self):
+        # the worker waits for the first request until release is set
+        outbox = Outbox()
+        release = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        async def block():
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+                release.wait(), loop))
+        outbox._push(EVENTS, block)
+        return outbox, release
+
+    async def _wait_blocked(self, outbox):
+        while outbox.counters()['queued'][EVENTS]:
+            await asyncio.sleep(0.01)
+
+    @patch.dict(outbox_module.CATEGORIES, {PROC_STATS: ('drop_oldest', 3)})
+    async def test_drop_oldest(self):
+        outbox, release = self._blocked()
+        await self._wait_blocked(outbox)
+        send = Recorder()
+        for i in range(5):
+            await outbox.put(PROC_STATS, send(i))
+        release.set()
+        self.assertTrue(await outbox.drain(5))
+        outbox.close()
+        self.assertEqual(send.sent, [2, 3, 4])
+        self.assertEqual(outbox.counters()['dropped'][PROC_STATS], 2)
+
+    @patch.dict(outbox_module.CATEGORIES, {METRICS: ('downsample', 4)})
+    async def test_downsample(self):
+        outbox, release = self._blocked()
+        await self._wait_blocked(outbox)
+        send = Recorder()
+        for i in range(6):
+            await outbox.put(METRICS, send(i))
+        release.set()
+        self.assertTrue(await outbox.drain(5))
+        outbox.close()
+        # the newest metric is always kept
+        self.assertEqual(send.sent, [1, 3, 4, 5])
+        self.assertEqual(outbox.counters()['dropped'][METRICS], 2)
+
+    @patch.dict(outbox_module.CATEGORIES, {EVENTS: ('never_drop', 2)})
+    async def test_never_drop(self):
+        outbox, release = self._blocked()
+        await self._wait_blocked(outbox)
+        send = Recorder()
+        await outbox.put(EVENTS, send(0))
+        await outbox.put(EVENTS, send(1))
+        # the caller waits for space in the full queue
+        put = asyncio.ensure_future(outbox.put(EVENTS, send(2)))
+        await asyncio.sleep(0.05)
+        self.assertFalse(put.done())
+        release.set()
+        await put
+        self.assertTrue(await outbox.drain(5))
+        outbox.close()
+        self.assertEqual(send.sent, [0, 1, 2])
+        self.assertEqual(outbox.counters()['dropped'][EVENTS], 0)
+
+    @patch.object(retry, 'BACKOFF_BASE', 0)
+    async def test_events_retried(self):
+        outbox = Outbox()
+        send = Recorder()
+        send.errors = [aiohttp.ServerDisconnectedError()]
+        await outbox.put(EVENTS, send('event'))
+        send_stats = Recorder()
+        send_stats.errors = [aiohttp.ServerDisconnectedError()]
+        await outbox.put(PROC_STATS, send_stats('stats'))
+        self.assertTrue(await outbox.drain(5))
+        outbox.close()
+        self.assertEqual(send.sent, ['event'])
+        self.assertEqual(send_stats.sent, [])
+        counters = outbox.counters()
+        self.assertEqual((counters['sent'], counters['failed']), (1, 1))
+
+    async def test_worker_survives(self):
+        outbox = Outbox()
+        send = Recorder()
+        with patch.object(outbox_module, 'backoff', side_effect=ValueError):
+            send.errors = [aiohttp.ServerDisconnectedError()]
+            await outbox.put(EVENTS, send('lost'))
+            self.assertTrue(await outbox.drain(5))
+        await outbox.put(EVENTS, send('event'))
+        self.assertTrue(await outbox.drain(5))
+        outbox.close()
+        self.assertEqual(send.sent, ['event'])
+        self.assertEqual(outbox.counters()['failed'], 1)
+
+    async def test_priority(self):
+        outbox, release = self._blocked()
+        await self._wait_blocked(outbox)
+        send = Recorder()
+        await outbox.put(PROC_STATS, send('stats'))
+        await outbox.put(METRICS, send('metric'))
+        await outbox.put(EVENTS, send('event'))
+        release.set()
+        self.assertTrue(await outbox.drain(5))
+        outbox.close()
+        self.assertEqual(send.sent, ['event', 'metric', 'stats'])
+
+
+class TestCounters(AsyncTestCase):
+    async def test_counters(self):
+        with ApiServer() as server:
+            with started_run(server.url).activate() as run:
+                for i in range(3):
+                    await kiro.aio.send({'loss': i})
+                for i in range(3):
+                    await kiro.aio.tag('key', i)
+                await sent(run)
+                run.writes.cancel()
+                counters = await kiro.aio.counters()
+            await Sender.close()
+        self.assertEqual(counters['sent'], 3)
+        self.assertEqual(counters['dropped'][METRICS], 0)
+        # the second and the third tag are merged into the pending patch
+        self.assertEqual(counters['coalesced'], 2)
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from kiroframe_arcee.modules import extractors, profiling
+from kiroframe_arcee.modules.dataset import Dataset
+from kiroframe_arcee.modules.profiling import MetaCache
+from kiroframe_arcee.modules.providers import local_file
+
+
+class TestProfileCsv(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'data.csv')
+        with open(self.path, 'w') as f:
+            f.write('id,value,name\n')
+            for i in range(1000):
+                f.write('%s,%s,%s\n' % (
+                    i, '' if i % 10 == 0 else i / 2, 'n%03d' % (999 - i)))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_profile(self):
+        with patch.object(profiling, 'CSV_BLOCK_SIZE', 1024):
+            meta = profiling.profile_csv(self.path)
+        self.assertEqual(meta['rows'], 1000)
+        self.assertEqual(meta['headers'], ['id', 'value', 'name'])
+        self.assertEqual(meta['schema'], {
+            'id': 'int64', 'value': 'double', 'name': 'string'})
+        self.assertEqual(meta['columns']['id'],
+                         {'nulls': 0, 'min': 0, 'max': 999})
+        self.assertEqual(meta['columns']['value'],
+                         {'nulls': 100, 'min': 0.5, 'max': 499.5})
+        self.assertEqual(meta['columns']['name']['min'], 'n000')
+
+    def test_sample(self):
+        with patch.object(profiling, 'CSV_BLOCK_SIZE', 1024):
+            meta = profiling.profile_csv(self.path, sample_rows=150)
+        # the row count of the file is unknown
+        self.assertNotIn('rows', meta)
+        self.assertEqual(meta['sampled_rows'], 150)
+        self.assertEqual(meta['columns']['id']['max'], 149)
+        self.assertIsNone(profiling.merge_profiles([meta, meta])['rows'])
+        # the sample covering the whole file keeps the count
+        with patch.object(profiling, 'CSV_BLOCK_SIZE', 1024):
+            meta = profiling.profile_csv(self.path, sample_rows=1000)
+        self.assertEqual(meta['rows'], 1000)
+
+    def test_inconsistent_types(self):
+        with open(self.path, 'a') as f:
+            f.write('last,1,x\n')
+        with patch.object(profiling, 'CSV_BLOCK_SIZE', 1024):
+            meta = profiling.profile_csv(self.path)
+        self.assertEqual(meta['schema']['id'], 'string')
+        self.assertEqual(meta['rows'], 1001)
+        # other columns keep their types and stats
+        self.assertEqual(meta['schema']['value'], 'double')
+        self.assertEqual(meta['columns']['value']['max'], 499.5)
+
+    def test_default_sample(self):
+        with patch.object(profiling, 'CSV_BLOCK_SIZE', 1024), \
+                patch.object(extractors, '_extractors', dict(
+                    extractors._extractors, **{'.csv': extractors.Extractor(
+                        extractors._csv, False, 100)})):
+            meta = local_file.read_file_meta(self.path)
+            self.assertEqual(meta['sampled_rows'], 100)
+            meta = local_file.read_file_meta(self.path, full_profile=True)
+            self.assertEqual(meta['rows'], 1000)
+
+    def test_cache(self):
+        cache = MetaCache(os.path.join(self.tmp.name, 'meta'))
+        with patch.object(profiling, 'default_cache', cache):
+            meta = local_file.read_file_meta(self.path, 'digest')
+            with patch.object(profiling, 'profile_csv',
+                              return_value={}) as profile:
+                self.assertEqual(
+                    local_file.read_file_meta(self.path, 'digest'), meta)
+                local_file.read_file_meta(self.path, 'digest', 10)
+            self.assertEqual(profile.call_count, 1)
+
+
+class TestProfileParquet(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = []
+        for year in (2023, 2024):
+            path = os.path.join(
+                self.tmp.name, 'year=%s' % year, 'part.parquet')
+            os.makedirs(os.path.dirname(path))
+            table = pa.table({'id': [year, None, year + 10],
+                              'name': ['a', 'b', 'c']})
+            pq.write_table(table, path, row_group_size=2)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_footer(self):
+        meta = local_file.read_file_meta(self.paths[0])
+        self.assertEqual(meta['rows'], 3)
+        self.assertEqual(meta['row_groups'], 2)
+        self.assertEqual(meta['partitions'], {'year': '2023'})
+        self.assertEqual(meta['schema'], {'id': 'int64', 'name': 'string'})
+        column = meta['columns']['id']
+        self.assertEqual((column['nulls'], column['min'], column['max']),
+                         (1, 2023, 2033))
+        self.assertGreater(column['compressed_size'], 0)
+        self.assertIn('PLAIN', column['encodings'])
+
+    def test_row_group_without_stats(self):
+        table = pa.table({'id': [1, 2], 'empty': pa.array([None, None],
+                                                          pa.int64())})
+        metadata = []
+        for stats in (True, False):
+            path = os.path.join(self.tmp.name, '%s.parquet' % stats)
+            pq.write_table(table, path, write_statistics=stats)
+            metadata.append(pq.read_metadata(path))
+        # footer of the row groups written with and without statistics
+        metadata[0].append_row_groups(metadata[1])
+        path = os.path.join(self.tmp.name, 'mixed.parquet')
+        metadata[0].write_metadata_file(path)
+        columns = profiling.profile_parquet(path)['columns']
+        self.assertEqual(
+            (columns['id']['nulls'], columns['id']['min'],
+             columns['id']['max']), (None, None, None))
+        # row groups of nulls only have no range
+        self.assertEqual(profiling.profile_parquet(
+            os.path.join(self.tmp.name, 'True.parquet'))['columns']['id'][
+                'max'], 2)
+
+    def test_dataset_profile(self):
+        dataset = Dataset.from_response({'key': 'test', 'version': {
+            'version': 1, 'files': [
+                {'_id': str(i), 'path': 'file://' + path, 'size': 1,
+                 'digest': 'etag%s' % i}
+                for i, path in enumerate(self.paths)]}})
+        with patch.object(profiling, 'profile_parquet',
+                          wraps=profiling.profile_parquet) as footer:
+            profile = dataset.profile()
+        self.assertEqual(footer.call_count, 2)
+        self.assertEqual(profile['files'], 2)
+        self.assertEqual(profile['rows'], 6)
+        self.assertEqual(profile['partitions'], {'year': ['2023', '2024']})
+        self.assertEqual(profile['columns']['id']['nulls'], 2)
+        self.assertEqual(profile['columns']['id']['max'], 2034)
@@ -0,0 +1,132 @@
+import time
+import unittest
+from email.utils import formatdate
+from unittest.mock import patch
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiounittest import AsyncTestCase
+
+import aiohttp
+
+from kiroframe_arcee.sender import retry
+from kiroframe_arcee.sender.retry import (
+    CircuitBreaker, CircuitOpenError, with_retries)
+from kiroframe_arcee.sender.sender import Sender
+
+
+def response_error(status, headers=None):
+    return aiohttp.ClientResponseError(
+        None, (), status=status, headers=headers or {})
+
+
+class Flaky:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(retry.retry_after(
+            response_error(503, {'Retry-After': '7'})), 7)
+
+    def test_date(self):
+        delay = retry.retry_after(response_error(
+            503, {'Retry-After': formatdate(time.time() + 20, usegmt=True)}))
+        self.assertTrue(15 < delay <= 20)
+
+    def test_backoff(self):
+        # long Retry-After is capped
+        self.assertEqual(retry.backoff(0, response_error(
+            429, {'Retry-After': '3600'})), retry.MAX_BACKOFF)
+        for attempt in range(5):
+            self.assertLessEqual(retry.backoff(attempt),
+                                 retry.BACKOFF_BASE * 2 ** attempt)
+        self.assertLessEqual(retry.backoff(10_000), retry.MAX_BACKOFF)
+
+
+@patch.object(retry, 'BACKOFF_BASE', 0)
+class TestWithRetries(AsyncTestCase):
+    async def test_transient(self):
+        request = Flaky(response_error(502), aiohttp.ServerDisconnectedError())
+        self.assertEqual(await with_retries(request), 'ok')
+        self.assertEqual(request.calls, 3)
+
+    async def test_not_idempotent(self):
+        # the api could have processed the request
+        request = Flaky(response_error(502))
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await with_retries(request, idempotent=False)
+        request = Flaky(response_error(503))
+        self.assertEqual(await with_retries(request, idempotent=False), 'ok')
+
+    async def test_rejected(self):
+        request = Flaky(response_error(400))
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await with_retries(request)
+        self.assertEqual(request.calls, 1)
+
+    async def test_breaker(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        request = Flaky(*[response_error(502)] * 10)
+        with self.assertRaises(CircuitOpenError):
+            await with_retries(request, breaker)
+        self.assertEqual(request.calls, 2)
+        with self.assertRaises(CircuitOpenError):
+            await with_retries(request, breaker)
+        self.assertEqual(request.calls, 2)
+        # a single probe after the reset timeout
+        breaker._opened -= 60
+        request.errors = []
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(await with_retries(request, breaker), 'ok')
+
+    async def test_wait_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.1)
+        breaker.failure()
+        request = Flaky()
+        # waits for the probe instead of failing at once
+        self.assertEqual(
+            await with_retries(request, breaker, wait_open=True), 'ok')
+        self.assertEqual(request.calls, 1)
+        self.assertFalse(breaker.is_open)
+
+
+class TestSender(AsyncTestCase):
+    @patch.object(retry, 'BACKOFF_BASE', 0)
+    async def test_finish_retried(self):
+        statuses = [502]
+
+        async def handler(request):
+            if statuses:
+                return web.Response(status=statuses.pop(),
+                                    headers={'Retry-After': '0'})
+            return web.json_response({'state': 2})
+
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', handler)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            sender = Sender(str(server.make_url('')))
+            self.assertEqual(
+                await sender.change_state('run', 'token', 2, True),
+                {'state': 2})
+        finally:
+            await Sender.close()
+            await server.close()
+
+    def test_timeouts(self):
+        sender = Sender('http://api')
+        self.assertEqual(sender._timeout('http://api/run/1/proc').total, 10)
+        self.assertEqual(
+            sender._timeout('http://api/run/1/dataset_register').total, 600)
+        self.assertEqual(sender._timeout('http://api/run/1').total, 30)
@@ -0,0 +1,102 @@
+import gc
+import asyncio
+import weakref
+import threading
+from unittest.mock import patch
+from aiounittest import AsyncTestCase
+
+import kiroframe_arcee as kiro
+from kiroframe_arcee import aio
+from kiroframe_arcee.collectors.hardware import Collector
+from kiroframe_arcee.sender.sender import Sender
+from kiroframe_arcee.utils import run_sync
+from tests.test_aio import ApiServer, sent, started_run
+
+
+class TestRun(AsyncTestCase):
+    def test_no_active_run(self):
+        with patch.object(aio, '_default_run', None):
+            self.assertRaises(RuntimeError, kiro.current_run)
+
+    def test_default_run(self):
+        run = started_run('http://localhost')
+        with patch.object(aio, '_default_run', run):
+            self.assertIs(kiro.current_run(), run)
+            other = started_run('http://localhost')
+            with other.activate():
+                self.assertIs(kiro.current_run(), other)
+            self.assertIs(kiro.current_run(), run)
+
+    async def test_concurrent_threads(self):
+        with ApiServer() as server:
+            def trial(run_id):
+                with started_run(server.url, run_id).activate() as run:
+                    for i in range(3):
+                        kiro.milestone(i)
+                run_sync(sent(run))
+
+            threads = [threading.Thread(target=trial, args=(run_id, ))
+                       for run_id in ('a', 'b', 'c')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            await Sender.close()
+        milestones = dict()
+        for _, path, body, _ in server.requests:
+            milestones.setdefault(path, []).append(body['milestone'])
+        self.assertEqual(milestones, {
+            '/run/%s/milestones' % run_id: [0, 1, 2]
+            for run_id in ('a', 'b', 'c')})
+
+    async def test_tasks_inherit_run(self):
+        with ApiServer() as server:
+            async def trial(run_id):
+                with started_run(server.url, run_id).activate() as run:
+                    # tasks started by the trial log to its run
+                    await asyncio.gather(*(asyncio.ensure_future(
+                        aio.stage(name)) for name in ('x', 'y')))
+                await sent(run)
+
+            await asyncio.gather(trial('a'), trial('b'))
+            await Sender.close()
+        self.assertEqual(
+            sorted((path, body['stage'])
+                   for _, path, body, _ in server.requests),
+            [('/run/a/stages', 'x'), ('/run/a/stages', 'y'),
+             ('/run/b/stages', 'x'), ('/run/b/stages', 'y')])
+
+    async def test_finished_run_released(self):
+        async def imports(self):
+            return []
+
+        with ApiServer(response={'id': 'run'}) as server, \
+                patch.object(Sender, '_imports_data', imports):
+            run = kiro.Run('token', 'task', endpoint_url=server.url,
+                           period=0.05)
+            await run.start()
+            with run.activate():
+                await aio.finish()
+            await Sender.close()
+        ref = weakref.ref(run)
+        del run
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class TestSharedStats(AsyncTestCase):
+    async def test_collected_once(self):
+        calls = []
+
+        async def collect_stats():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {'ps_stats': len(calls)}
+
+        with patch.object(Collector, 'collect_stats', collect_stats):
+            results = await asyncio.gather(
+                *(Collector.shared_stats() for _ in range(5)))
+            self.assertEqual(results, [{'ps_stats': 1}] * 5)
+            # the next heartbeat collects new stats
+            self.assertEqual(await Collector.shared_stats(),
+                             {'ps_stats': 2})
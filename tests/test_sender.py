@@ -0,0 +1,83 @@
+import json
+from unittest.mock import patch
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiounittest import AsyncTestCase
+
+from kiroframe_arcee.sender import retry
+from kiroframe_arcee.sender.sender import Sender
+
+
+class SenderTestCase(AsyncTestCase):
+    async def _server(self, handler):
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', handler)
+        server = TestServer(app)
+        await server.start_server()
+        return server
+
+
+class TestStreamRequest(SenderTestCase):
+    async def test_stream_body(self):
+        bodies = []
+
+        async def handler(request):
+            bodies.append(json.loads(await request.read()))
+            return web.json_response({})
+
+        server = await self._server(handler)
+        try:
+            sender = Sender(str(server.make_url('')))
+            for data in ({'key': 'test'}, {}):
+                await sender.send_post_stream_request(
+                    sender.endpoint_url + '/register', data=data,
+                    key='files', chunks=lambda: iter([b'1,2', b'3']))
+        finally:
+            await Sender.close()
+            await server.close()
+        self.assertEqual(bodies, [{'key': 'test', 'files': [1, 2, 3]},
+                                  {'files': [1, 2, 3]}])
+
+    @patch.object(retry, 'BACKOFF_BASE', 0)
+    async def test_retried(self):
+        bodies = []
+
+        async def handler(request):
+            bodies.append(json.loads(await request.read()))
+            if len(bodies) == 1:
+                return web.Response(status=503)
+            return web.json_response({})
+
+        server = await self._server(handler)
+        try:
+            sender = Sender(str(server.make_url('')))
+            await sender.send_post_stream_request(
+                sender.endpoint_url + '/register', data={}, key='files',
+                chunks=lambda: iter([b'1,2', b'3']))
+        finally:
+            await Sender.close()
+            await server.close()
+        # the stream is rebuilt for the retry
+        self.assertEqual(bodies, [{'files': [1, 2, 3]}] * 2)
+
+
+class TestUseDataset(SenderTestCase):
+    async def test_conditional(self):
+        async def handler(request):
+            if request.headers.get('If-None-Match') == '"v1"':
+                return web.Response(status=304)
+            return web.json_response({'key': 'test'}, headers={'ETag': '"v1"'})
+
+        server = await self._server(handler)
+        try:
+            sender = Sender(str(server.make_url('')))
+            self.assertEqual(
+                await sender.use_dataset('token', 'run', 'test:latest'),
+                ({'key': 'test'}, '"v1"'))
+            self.assertEqual(
+                await sender.use_dataset('token', 'run', 'test:latest',
+                                         etag='"v1"'),
+                (None, '"v1"'))
+        finally:
+            await Sender.close()
+            await server.close()
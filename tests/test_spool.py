@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import aiohttp
+
+from kiroframe_arcee import cli
+from kiroframe_arcee.sender import spool as spool_module
+from kiroframe_arcee.sender.sender import Sender
+from kiroframe_arcee.sender.spool import Spool
+from kiroframe_arcee.utils import default_loop, run_sync
+from tests.test_aio import ApiServer
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name + '/spool/'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _append(self, spool, count, start=0):
+        for i in range(start, start + count):
+            spool.append('http://api', 'http://api/run/r/milestones', 'POST',
+                         {'x-api-key': 'token'}, {'milestone': i})
+
+    def _wait_compressed(self):
+        # sealed segments are compressed in background
+        for _ in range(100):
+            segments = sorted(name for name in os.listdir(self.path)
+                              if name.endswith(('.log', '.log.gz')))
+            if not any(name.endswith('.log') for name in segments[:-1]):
+                break
+            time.sleep(0.01)
+
+    def test_segments(self):
+        with patch.object(spool_module, 'SEGMENT_SIZE', 1024):
+            spool = Spool(self.path)
+            self._append(spool, 50)
+            spool.close()
+        self._wait_compressed()
+        names = sorted(os.listdir(self.path))
+        self.assertTrue(any(n.endswith('.log.gz') for n in names))
+        # the record torn by a crash is dropped on reopen
+        with open(os.path.join(self.path, names[-2]), 'ab') as f:
+            f.write(b'{"method": "PO')
+        spool = Spool(self.path)
+        self._append(spool, 1, 50)
+        self.assertEqual(
+            [r['body']['milestone'] for r in spool.records()],
+            list(range(51)))
+        self.assertEqual([r['seq'] for r in spool.records(48)], [49, 50, 51])
+        spool.close()
+
+    def test_locked(self):
+        spool = Spool(self.path)
+        self.assertRaises(ValueError, Spool, self.path)
+        spool.close()
+
+    def test_ship_resume(self):
+        with ApiServer() as server:
+            spool = Spool(self.path)
+            self._append(spool, 3)
+            spool.close()
+            self.assertEqual(cli.main(
+                ['replay', self.path, '--endpoint-url', server.url]), 0)
+            spool = Spool(self.path)
+            self.assertEqual(spool.pending, 0)
+            self._append(spool, 2, 3)
+            spool.close()
+            self.assertEqual(cli.main(
+                ['replay', self.path, '--endpoint-url', server.url]), 0)
+        self.assertEqual([r[2]['milestone'] for r in server.requests],
+                         [0, 1, 2, 3, 4])
+
+    def test_offline(self):
+        spool = Spool(self.path)
+        sender = Sender('http://offline', spool=spool, offline=True)
+
+        async def log():
+            model_id = await sender.add_model('token', 'model')
+            await sender.add_version('run', model_id, 'token', 1)
+            return model_id
+
+        model_id = asyncio.run(log())
+        self.assertTrue(model_id.startswith(spool_module.PLACEHOLDER_PREFIX))
+        spool.close()
+        with ApiServer(response={'_id': 'm1'}) as server:
+            self.assertEqual(cli.main(
+                ['replay', self.path, '--endpoint-url', server.url]), 0)
+        self.assertEqual([r[:3] for r in server.requests], [
+            ('POST', '/models', {'key': 'model'}),
+            ('PATCH', '/runs/run/models/m1/version', {'version': '1'})])
+
+    def test_checkpoint_returns(self):
+        spool = Spool(self.path)
+        sender = Sender('http://offline', spool=spool, offline=True)
+
+        async def log():
+            model_id = await sender.add_model('token', 'model')
+            await sender.add_version('run', model_id, 'token', 1)
+            return model_id
+
+        model_id = asyncio.run(log())
+        saved = []
+        original = spool._ship_record
+
+        async def ship_record(session, record, endpoint_url=None):
+            path = os.path.join(self.path, 'checkpoint.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    saved.append(json.load(f))
+            await original(session, record, endpoint_url)
+
+        async def ship(url):
+            async with aiohttp.ClientSession() as session:
+                return await spool.ship(session, url)
+
+        with ApiServer(response={'_id': 'm1'}) as server:
+            with patch.object(spool, '_ship_record', ship_record):
+                self.assertEqual(asyncio.run(ship(server.url)), 2)
+        spool.close()
+        # the created model is checkpointed before the next record
+        self.assertEqual(saved, [{'seq': 1, 'ids': {model_id: 'm1'}}])
+
+    def test_shipper(self):
+        with ApiServer() as server:
+            spool = Spool(self.path)
+            spool.start_shipper(default_loop)
+            for i in range(3):
+                spool.append(server.url, server.url + '/run/r/stages',
+                             'POST', {}, {'stage': i})
+            self.assertTrue(run_sync(spool.drain(5)))
+            spool.close()
+        self.assertEqual([r[2]['stage'] for r in server.requests],
+                         [0, 1, 2])